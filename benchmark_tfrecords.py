@@ -0,0 +1,751 @@
+"""
+Benchmarks of the tfrecord creation.
+
+    python benchmark_tfrecords.py --num_records 20000 --profile full
+    python benchmark_tfrecords.py --suite --preset ocr --threads 1 4 --output_json results.json
+
+The serialization benchmark times the encoding of Examples from image example dicts by
+
+    protobuf: the `tf.train.Example` of `create_tfrecords._convert_to_example`, serialized
+      with `SerializeToString(deterministic=True)`, when tensorflow is installed.
+    encode_example: `tfrecord_io.encode_example`, encoding every feature on its own.
+    serializer: the precompiled `tfrecord_io.ExampleSerializer` used by `create`.
+
+and first checks that all of them give the same bytes for every record.
+
+The suite (`--suite`) generates a synthetic dataset of class folders, see
+`generate_class_folder_dataset`, and times on it
+
+    generate_tfrecords: `wrapper_create_tfrecords.generate_tfrecords`, scanning the class
+      folders and writing the `classification` profile.
+    create: `create_tfrecords.create` on the image examples, with their boxes, writing the
+      `full` profile.
+    yield_record: `iterate_tfrecords.yield_record`, the ids, labels and boxes without
+      decoding the images, when tensorflow is installed.
+    class_stats, verify_bboxes: `stat_tfrecords.compute_stats`, reading the shards.
+
+for every combination of the thread, shard, backend and executor settings. The results
+are written as JSON with `--output_json`, and `--compare` checks them against the results
+of an earlier run, e.g. of another commit, for throughput regressions.
+"""
+
+from __future__ import absolute_import
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from datetime import datetime
+import importlib
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from create_tfrecords import _convert_to_example, _example_feature_values, _serialize_example
+    from tfrecord_io import encode_example
+    from tfrecord_schema import FEATURES_BY_KEY, PROFILES
+    from metrics import MetricsReporter
+except ImportError:
+    from tfrecords_creater.create_tfrecords import (_convert_to_example, _example_feature_values,
+                                                    _serialize_example)
+    from tfrecords_creater.tfrecord_io import encode_example
+    from tfrecords_creater.tfrecord_schema import FEATURES_BY_KEY, PROFILES
+    from tfrecords_creater.metrics import MetricsReporter
+
+# Version of the layout of the JSON results
+RESULTS_FORMAT = 1
+
+# Defaults of the synthetic datasets: small text crops, or large photos
+DATASET_PRESETS = {
+    'ocr': {'image_size': (128, 32), 'image_format': 'png', 'num_classes': 50,
+            'images_per_class': 100},
+    'photo': {'image_size': (1024, 768), 'image_format': 'jpeg', 'num_classes': 10,
+              'images_per_class': 50},
+}
+
+IMAGE_FORMATS = ('png', 'jpeg')
+
+SUITE_BENCHMARKS = ('generate_tfrecords', 'create', 'yield_record', 'class_stats',
+                    'verify_bboxes')
+
+# Name of the description of a synthetic dataset, a dataset is reused if it matches
+_DATASET_CONFIG_FILENAME = 'benchmark-dataset.json'
+
+# The features read by the yield_record benchmark
+_YIELD_FEATURES = [('image/id', 'id'), ('image/class/label', 'label'),
+                   ('image/object/bbox/xmin', 'xmin'), ('image/object/bbox/ymin', 'ymin'),
+                   ('image/object/bbox/xmax', 'xmax'), ('image/object/bbox/ymax', 'ymax')]
+
+
+def synthetic_image_examples(num_records, image_bytes=2048, max_objects=4, seed=0):
+    """Image examples with random classes, boxes, parts and random bytes as images.
+    Args:
+      num_records: integer, number of image examples.
+      image_bytes: integer, size of every image.
+      max_objects: integer, the examples have up to this many objects.
+      seed: integer, seed of the random values.
+    Returns:
+      list : (image_example, image_buffer, height, width) tuples.
+    """
+    rng = random.Random(seed)
+    image_examples = []
+    for i in range(num_records):
+        num_objects = rng.randint(0, max_objects)
+        image_example = {
+            'filename': '/data/images/%07d.jpg' % (i,),
+            'id': str(i),
+            'class': {
+                'label': rng.randrange(1000),
+                'text': u'class %d é' % (i % 7,),
+                'conf': rng.random(),
+            },
+            'object': {
+                'count': num_objects,
+                'area': [rng.random() for _ in range(num_objects)],
+                'id': ['%d-%d' % (i, j) for j in range(num_objects)],
+                'is_crowd': [rng.randint(0, 1) for _ in range(num_objects)],
+                'bbox': {
+                    'xmin': [rng.random() / 2 for _ in range(num_objects)],
+                    'xmax': [0.5 + rng.random() / 2 for _ in range(num_objects)],
+                    'ymin': [rng.random() / 2 for _ in range(num_objects)],
+                    'ymax': [0.5 + rng.random() / 2 for _ in range(num_objects)],
+                    'label': [rng.randrange(-1, 200) for _ in range(num_objects)],
+                    'text': ['object %d' % (j,) for j in range(num_objects)],
+                    'conf': [rng.random() for _ in range(num_objects)],
+                    'score': [rng.random() for _ in range(num_objects)],
+                },
+                'parts': {
+                    'x': [rng.random() for _ in range(3 * num_objects)],
+                    'y': [rng.random() for _ in range(3 * num_objects)],
+                    'v': [rng.randint(0, 2) for _ in range(3 * num_objects)],
+                    'score': [rng.random() for _ in range(3 * num_objects)],
+                },
+            },
+        }
+        image_buffer = bytes(bytearray(rng.getrandbits(8) for _ in range(image_bytes)))
+        image_examples.append((image_example, image_buffer, rng.randint(16, 1024),
+                               rng.randint(16, 1024)))
+    return image_examples
+
+
+def _has_tensorflow():
+    try:
+        importlib.import_module('tensorflow')
+    except ImportError:
+        return False
+    return True
+
+
+def _serialize_protobuf(image_example, image_buffer, height, width, profile):
+    example = _convert_to_example(image_example, image_buffer, height, width, profile=profile)
+    return example.SerializeToString(deterministic=True)
+
+
+def _serialize_encode_example(image_example, image_buffer, height, width, profile):
+    feature_values = _example_feature_values(image_example, image_buffer, height, width,
+                                             profile=profile)
+    return encode_example((feature_key, FEATURES_BY_KEY[feature_key].dtype, values)
+                          for feature_key, values in feature_values.items())
+
+
+def _serialize_serializer(image_example, image_buffer, height, width, profile):
+    return _serialize_example(image_example, image_buffer, height, width, profile=profile)
+
+
+def _serialization_paths(with_tensorflow):
+    paths = []
+    if with_tensorflow:
+        paths.append(('protobuf', _serialize_protobuf))
+    paths.append(('encode_example', _serialize_encode_example))
+    paths.append(('serializer', _serialize_serializer))
+    return paths
+
+
+def check_serialization(image_examples, profile='full', with_tensorflow=True):
+    """Check that every serialization path gives the same bytes for every image example.
+    Raises:
+      ValueError: naming the first record and path that differ.
+    """
+    paths = _serialization_paths(with_tensorflow)
+    for i, (image_example, image_buffer, height, width) in enumerate(image_examples):
+        expected_name, expected_serialize = paths[0]
+        expected = expected_serialize(image_example, image_buffer, height, width, profile)
+        for name, serialize in paths[1:]:
+            if serialize(image_example, image_buffer, height, width, profile) != expected:
+                raise ValueError('Record %d of the %s profile: %s and %s give different bytes.' %
+                                 (i, profile, name, expected_name))
+
+
+def benchmark_serialization(image_examples, profile='full', with_tensorflow=True, repeat=3):
+    """Time the serialization paths.
+    Args:
+      image_examples: list, see `synthetic_image_examples`.
+      profile: string, one of tfrecord_schema.PROFILES.
+      with_tensorflow: bool, also time the protobuf path.
+      repeat: integer, the best of `repeat` runs is kept.
+    Returns:
+      dict : maps the name of every path to the records it serializes per second.
+    """
+    records_per_sec = {}
+    for name, serialize in _serialization_paths(with_tensorflow):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for image_example, image_buffer, height, width in image_examples:
+                serialize(image_example, image_buffer, height, width, profile)
+            best = min(best, time.perf_counter() - start)
+        records_per_sec[name] = len(image_examples) / best
+    return records_per_sec
+
+
+def _synthetic_image(rng, width, height, max_objects=4):
+    """A noisy gradient with up to `max_objects` filled rectangles, and their boxes."""
+    import numpy as np
+
+    colors = rng.randint(0, 256, size=(2, 3))
+    ramp = np.linspace(0., 1., width)[None, :, None]
+    image = colors[0] * (1. - ramp) + colors[1] * ramp
+    image = np.repeat(image, height, axis=0)
+
+    bbox = {'xmin': [], 'ymin': [], 'xmax': [], 'ymax': [], 'label': []}
+    for _ in range(rng.randint(0, max_objects + 1)):
+        x0, x1 = sorted(rng.randint(0, width + 1, size=2))
+        y0, y1 = sorted(rng.randint(0, height + 1, size=2))
+        image[y0:y1, x0:x1] = rng.randint(0, 256, size=3)
+        bbox['xmin'].append(float(x0) / width)
+        bbox['ymin'].append(float(y0) / height)
+        bbox['xmax'].append(float(x1) / width)
+        bbox['ymax'].append(float(y1) / height)
+        bbox['label'].append(int(rng.randint(0, 10)))
+
+    # sensor noise, so the images compress like photos rather than flat drawings
+    image += rng.normal(0., 6., size=image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8), bbox
+
+
+def _write_synthetic_image(work_unit):
+    from PIL import Image
+    import numpy as np
+
+    path, image_size, image_format, seed, class_index, image_index = work_unit
+    rng = np.random.RandomState([seed, class_index, image_index])
+    image, bbox = _synthetic_image(rng, *image_size)
+    if image_format == 'jpeg':
+        Image.fromarray(image).save(path, format='JPEG', quality=90)
+    else:
+        Image.fromarray(image).save(path, format='PNG')
+    return bbox
+
+
+def generate_class_folder_dataset(dataset_dir, num_classes, images_per_class, image_size,
+                                  image_format='png', seed=0, num_threads=8):
+    """Write a synthetic dataset of class folders, `<dataset_dir>/images/class_<i>/`, and
+    the manifest of its image examples, `<dataset_dir>/dataset.json`.
+
+    Every image is a noisy gradient with a few rectangles, which are its objects. The
+    images only depend on the seed, so every run of the benchmark reads the same bytes. A
+    dataset written earlier with the same arguments is reused.
+    Args:
+      dataset_dir: string, directory of the dataset.
+      num_classes: integer, number of class folders.
+      images_per_class: integer, number of images in every class folder.
+      image_size: (width, height) tuple of integers, size of the images in pixels.
+      image_format: string, one of IMAGE_FORMATS.
+      seed: integer, seed of the random images.
+      num_threads: integer, number of threads writing the images.
+    Returns:
+      dict : the description of the dataset, with the `image_examples` of the manifest.
+    """
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError('Unknown image format %r, expected one of %s' %
+                         (image_format, IMAGE_FORMATS))
+
+    config = {
+        'num_classes': num_classes,
+        'images_per_class': images_per_class,
+        'image_size': list(image_size),
+        'image_format': image_format,
+        'seed': seed,
+    }
+    config_path = os.path.join(dataset_dir, _DATASET_CONFIG_FILENAME)
+    manifest_path = os.path.join(dataset_dir, 'dataset.json')
+    if os.path.exists(config_path) and os.path.exists(manifest_path):
+        with open(config_path) as f:
+            dataset = json.load(f)
+        if dict((key, dataset.get(key)) for key in config) == config:
+            with open(manifest_path) as f:
+                dataset['image_examples'] = json.load(f)
+            return dataset
+
+    images_directory = os.path.join(dataset_dir, 'images')
+    if os.path.exists(images_directory):
+        shutil.rmtree(images_directory)
+
+    extension = 'jpg' if image_format == 'jpeg' else 'png'
+    work_units = []
+    image_examples = []
+    for class_index in range(num_classes):
+        class_name = 'class_%03d' % (class_index,)
+        os.makedirs(os.path.join(images_directory, class_name))
+        for image_index in range(images_per_class):
+            path = os.path.join(images_directory, class_name, '%06d.%s' % (image_index, extension))
+            work_units.append((path, tuple(image_size), image_format, seed, class_index,
+                               image_index))
+            image_examples.append({
+                'filename': path,
+                'id': '%s/%06d' % (class_name, image_index),
+                'class': {'label': class_index, 'text': class_name},
+            })
+
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        for image_example, bbox in zip(image_examples,
+                                       executor.map(_write_synthetic_image, work_units)):
+            image_example['object'] = {'count': len(bbox['label']), 'bbox': bbox}
+
+    dataset = dict(config)
+    dataset['num_images'] = len(image_examples)
+    dataset['image_bytes'] = sum(os.path.getsize(image_example['filename'])
+                                 for image_example in image_examples)
+    with open(manifest_path, 'w') as f:
+        json.dump(image_examples, f)
+    with open(config_path, 'w') as f:
+        json.dump(dataset, f)
+
+    dataset['image_examples'] = image_examples
+    return dataset
+
+
+@contextlib.contextmanager
+def _quiet(verbose=False):
+    """Silence the progress prints of the benchmarked functions."""
+    if verbose:
+        yield
+        return
+    sys.stdout.flush()
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+def _time_runs(run, repeat, setup=None, verbose=False):
+    """Time `repeat` calls of `run`, after `setup` every time.
+    Returns:
+      tuple : the seconds of every call, and the stages of the metrics of the fastest one.
+    """
+    seconds = []
+    stages = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        reporter = MetricsReporter(job='benchmark')
+        with _quiet(verbose):
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+        if not seconds or elapsed < min(seconds):
+            stages = dict((stage, {'share': stage_stats['share'], 'mean_ms': stage_stats['mean_ms']})
+                          for stage, stage_stats in reporter.report()['stages'].items())
+        seconds.append(elapsed)
+    return seconds, stages
+
+
+def _result(benchmark, settings, seconds, num_records, num_bytes, stages=None):
+    best = min(seconds)
+    return {
+        'benchmark': benchmark,
+        'settings': settings,
+        'seconds': best,
+        'runs': seconds,
+        'records': num_records,
+        'records_per_sec': num_records / best,
+        'mb_per_sec': num_bytes / 1e6 / best,
+        'stages': stages or {},
+    }
+
+
+def _reset_directory(directory):
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+
+def _shards(directory):
+    return sorted(os.path.join(directory, filename) for filename in os.listdir(directory)
+                  if filename.endswith('.tfrec'))
+
+
+def run_suite(dataset, work_directory, benchmarks=SUITE_BENCHMARKS, threads=(4,), shards=(8,),
+              backends=('python',), executors=('threads',), repeat=1, verbose=False):
+    """Time the benchmarks of the suite on a synthetic dataset.
+    Args:
+      dataset: dict, see `generate_class_folder_dataset`.
+      work_directory: string, directory of the tfrecords written by the benchmarks.
+      benchmarks: the benchmarks to run, from SUITE_BENCHMARKS.
+      threads: the numbers of threads (or processes) to time, of the writers and readers.
+      shards: the numbers of shards to time, of the writers.
+      backends: the backends of the writers to time, see `create`.
+      executors: the executors of the writers to time, see `create`.
+      repeat: integer, the best of `repeat` runs is kept.
+      verbose: bool, show the prints of the benchmarked functions.
+    Returns:
+      list : a result dict for every benchmark and settings.
+    """
+    try:
+        from create_tfrecords import create
+        from stat_tfrecords import compute_stats
+        from wrapper_create_tfrecords import generate_tfrecords
+    except ImportError:
+        from tfrecords_creater.create_tfrecords import create
+        from tfrecords_creater.stat_tfrecords import compute_stats
+        from tfrecords_creater.wrapper_create_tfrecords import generate_tfrecords
+
+    for benchmark in benchmarks:
+        if benchmark not in SUITE_BENCHMARKS:
+            raise ValueError('Unknown benchmark %r, expected one of %s' %
+                             (benchmark, SUITE_BENCHMARKS))
+
+    image_examples = dataset['image_examples']
+    num_images = len(image_examples)
+    image_bytes = dataset['image_bytes']
+    images_directory = os.path.dirname(os.path.dirname(image_examples[0]['filename']))
+    output_directory = os.path.join(work_directory, 'tfrecords')
+    results = []
+
+    writer_settings = [
+        {'threads': num_threads, 'shards': num_shards, 'backend': backend, 'executor': executor}
+        for num_threads, num_shards, backend, executor in itertools.product(
+            threads, shards, backends, executors)]
+
+    for benchmark in ('generate_tfrecords', 'create'):
+        if benchmark not in benchmarks:
+            continue
+        for settings in writer_settings:
+            if benchmark == 'generate_tfrecords':
+                def run():
+                    generate_tfrecords(
+                        images_directory, dataset_name='train', output_directory=output_directory,
+                        num_shards=settings['shards'], num_threads=settings['threads'],
+                        executor=settings['executor'], backend=settings['backend'], seed=0)
+            else:
+                def run():
+                    create([dict(image_example) for image_example in image_examples], 'train',
+                           output_directory, settings['shards'], settings['threads'],
+                           executor=settings['executor'], backend=settings['backend'], seed=0)
+
+            seconds, stages = _time_runs(run, repeat, lambda: _reset_directory(output_directory),
+                                         verbose)
+            results.append(_result(benchmark, settings, seconds, num_images, image_bytes, stages))
+            print('%-18s %-60s %8.1f images/s' % (benchmark, json.dumps(settings),
+                                                  results[-1]['records_per_sec']))
+            sys.stdout.flush()
+
+    readers = [benchmark for benchmark in ('yield_record', 'class_stats', 'verify_bboxes')
+               if benchmark in benchmarks]
+    if 'yield_record' in readers and not _has_tensorflow():
+        print('tensorflow is not installed, skipping the yield_record benchmark.')
+        readers.remove('yield_record')
+    if not readers:
+        return results
+
+    # the shards read by the reader benchmarks, with every feature and the boxes
+    _reset_directory(output_directory)
+    with _quiet(verbose):
+        create([dict(image_example) for image_example in image_examples], 'train',
+               output_directory, max(shards), max(threads), backend=backends[0], seed=0)
+    tfrecords = _shards(output_directory)
+    shard_bytes = sum(os.path.getsize(tfrecord) for tfrecord in tfrecords)
+
+    for benchmark in readers:
+        for num_threads in threads:
+            if benchmark == 'yield_record':
+                try:
+                    from iterate_tfrecords import yield_record
+                except ImportError:
+                    from tfrecords_creater.iterate_tfrecords import yield_record
+
+                def run():
+                    for _ in yield_record(tfrecords, _YIELD_FEATURES, decode_image=False,
+                                          num_readers=num_threads, num_parsers=num_threads):
+                        pass
+            else:
+                def run():
+                    compute_stats(tfrecords, [benchmark], num_workers=num_threads,
+                                  use_summary=False)
+
+            settings = {'threads': num_threads, 'shards': len(tfrecords)}
+            seconds, stages = _time_runs(run, repeat, verbose=verbose)
+            results.append(_result(benchmark, settings, seconds, num_images, shard_bytes, stages))
+            print('%-18s %-60s %8.1f records/s' % (benchmark, json.dumps(settings),
+                                                   results[-1]['records_per_sec']))
+            sys.stdout.flush()
+
+    return results
+
+
+def _git_commit():
+    """The commit of the checkout of this file, None outside of a git checkout."""
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode('utf8').strip()
+
+
+def _host():
+    host = {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'tensorflow': None,
+    }
+    if _has_tensorflow():
+        host['tensorflow'] = importlib.import_module('tensorflow').__version__
+    return host
+
+
+def make_results(results, dataset=None, arguments=None):
+    """The JSON document of the results of a run, with the commit, host and dataset."""
+    if dataset is not None:
+        dataset = dict((key, value) for key, value in dataset.items() if key != 'image_examples')
+    return {
+        'format': RESULTS_FORMAT,
+        'time': datetime.now().isoformat(),
+        'commit': _git_commit(),
+        'host': _host(),
+        'arguments': arguments,
+        'dataset': dataset,
+        'results': results,
+    }
+
+
+def _result_key(result):
+    return result['benchmark'], json.dumps(result['settings'], sort_keys=True)
+
+
+def compare_results(baseline, current, tolerance=0.1):
+    """Compare the throughputs of two runs, matching the results by benchmark and settings.
+    Args:
+      baseline: dict, the JSON results of the earlier run, see `make_results`.
+      current: dict, the JSON results of this run.
+      tolerance: float, a throughput lower by more than this fraction is a regression.
+    Returns:
+      list : (benchmark, settings, baseline records/s, current records/s) tuples of the
+        regressions.
+    """
+    if baseline.get('dataset') != current.get('dataset'):
+        print('The runs are on different datasets, the throughputs may not compare.')
+    if baseline.get('host') != current.get('host'):
+        print('The runs are on different hosts, the throughputs may not compare.')
+
+    baseline_results = dict((_result_key(result), result) for result in baseline['results'])
+    regressions = []
+    print('Compared to %s:' % (baseline.get('commit') or 'the baseline',))
+    for result in current['results']:
+        key = _result_key(result)
+        if key not in baseline_results:
+            continue
+        before = baseline_results[key]['records_per_sec']
+        after = result['records_per_sec']
+        ratio = after / before
+        regressed = ratio < 1. - tolerance
+        if regressed:
+            regressions.append((key[0], key[1], before, after))
+        print('  %-18s %-60s %10.1f -> %10.1f records/s  %5.2fx%s' %
+              (key[0], key[1], before, after, ratio, '  REGRESSION' if regressed else ''))
+    sys.stdout.flush()
+    return regressions
+
+
+def parse_args():
+
+    parser = argparse.ArgumentParser(description='Benchmark the tfrecord creation')
+
+    parser.add_argument('--num_records', dest='num_records',
+                        help='Number of synthetic records.',
+                        type=int, required=False, default=10000)
+
+    parser.add_argument('--image_bytes', dest='image_bytes',
+                        help='Size of the synthetic images.',
+                        type=int, required=False, default=2048)
+
+    parser.add_argument('--profile', dest='profiles',
+                        help='Profiles to benchmark, all of them by default.',
+                        choices=list(PROFILES), nargs='+',
+                        required=False, default=list(PROFILES))
+
+    parser.add_argument('--repeat', dest='repeat',
+                        help='Keep the best of this many runs, 3 by default, 1 for the suite.',
+                        type=int, required=False, default=None)
+
+    parser.add_argument('--suite', dest='suite',
+                        help='Run the suite on a synthetic dataset instead of the serialization benchmark.',
+                        action='store_true', required=False)
+
+    parser.add_argument('--benchmarks', dest='benchmarks',
+                        help='Benchmarks of the suite to run, all of them by default.',
+                        choices=SUITE_BENCHMARKS, nargs='+',
+                        required=False, default=list(SUITE_BENCHMARKS))
+
+    parser.add_argument('--preset', dest='preset',
+                        help='Defaults of the synthetic dataset: small text crops or large photos.',
+                        choices=sorted(DATASET_PRESETS), required=False, default='ocr')
+
+    parser.add_argument('--num_classes', dest='num_classes',
+                        help='Number of class folders of the synthetic dataset.',
+                        type=int, required=False, default=None)
+
+    parser.add_argument('--images_per_class', dest='images_per_class',
+                        help='Number of images in every class folder.',
+                        type=int, required=False, default=None)
+
+    parser.add_argument('--image_size', dest='image_size',
+                        help='Width and height of the synthetic images.',
+                        type=int, nargs=2, required=False, default=None)
+
+    parser.add_argument('--image_format', dest='image_format',
+                        help='Format of the synthetic images.',
+                        choices=IMAGE_FORMATS, required=False, default=None)
+
+    parser.add_argument('--seed', dest='seed',
+                        help='Seed of the synthetic images.',
+                        type=int, required=False, default=0)
+
+    parser.add_argument('--dataset_dir', dest='dataset_dir',
+                        help='Directory of the synthetic dataset, kept and reused by later runs. '
+                             'A temporary directory by default.',
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--threads', dest='threads',
+                        help='Numbers of threads (or processes) of the writers and readers to time.',
+                        type=int, nargs='+', required=False, default=[4])
+
+    parser.add_argument('--shards', dest='shards',
+                        help='Numbers of shards of the writers to time.',
+                        type=int, nargs='+', required=False, default=[8])
+
+    parser.add_argument('--backends', dest='backends',
+                        help='Backends of the writers to time, see create_tfrecords.BACKENDS.',
+                        type=str, nargs='+', required=False, default=['python'])
+
+    parser.add_argument('--executors', dest='executors',
+                        help='Executors of the writers to time, see create_tfrecords.EXECUTORS.',
+                        type=str, nargs='+', required=False, default=['threads'])
+
+    parser.add_argument('--output_json', dest='output_json',
+                        help='Write the results to this JSON file.',
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--compare', dest='baseline_json',
+                        help='JSON results of an earlier run, e.g. of another commit, to compare against. '
+                             'Exits with status 1 on a regression.',
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--tolerance', dest='tolerance',
+                        help='A throughput lower than the baseline by more than this fraction is a regression.',
+                        type=float, required=False, default=0.1)
+
+    parser.add_argument('--verbose', dest='verbose',
+                        help='Show the prints of the benchmarked functions.',
+                        action='store_true', required=False)
+
+    parsed_args = parser.parse_args()
+
+    return parsed_args
+
+
+def _serialization_results(args):
+    with_tensorflow = _has_tensorflow()
+    if not with_tensorflow:
+        print('tensorflow is not installed, skipping the protobuf path.')
+
+    repeat = args.repeat if args.repeat is not None else 3
+    image_examples = synthetic_image_examples(args.num_records, args.image_bytes)
+    results = []
+    for profile in args.profiles:
+        check_serialization(image_examples, profile, with_tensorflow)
+        records_per_sec = benchmark_serialization(image_examples, profile, with_tensorflow,
+                                                  repeat)
+
+        baseline = next(iter(records_per_sec.values()))
+        print('Profile %s, %d records, identical bytes:' % (profile, len(image_examples)))
+        for name, rate in records_per_sec.items():
+            print('  %-16s %10.0f records/s  %5.2fx' % (name, rate, rate / baseline))
+            results.append({
+                'benchmark': 'serialize',
+                'settings': {'path': name, 'profile': profile},
+                'records': len(image_examples),
+                'records_per_sec': rate,
+            })
+        sys.stdout.flush()
+    return results, None
+
+
+def _suite_results(args):
+    with_tensorflow = _has_tensorflow()
+    backends = list(args.backends)
+    if 'tensorflow' in backends and not with_tensorflow:
+        print('tensorflow is not installed, skipping the tensorflow backend.')
+        backends.remove('tensorflow')
+    if not backends:
+        raise ValueError('No backend left to benchmark.')
+
+    preset = DATASET_PRESETS[args.preset]
+    dataset_dir = args.dataset_dir
+    work_directory = tempfile.mkdtemp(prefix='benchmark_tfrecords-')
+    try:
+        if dataset_dir is None:
+            dataset_dir = os.path.join(work_directory, 'dataset')
+        start = time.perf_counter()
+        dataset = generate_class_folder_dataset(
+            dataset_dir,
+            args.num_classes or preset['num_classes'],
+            args.images_per_class or preset['images_per_class'],
+            args.image_size or preset['image_size'],
+            args.image_format or preset['image_format'],
+            args.seed)
+        dataset['preset'] = args.preset
+        print('Dataset of %d %s images, %.1f MB, ready in %.1f seconds.' %
+              (dataset['num_images'], dataset['image_format'], dataset['image_bytes'] / 1e6,
+               time.perf_counter() - start))
+        sys.stdout.flush()
+
+        results = run_suite(dataset, work_directory, args.benchmarks, args.threads, args.shards,
+                            backends, args.executors,
+                            args.repeat if args.repeat is not None else 1, args.verbose)
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    return results, dataset
+
+
+def main():
+    args = parse_args()
+
+    if args.suite:
+        results, dataset = _suite_results(args)
+    else:
+        results, dataset = _serialization_results(args)
+    results = make_results(results, dataset, vars(args))
+
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to %s' % (args.output_json,))
+
+    if args.baseline_json is not None:
+        with open(args.baseline_json) as f:
+            baseline = json.load(f)
+        if compare_results(baseline, results, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,45 +22,63 @@ A lot of this code comes from the tensorflow inception example, so here is their
 from __future__ import absolute_import
 
 import argparse
+import collections
 from datetime import datetime
 import hashlib
+import io
 import json
+import multiprocessing
 import os
 import pathlib
 
-from queue import Queue
+from queue import Empty, Full, Queue
 import random
+import re
+import shutil
 import sys
+import tempfile
 import threading
+import time
 
 import numpy as np
-import tensorflow as tf
-tf.compat.v1.disable_eager_execution()
 
-def _int64_feature(value):
-    """Wrapper for inserting int64 features into Example proto."""
-    if not isinstance(value, list):
-        value = [value]
-    return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
+try:
+    from dedup_index import HashIndex, HashIndexManager
+    from image_headers import read_image_header
+    from metrics import REGISTRY, MetricsReporter
+    from remote_storage import ShardUploader, is_remote
+    from tfrecord_io import ExampleSerializer, TFRecordWriter, index_files
+    from tfrecord_schema import FEATURES_BY_KEY, PROFILES, profile_keys
+except ImportError:
+    from tfrecords_creater.dedup_index import HashIndex, HashIndexManager
+    from tfrecords_creater.image_headers import read_image_header
+    from tfrecords_creater.metrics import REGISTRY, MetricsReporter
+    from tfrecords_creater.remote_storage import ShardUploader, is_remote
+    from tfrecords_creater.tfrecord_io import ExampleSerializer, TFRecordWriter, index_files
+    from tfrecords_creater.tfrecord_schema import FEATURES_BY_KEY, PROFILES, profile_keys
 
 
-def _float_feature(value):
-    """Wrapper for inserting float features into Example proto."""
-    if not isinstance(value, list):
-        value = [value]
-    return tf.train.Feature(float_list=tf.train.FloatList(value=value))
+class _LazyTensorflow(object):
+    """Imports tensorflow when it is first used, the `python` backend never imports it."""
 
+    def __getattr__(self, name):
+        import tensorflow
+        tensorflow.compat.v1.disable_eager_execution()
+        globals()['tf'] = tensorflow
+        return getattr(tensorflow, name)
 
-def _bytes_list_feature(value):
-    """Wrapper for inserting bytes list features into Example proto."""
-    value = [x.encode('utf8') for x in value]
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=value))
 
-def _bytes_feature(value):
-    """Wrapper for inserting bytes features into Example proto."""
-    if not isinstance(value, bytes):
-        value = value.encode('utf8')
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+tf = _LazyTensorflow()
+
+
+def _tf_feature(dtype, values):
+    """Wrapper for inserting a list of `int64`, `float` or `bytes` values into Example proto."""
+    if dtype == 'int64':
+        return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+    if dtype == 'float':
+        return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
+
 
 def _validate_text(text):
     """If text is not str or unicode, then try to convert it to str."""
@@ -70,16 +88,25 @@ def _validate_text(text):
     else:
         return str(text)
 
-def _convert_to_example(image_example, image_buffer, height, width, colorspace='RGB',
-                        channels=3, image_format='JPEG'):
-    """Build an Example proto for an example.
+
+def _to_bytes(value):
+    if not isinstance(value, bytes):
+        value = _validate_text(value).encode('utf8')
+    return value
+
+
+def _example_feature_values(image_example, image_buffer, height, width, colorspace='RGB',
+                            channels=3, image_format='JPEG', key=None, profile='full'):
+    """Values of the features of the Example of an image example, see tfrecord_schema.
     Args:
       image_example: dict, an image example
-      image_buffer: string, JPEG encoding of RGB image
+      image_buffer: bytes, encoding of the image
       height: integer, image height in pixels
       width: integer, image width in pixels
+      key: string, sha256 hex digest of image_buffer, computed if it is not given.
+      profile: string, one of tfrecord_schema.PROFILES, the features to write.
     Returns:
-      Example proto
+      dict : maps the key of every feature of the profile to its list of values.
     """
 
     # Required
@@ -89,7 +116,7 @@ def _convert_to_example(image_example, image_buffer, height, width, colorspace='
     # Class label for the whole image
     image_class = image_example.get('class', {})
     class_label = image_class.get('label', 0)
-    class_text = _validate_text(image_class.get('text', ''))
+    class_text = image_class.get('text', '')
     class_conf = image_class.get('conf', 1.)
 
     # Objects
@@ -98,96 +125,180 @@ def _convert_to_example(image_example, image_buffer, height, width, colorspace='
 
     # Bounding Boxes
     image_bboxes = image_objects.get('bbox', {})
-    xmin = image_bboxes.get('xmin', [])
-    xmax = image_bboxes.get('xmax', [])
-    ymin = image_bboxes.get('ymin', [])
-    ymax = image_bboxes.get('ymax', [])
-    bbox_scores = image_bboxes.get('score', [])
-    bbox_labels = image_bboxes.get('label', [])
-    bbox_text = map(_validate_text, image_bboxes.get('text', []))
-    bbox_label_confs = image_bboxes.get('conf', [])
+    bbox_labels = list(image_bboxes.get('label', []))
+    bbox_text = [_to_bytes(text) for text in image_bboxes.get('text', [])]
 
     # Parts
     image_parts = image_objects.get('parts', {})
-    parts_x = image_parts.get('x', [])
-    parts_y = image_parts.get('y', [])
-    parts_v = image_parts.get('v', [])
-    parts_s = image_parts.get('score', [])
-
-    # Areas
-    object_areas = image_objects.get('area', [])
-
-    # Ids
-    object_ids = map(str, image_objects.get('id', []))
 
     # Any extra data (e.g. stringified json)
     extra_info = str(image_class.get('extra', ''))
 
     # Additional fields for the format needed by the Object Detection repository
-    key = hashlib.sha256(image_buffer).hexdigest()
-    is_crowd = image_objects.get('is_crowd', [])
-
-    example = tf.train.Example(features=tf.train.Features(feature={
-        'image/height': _int64_feature(height),
-        'image/width': _int64_feature(width),
-        'image/colorspace': _bytes_feature(colorspace),
-        'image/channels': _int64_feature(channels),
-        'image/format': _bytes_feature(image_format),
-        'image/filename': _bytes_feature(filename),
-        'image/id': _bytes_feature(image_id),
-        'image/encoded': _bytes_feature(image_buffer),
-        'image/extra': _bytes_feature(extra_info),
-        'image/class/label': _int64_feature(class_label),
-        'image/class/text': _bytes_list_feature(class_text),
-        'image/class/conf': _float_feature(class_conf),
-        'image/object/bbox/xmin': _float_feature(xmin),
-        'image/object/bbox/xmax': _float_feature(xmax),
-        'image/object/bbox/ymin': _float_feature(ymin),
-        'image/object/bbox/ymax': _float_feature(ymax),
-        'image/object/bbox/label': _int64_feature(bbox_labels),
-        'image/object/bbox/text': _bytes_list_feature(bbox_text),
-        'image/object/bbox/conf': _float_feature(bbox_label_confs),
-        'image/object/bbox/score' : _float_feature(bbox_scores),
-        'image/object/parts/x' : _float_feature(parts_x),
-        'image/object/parts/y' : _float_feature(parts_y),
-        'image/object/parts/v' : _int64_feature(parts_v),
-        'image/object/parts/score' : _float_feature(parts_s),
-        'image/object/count' : _int64_feature(object_count),
-        'image/object/area' : _float_feature(object_areas),
-        'image/object/id' : _bytes_list_feature(object_ids),
-
-        # Additional fields for the format needed by the Object Detection repository
-        'image/source_id': _bytes_list_feature(image_id),
-        'image/key/sha256': _bytes_feature(key),
-        'image/object/class/label': _int64_feature(bbox_labels),
-        'image/object/class/text': _bytes_list_feature(bbox_text),
-        'image/object/is_crowd': _int64_feature(is_crowd)
-
-    }))
-    return example
+    if key is None:
+        key = hashlib.sha256(image_buffer).hexdigest()
+
+    feature_values = {
+        'image/height': [height],
+        'image/width': [width],
+        'image/colorspace': [_to_bytes(colorspace)],
+        'image/channels': [channels],
+        'image/format': [_to_bytes(image_format)],
+        'image/filename': [_to_bytes(filename)],
+        'image/id': [_to_bytes(image_id)],
+        'image/encoded': [_to_bytes(image_buffer)],
+        'image/extra': [_to_bytes(extra_info)],
+        'image/class/label': [class_label],
+        'image/class/text': [_to_bytes(class_text)],
+        'image/class/conf': [class_conf],
+        'image/object/bbox/xmin': list(image_bboxes.get('xmin', [])),
+        'image/object/bbox/xmax': list(image_bboxes.get('xmax', [])),
+        'image/object/bbox/ymin': list(image_bboxes.get('ymin', [])),
+        'image/object/bbox/ymax': list(image_bboxes.get('ymax', [])),
+        'image/object/bbox/label': bbox_labels,
+        'image/object/bbox/text': bbox_text,
+        'image/object/bbox/conf': list(image_bboxes.get('conf', [])),
+        'image/object/bbox/score': list(image_bboxes.get('score', [])),
+        'image/object/parts/x': list(image_parts.get('x', [])),
+        'image/object/parts/y': list(image_parts.get('y', [])),
+        'image/object/parts/v': list(image_parts.get('v', [])),
+        'image/object/parts/score': list(image_parts.get('score', [])),
+        'image/object/count': [object_count],
+        'image/object/area': list(image_objects.get('area', [])),
+        'image/object/id': [_to_bytes(object_id) for object_id in image_objects.get('id', [])],
+        'image/source_id': [_to_bytes(image_id)],
+        'image/key/sha256': [_to_bytes(key)],
+        'image/object/class/label': bbox_labels,
+        'image/object/class/text': bbox_text,
+        'image/object/is_crowd': list(image_objects.get('is_crowd', [])),
+    }
+    return dict((feature_key, feature_values[feature_key]) for feature_key in profile_keys(profile))
+
+
+def _convert_to_example(image_example, image_buffer, height, width, colorspace='RGB',
+                        channels=3, image_format='JPEG', key=None, profile='full'):
+    """Build an Example proto for an example.
+    Args:
+      image_example: dict, an image example
+      image_buffer: string, JPEG encoding of RGB image
+      height: integer, image height in pixels
+      width: integer, image width in pixels
+      key: string, sha256 hex digest of image_buffer, computed if it is not given.
+      profile: string, one of tfrecord_schema.PROFILES, the features to write.
+    Returns:
+      Example proto
+    """
+    feature_values = _example_feature_values(image_example, image_buffer, height, width,
+                                             colorspace, channels, image_format, key, profile)
+    feature = {}
+    for feature_key, values in feature_values.items():
+        feature[feature_key] = _tf_feature(FEATURES_BY_KEY[feature_key].dtype, values)
+
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+# The precompiled serializer of every profile
+_EXAMPLE_SERIALIZERS = dict(
+    (profile, ExampleSerializer((feature_key, FEATURES_BY_KEY[feature_key].dtype)
+                                for feature_key in profile_keys(profile)))
+    for profile in PROFILES)
+
+
+def _serialize_example(image_example, image_buffer, height, width, colorspace='RGB',
+                       channels=3, image_format='JPEG', key=None, profile='full'):
+    """Serialize the Example of an image example with the ExampleSerializer of its profile.
+
+    This gives the same bytes as `_convert_to_example(...).SerializeToString(deterministic=True)`
+    without building a protobuf object per feature, with either of the BACKENDS.
+    """
+    feature_values = _example_feature_values(image_example, image_buffer, height, width,
+                                             colorspace, channels, image_format, key, profile)
+    return _EXAMPLE_SERIALIZERS[profile].serialize(feature_values)
+
+
+# How the workers run, see `create`.
+EXECUTORS = ('threads', 'processes', 'pipeline')
+
+# Backends that write the records and code the images: `tensorflow`, or `python` that
+# does not import tensorflow at all.
+BACKENDS = ('tensorflow', 'python')
+
+# Transcode policies for images that are not already JPEG encoded.
+TRANSCODE_POLICIES = ('passthrough', 'jpeg', 'png', 'webp')
+
+# What to do with an image whose content hash is already in the hash index, see `create`.
+DEDUP_POLICIES = (None, 'drop', 'count')
+
+# Default file name of the hash index, in the output directory.
+DEDUP_INDEX_FILENAME = 'sha256-index.npy'
+
+# Bin size, in pixels, of the image height and width histograms of the build summary
+DIMENSION_BIN_SIZE = 32
+
+# How the workers store every image example, see `create` for the fields. `hash_index`
+# is a HashIndex, or a proxy of one when the workers are processes.
+_ExampleOptions = collections.namedtuple(
+    '_ExampleOptions',
+    ['store_images', 'verify_decode_rate', 'transcode', 'dedup', 'hash_index', 'backend',
+     'profile'])
 
 
 class ImageCoder(object):
     """Helper class that provides TensorFlow image coding utilities."""
 
-    def __init__(self):
+    def __init__(self, quality=100, png_compression=-1):
+        """
+        Args:
+          quality: integer in [0, 100], quality of the JPEG and WebP encodings.
+          png_compression: integer in [-1, 9], zlib compression level of the PNG encoding,
+            -1 picks the zlib default.
+        """
+        self._quality = quality
+
         # Create a single Session to run all image coding calls.
         self._sess = tf.compat.v1.Session()
 
-        # Initializes function that converts PNG to JPEG data.
+        # Initializes function that converts PNG to JPEG data. The conversions also take
+        # the GIF and BMP images, whose headers are not read, see `_process_image`.
         self._png_data = tf.compat.v1.placeholder(dtype=tf.string)
-        image = tf.image.decode_png(self._png_data, channels=3)
-        self._png_to_jpeg = tf.image.encode_jpeg(image, format='rgb', quality=100)
+        image = tf.io.decode_image(self._png_data, channels=3, expand_animations=False)
+        self._png_to_jpeg = tf.image.encode_jpeg(image, format='rgb', quality=quality)
+
+        # Initializes function that re-compresses PNG data, keeping its channels.
+        image = tf.io.decode_image(self._png_data, channels=0, expand_animations=False)
+        self._png_to_png = tf.image.encode_png(image, compression=png_compression)
+
+        # Initializes function that decodes image data of any format, keeping its channels.
+        self._decode_image = image
 
         # Initializes function that decodes RGB JPEG data.
         self._decode_jpeg_data = tf.compat.v1.placeholder(dtype=tf.string)
         self._decode_jpeg = tf.image.decode_jpeg(self._decode_jpeg_data, channels=3)
 
+        # Initializes function that decodes PNG data as RGB.
+        self._decode_png = tf.image.decode_png(self._png_data, channels=3)
+
     def png_to_jpeg(self, image_data):
         # Convert the image data from png to jpg
         return self._sess.run(self._png_to_jpeg,
                               feed_dict={self._png_data: image_data})
 
+    def png_to_png(self, image_data):
+        # Re-compress the png image data
+        return self._sess.run(self._png_to_png,
+                              feed_dict={self._png_data: image_data})
+
+    def png_to_webp(self, image_data):
+        # Convert the image data from png to webp, tensorflow has no webp encoder
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(image_data))
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        output = io.BytesIO()
+        image.save(output, format='WEBP', quality=self._quality)
+        return output.getvalue()
+
     def decode_jpeg(self, image_data):
         # Decode the image data as a jpeg image
         image = self._sess.run(self._decode_jpeg,
@@ -196,160 +307,1546 @@ class ImageCoder(object):
         assert image.shape[2] == 3, "JPEG needs to have 3 channels (RGB)"
         return image
 
-def _is_png(filename):
-    """Determine if a file contains a PNG format image.
-    Args:
-      filename: string, path of the image file.
-    Returns:
-      boolean indicating if the image is a PNG.
-    """
-    _, file_extension = os.path.splitext(filename)
-    return file_extension.lower() == '.png'
+    def decode_png(self, image_data):
+        # Decode the image data as a png image
+        return self._sess.run(self._decode_png,
+                              feed_dict={self._png_data: image_data})
+
+    def decode_webp(self, image_data):
+        # Decode the image data as a webp image
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(image_data))
+        return np.asarray(image.convert('RGB'))
+
+    def decode_image(self, image_data):
+        # Decode the image data of any format tensorflow reads, keeping its channels
+        return self._sess.run(self._decode_image,
+                              feed_dict={self._png_data: image_data})
+
+    def decode(self, image_data, image_format):
+        # Decode the image data of the given format, `JPEG`, `PNG` or `WEBP`
+        return {
+            'JPEG': self.decode_jpeg,
+            'PNG': self.decode_png,
+            'WEBP': self.decode_webp,
+        }[image_format](image_data)
+
+    def transcode(self, image_data, transcode):
+        # Convert the png image data following a transcode policy, see TRANSCODE_POLICIES
+        return {
+            'jpeg': self.png_to_jpeg,
+            'png': self.png_to_png,
+            'webp': self.png_to_webp,
+        }[transcode](image_data)
+
+
+class PillowImageCoder(ImageCoder):
+    """ImageCoder that codes the images with Pillow, used by the `python` backend so that
+    tensorflow is not needed. Its JPEG encodings are not the same bytes as tensorflow's."""
+
+    def __init__(self, quality=100, png_compression=-1):
+        self._quality = quality
+        # zlib level 6 is the default of both Pillow and tensorflow
+        self._png_compression = 6 if png_compression < 0 else png_compression
+
+    def _open(self, image_data, mode='RGB'):
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(image_data))
+        if mode is not None and image.mode != mode:
+            image = image.convert(mode)
+        return image
 
-def _process_image(filename, coder):
+    def png_to_jpeg(self, image_data):
+        # Convert the image data from png to jpg
+        output = io.BytesIO()
+        self._open(image_data).save(output, format='JPEG', quality=self._quality)
+        return output.getvalue()
+
+    def png_to_png(self, image_data):
+        # Re-compress the png image data
+        output = io.BytesIO()
+        self._open(image_data, mode=None).save(output, format='PNG',
+                                               compress_level=self._png_compression)
+        return output.getvalue()
+
+    def decode_jpeg(self, image_data):
+        # Decode the image data as a jpeg image
+        image = np.asarray(self._open(image_data))
+        assert len(image.shape) == 3, "JPEG needs to have height x width x channels"
+        assert image.shape[2] == 3, "JPEG needs to have 3 channels (RGB)"
+        return image
+
+    def decode_png(self, image_data):
+        # Decode the image data as a png image
+        return np.asarray(self._open(image_data))
+
+    def decode_image(self, image_data):
+        # Decode the image data of any format Pillow reads, keeping its gray, RGB and alpha
+        # channels as png_to_webp does
+        image = self._open(image_data, mode=None)
+        if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        image = np.asarray(image)
+        if image.ndim == 2:
+            image = image[:, :, np.newaxis]
+        return image
+
+
+def _make_coder(backend, quality=100, png_compression=-1):
+    """The image coder of a backend, see BACKENDS."""
+    if backend == 'python':
+        return PillowImageCoder(quality, png_compression)
+    return ImageCoder(quality, png_compression)
+
+
+# Colorspace of a stored image by its number of channels, see `_colorspace`
+_COLORSPACES = {1: 'GRAY', 2: 'GRAY_ALPHA', 3: 'RGB', 4: 'RGBA'}
+
+
+def _colorspace(channels, image_format):
+    """Colorspace of a stored image, e.g. `GRAY` for a grayscale PNG kept as it is."""
+    if image_format == 'JPEG' and channels == 4:
+        return 'CMYK'
+    return _COLORSPACES.get(channels, 'RGB')
+
+
+def _read_file(filename):
+    """Read a file, through tensorflow's gfile only for remote (`scheme://`) paths."""
+    with REGISTRY.timer('read'):
+        if '://' in filename:
+            with tf.io.gfile.GFile(filename, 'rb') as f:
+                return f.read()
+        with open(filename, 'rb') as f:
+            return f.read()
+
+
+def _process_image(filename, coder, verify_decode=False, transcode='jpeg', image_data=None):
     """Process a single image file.
     Args:
       filename: string, path to an image file e.g., '/path/to/example.JPG'.
       coder: instance of ImageCoder to provide TensorFlow image coding utils.
+      verify_decode: bool, fully decode the stored image to check its integrity. Otherwise
+        the dimensions are only read from the image header.
+      transcode: string, one of TRANSCODE_POLICIES. `passthrough` stores the file as it is,
+        the others convert PNG images to JPEG, re-compressed PNG or WebP. JPEG images are
+        always stored as they are.
+      image_data: bytes, the content of the file if it was already read, e.g. by the
+        read stage of the pipeline executor.
     Returns:
-      image_buffer: string, JPEG encoding of RGB image.
+      image_buffer: string, encoding of the image.
       height: integer, image height in pixels.
       width: integer, image width in pixels.
+      channels: integer, number of channels of the stored image, from its header unless
+        it was converted to RGB JPEG or to WebP.
+      image_format: string, `JPEG`, `PNG` or `WEBP`.
+      image_bytes_in: integer, size of the image file in bytes.
     """
     # Read the image file.
-    image_data = tf.io.gfile.GFile(filename, 'rb').read()  # tf.gfile.FastGFile
+    if image_data is None:
+        image_data = _read_file(filename)
+    image_bytes_in = len(image_data)
+
+    with REGISTRY.timer('decode'):
+        try:
+            height, width, channels, image_format = read_image_header(image_data)
+        except ValueError as header_error:
+            if transcode == 'passthrough':
+                raise
+            # Not a JPEG or PNG, e.g. a GIF or BMP, or a damaged header: decode it to get
+            # its dimensions, it is converted below.
+            try:
+                image = coder.decode_image(image_data)
+            except Exception as e:
+                raise ValueError('%s can not be read: %s, and it can not be decoded: %r' %
+                                 (filename, header_error, e))
+            height, width, channels = image.shape[0], image.shape[1], image.shape[2]
+            image_format = None
+
+        # Clean the dirty data.
+        if image_format != 'JPEG' and transcode != 'passthrough':
+            image_data = coder.transcode(image_data, transcode)
+            image_format = transcode.upper()
+            if transcode == 'jpeg':
+                channels = 3
+            elif transcode == 'png':
+                # the channels are kept, except those of an image without a PNG header
+                _, _, channels, _ = read_image_header(image_data)
+            else:
+                # png_to_webp keeps the alpha channel and converts the rest to RGB
+                channels = 4 if channels in (2, 4) else 3
+
+        if verify_decode:
+            image = coder.decode(image_data, image_format)
+
+            # Check that image decoded to RGB with the dimensions of its header
+            assert len(image.shape) == 3
+            assert image.shape[0] == height and image.shape[1] == width
+            assert image.shape[2] == 3
+
+    return image_data, height, width, channels, image_format, image_bytes_in
+
+
+def _should_verify_decode(verify_decode_rate, rng):
+    """Decide whether the next image is fully decoded, for a sampling rate in [0, 1]."""
+    if verify_decode_rate >= 1:
+        return True
+    if verify_decode_rate <= 0:
+        return False
+    return rng.random() < verify_decode_rate
+
+
+def _process_image_example(image_example, coder, options, verify_decode=False,
+                           image_data=None):
+    """Build the Example proto of a single image example.
+    Args:
+      image_example: dict, an image example
+      coder: instance of ImageCoder to provide TensorFlow image coding utils.
+      options: _ExampleOptions, how the image example is stored.
+      verify_decode: bool, fully decode the image to check its integrity.
+      image_data: bytes, the content of the image file if it was already read.
+    Returns:
+      record: bytes, the serialized Example, None if the image is a duplicate that is dropped.
+      image_bytes_in: integer, size of the image that was read in bytes.
+      image_bytes_out: integer, size of the stored image in bytes.
+      is_duplicate: bool, the image was already in the hash index.
+      image_size: tuple, the (height, width) of the image.
+    """
+    filename = str(image_example['filename'])
+
+    if options.store_images:
+        if 'encoded' in image_example:
+            image_buffer = image_example['encoded']
+            height = image_example['height']
+            width = image_example['width']
+            colorspace = image_example['colorspace']
+            image_format = image_example['format']
+            num_channels = image_example['channels']
+            image_bytes_in = len(image_buffer)
+
+        else:
+            image_buffer, height, width, num_channels, image_format, image_bytes_in = \
+                _process_image(filename, coder, verify_decode, options.transcode, image_data)
+            colorspace = _colorspace(num_channels, image_format)
+    else:
+        image_buffer = b''
+        image_bytes_in = 0
+        height = int(image_example['height'])
+        width = int(image_example['width'])
+        colorspace = 'RGB'
+        num_channels = 3
+        image_format = 'JPEG'
+
+    with REGISTRY.timer('hash'):
+        digest = hashlib.sha256(image_buffer)
+        is_duplicate = False
+        if options.hash_index is not None and image_buffer:
+            is_duplicate = not options.hash_index.add(digest.digest())
+    if is_duplicate:
+        REGISTRY.inc('duplicates')
+        if options.dedup == 'drop':
+            return None, image_bytes_in, 0, is_duplicate, (height, width)
 
-    # Clean the dirty data.
-    if _is_png(filename):
-        image_data = coder.png_to_jpeg(image_data)
+    with REGISTRY.timer('serialize'):
+        record = _serialize_example(image_example, image_buffer, height, width, colorspace,
+                                    num_channels, image_format, digest.hexdigest(),
+                                    options.profile)
 
-    # Decode the RGB JPEG.
-    image = coder.decode_jpeg(image_data)
+    return record, image_bytes_in, len(image_buffer), is_duplicate, (height, width)
 
-    # Check that image converted to RGB
-    assert len(image.shape) == 3
-    height = image.shape[0]
-    width = image.shape[1]
-    assert image.shape[2] == 3
 
-    return image_data, height, width
+def _shard_output_file(output_directory, name, shard, num_shards):
+    """Path of a shard that is still being written, e.g. 'train-02-of-10-cnt-.tfrec'."""
+    # output_filename = '%s-%.5d-of-%.5d' % (name, shard, num_shards)
 
+    # write count in tfrecord filename -- tfrecords don't store metadata info - 
+    # so its better to store count in filname - 
+    # it will avoid iterating whole dataset to counting records
+    output_filename = '%s-%.2d-of-%.2d-cnt-.tfrec' % (name, shard, num_shards)
 
-def _process_image_files_batch(coder, thread_index, ranges, name, output_directory,
-                               dataset, num_shards, store_images, error_queue):
-    """Processes and saves list of images as TFRecord in 1 thread.
+    return os.path.join(output_directory, output_filename)
+
+
+def _part_output_file(output_directory, name, worker_index, part):
+    """Path of a size targeted shard before the number of shards is known."""
+    output_filename = '%s-worker-%.2d-part-%.4d.tfrec.tmp' % (name, worker_index, part)
+
+    return os.path.join(output_directory, output_filename)
+
+
+def _finalize_shard(output_file, shard_counter, final_output_file=None):
+    """Rename a written shard to carry its record count, e.g. 'train-02-of-10-cnt-512.tfrec'.
+    Args:
+      output_file: string, path of the written shard.
+      shard_counter: integer, number of records in the shard.
+      final_output_file: string, path of the shard without its count, if it is not
+        `output_file`, see `_shard_output_file`.
+    Returns:
+      pathlib.Path : the new path of the shard.
+    """
+    if final_output_file is None:
+        final_output_file = output_file
+
+    # add total image count in tfrecord filename
+    # it will avoid iterating dataset to get count
+    path = pathlib.Path(final_output_file)
+    old_name = path.stem
+    old_extension = path.suffix
+    directory = path.parent
+    new_name = old_name + str(shard_counter)  + old_extension
+    new_output_file = pathlib.Path(directory, new_name)
+    pathlib.Path(output_file).rename(new_output_file) # rename file on disk
+
+    # the index sidecars follow their shard
+    for sidecar_file, new_sidecar_file in zip(index_files(str(output_file)),
+                                              index_files(str(new_output_file))):
+        if os.path.exists(sidecar_file):
+            os.replace(sidecar_file, new_sidecar_file)
+
+    return new_output_file
+
+
+class _ShardWriter(object):
+    """Writes the records of one shard and keeps the statistics of the shard.
+
+    Next to the shard it writes its index sidecars, see `tfrecord_io.index_files`: the
+    `offset size` of every record in `.idx`, and the `id<TAB>class label` of every record,
+    on the same line, in `.ids`.
+
+    The histograms of the shard are counts keyed by strings, so they are the same after a
+    round trip through JSON: the class labels, the image heights and widths in bins of
+    DIMENSION_BIN_SIZE pixels, and the record sizes in bins of powers of 2 bytes.
+    """
+
+    def __init__(self, output_file, shard=None, backend='tensorflow'):
+        """
+        Args:
+          output_file: string, path of the shard.
+          shard: integer, index of the shard, None if it is not known yet.
+          backend: string, one of BACKENDS.
+        """
+        self.output_file = output_file
+        self.shard = shard
+        self.count = 0
+        self.errors = 0
+        self.duplicates = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.size_bytes = 0
+        self.class_counts = collections.Counter()
+        self.height_counts = collections.Counter()
+        self.width_counts = collections.Counter()
+        self.record_size_counts = collections.Counter()
+        if backend == 'python':
+            self._writer = TFRecordWriter(output_file)
+        else:
+            self._writer = tf.io.TFRecordWriter(output_file)
+        offsets_file, ids_file = index_files(output_file)
+        self._offsets = open(offsets_file, 'w')
+        self._ids = open(ids_file, 'w')
+
+    def write(self, record, image_bytes_in=0, image_bytes_out=0, image_id='', label=0,
+              height=0, width=0):
+        with REGISTRY.timer('write'):
+            self._writer.write(record)
+            # length (8 bytes) + crc of the length (4 bytes) + data + crc of the data (4 bytes)
+            record_size = len(record) + 16
+            self._offsets.write('%d %d\n' % (self.size_bytes, record_size))
+            self._ids.write('%s\t%d\n' % (image_id, label))
+        REGISTRY.inc('images')
+        REGISTRY.inc('image_in_bytes', image_bytes_in)
+        REGISTRY.inc('record_bytes', record_size)
+        self.count += 1
+        self.bytes_in += image_bytes_in
+        self.bytes_out += image_bytes_out
+        self.size_bytes += record_size
+        self.class_counts[str(label)] += 1
+        self.height_counts[str(int(height) // DIMENSION_BIN_SIZE * DIMENSION_BIN_SIZE)] += 1
+        self.width_counts[str(int(width) // DIMENSION_BIN_SIZE * DIMENSION_BIN_SIZE)] += 1
+        self.record_size_counts[str(1 << (record_size.bit_length() - 1))] += 1
+
+    def close(self):
+        self._writer.close()
+        self._offsets.close()
+        self._ids.close()
+
+    def stats(self):
+        """Statistics of the shard: its `shard` index, `filename`, record `count`, number of
+        `errors` and `duplicates`, image `bytes_in`, image `bytes_out`, file `size_bytes`
+        and its histograms."""
+        return {
+            'shard': self.shard,
+            'filename': os.path.basename(str(self.output_file)),
+            'count': self.count,
+            'errors': self.errors,
+            'duplicates': self.duplicates,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'size_bytes': self.size_bytes,
+            'class_counts': _sorted_counts(self.class_counts),
+            'height_counts': _sorted_counts(self.height_counts),
+            'width_counts': _sorted_counts(self.width_counts),
+            'record_size_counts': _sorted_counts(self.record_size_counts),
+        }
+
+
+def _sorted_counts(counts):
+    """A histogram keyed by integers as strings, ordered by the integers."""
+    return collections.OrderedDict((key, counts[key]) for key in sorted(counts, key=int))
+
+
+def _index_id_label(image_example):
+    """The id and class label of an image example, as written to the `.ids` sidecar."""
+    image_id = str(image_example['id']).replace('\t', ' ').replace('\n', ' ')
+    return image_id, int(image_example.get('class', {}).get('label', 0))
+
+
+def _file_sha256(path, chunk_size=1 << 20):
+    """sha256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _upload_shard(uploader, shard_stats):
+    """Upload a completed shard of the staging directory, after its index sidecars, so a
+    reader that finds the shard also finds them."""
+    output_file = os.path.join(uploader.staging_directory, shard_stats['filename'])
+    uploader.upload([sidecar_file for sidecar_file in index_files(output_file)
+                     if os.path.exists(sidecar_file)] + [output_file])
+
+
+def _upload_build(uploader, name):
+    """Upload the files of a build left in the staging directory: the shards that were not
+    uploaded as they were completed, then the journal and the summary."""
+    uploader.wait()
+    shard_filename = re.compile(r'^%s-\d+-of-\d+-cnt-\d+\.tfrec$' % (re.escape(name),))
+    for filename in sorted(os.listdir(uploader.staging_directory)):
+        if shard_filename.match(filename):
+            _upload_shard(uploader, {'filename': filename})
+    uploader.wait()
+
+    for filename in ('%s-journal.jsonl' % (name,), '%s-summary.json' % (name,)):
+        path = os.path.join(uploader.staging_directory, filename)
+        if os.path.exists(path):
+            uploader.upload([path])
+    uploader.wait()
+
+
+class _ShardJournal(object):
+    """Records every completed shard in `<name>-journal.jsonl`, so an interrupted build
+    can resume from the shards it has not finished.
+
+    The first line of the journal describes the build, every following line is the
+    statistics of one completed shard with its `input_range` and `sha256` checksum.
+    """
+
+    def __init__(self, output_directory, name):
+        self.output_directory = output_directory
+        self.name = name
+        self.path = os.path.join(output_directory, '%s-journal.jsonl' % (name,))
+        self._lock = threading.Lock()
+
+    def start(self, build):
+        """Start the journal of a new build, described by the dict `build`."""
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(build) + '\n')
+
+    def resume(self, build):
+        """Resume the journal of an interrupted build.
+
+        Shards that are in the journal and on disk with their recorded size and sha256 are
+        kept, every other shard file of the build, finished, half-written or damaged, is
+        deleted.
+        Args:
+          build: dict, description of the build, it must match the journal.
+        Returns:
+          dict : maps the index of every completed shard to its statistics.
+        """
+        if not os.path.exists(self.path):
+            self.start(build)
+            return {}
+
+        with open(self.path) as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        if not lines or lines[0] != build:
+            raise ValueError('Can not resume %s, it was started with %s but this build is %s.' %
+                             (self.path, lines[0] if lines else None, build))
+
+        completed = {}
+        for shard_stats in lines[1:]:
+            output_file = os.path.join(self.output_directory, shard_stats['filename'])
+            if not (os.path.exists(output_file) and
+                    os.path.getsize(output_file) == shard_stats['size_bytes']):
+                continue
+            # A shard of the right size can still have been damaged, e.g. by a copy
+            if _file_sha256(output_file) != shard_stats['sha256']:
+                print('The sha256 of %s does not match the journal.' % (shard_stats['filename'],))
+                continue
+            completed[shard_stats['shard']] = shard_stats
+
+        completed_files = set(shard_stats['filename'] for shard_stats in completed.values())
+        shard_filename = re.compile(r'^(%s-\d+-of-\d+-cnt-\d*\.tfrec)(\.idx|\.ids)?$' %
+                                    (re.escape(self.name),))
+        for filename in os.listdir(self.output_directory):
+            match = shard_filename.match(filename)
+            if match and match.group(1) not in completed_files:
+                print('Deleting unfinished shard %s' % (filename,))
+                os.remove(os.path.join(self.output_directory, filename))
+
+        # Rewrite the journal with only the shards that were kept.
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(build) + '\n')
+            for shard in sorted(completed):
+                f.write(json.dumps(completed[shard]) + '\n')
+
+        return completed
+
+    def record(self, shard_stats):
+        """Append a completed shard to the journal."""
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(shard_stats) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def _process_image_shard(coder, worker_index, shard, name, output_directory, image_examples,
+                         num_shards, options, error_queue):
+    """Processes and saves the image examples of one shard as a TFRecord file.
     Args:
       coder: instance of ImageCoder to provide TensorFlow image coding utils.
-      thread_index: integer, unique batch to run index is within [0, len(ranges)).
-      ranges: list of pairs of integers specifying ranges of each batches to
-        analyze in parallel.
+      worker_index: integer, index of the worker writing the shard.
+      shard: integer, index of the shard within [0, num_shards).
+      name: string, unique identifier specifying the data set (e.g. `train` or `test`)
+      output_directory: string, file path to store the tfrecord files.
+      image_examples: list, the image example dicts of this shard
+      num_shards: integer number of shards for this data set.
+      options: _ExampleOptions, how the image examples are stored.
+      error_queue: Queue, a queue to place image examples that failed.
+    Returns:
+      dict : statistics of the shard, see `_ShardWriter.stats`, and the `sha256` of the file.
+    """
+    output_file = _shard_output_file(output_directory, name, shard, num_shards)
+    writer = _ShardWriter(output_file, shard, options.backend)
+
+    verify_rng = random.Random()
+    # images processed so far, written, failed or dropped as duplicates
+    for processed, image_example in enumerate(image_examples, 1):
+
+        try:
+            verify_decode = _should_verify_decode(options.verify_decode_rate, verify_rng)
+            record, image_bytes_in, image_bytes_out, is_duplicate, image_size = \
+                _process_image_example(image_example, coder, options, verify_decode)
+
+            writer.duplicates += is_duplicate
+            if record is not None:
+                writer.write(record, image_bytes_in, image_bytes_out,
+                             *(_index_id_label(image_example) + image_size))
+        except Exception as e:
+            writer.errors += 1
+            REGISTRY.inc('errors')
+            error_msg = repr(e)
+            image_example['error_msg'] = error_msg
+            error_queue.put(image_example)
+
+        if not processed % 1000:
+            print('%s [worker %d]: Processed %d of %d images in shard %d, with %d errors.' %
+                  (datetime.now(), worker_index, processed, len(image_examples), shard,
+                   writer.errors))
+            sys.stdout.flush()
+
+    writer.close()
+    writer.output_file = _finalize_shard(output_file, writer.count)
+
+    print('%s [worker %d]: Wrote %d images to %s, with %d errors and %d duplicates. '
+          'Image bytes in: %d, image bytes out: %d.' %
+          (datetime.now(), worker_index, writer.count, writer.output_file, writer.errors,
+           writer.duplicates, writer.bytes_in, writer.bytes_out))
+    sys.stdout.flush()
+
+    shard_stats = writer.stats()
+    shard_stats['sha256'] = _file_sha256(writer.output_file)
+
+    return shard_stats
+
+
+def _process_image_files_batch(coder, thread_index, shard_queue, name, output_directory,
+                               dataset, num_shards, options, error_queue, shard_stats_queue,
+                               journal=None, uploader=None):
+    """Processes and saves shards of images as TFRecord in 1 thread, until no shard is left.
+
+    The shards are pulled from a queue shared by all the threads, so a thread that is done
+    with its shard takes the next one instead of waiting for the slowest thread.
+    Args:
+      coder: instance of ImageCoder to provide TensorFlow image coding utils.
+      thread_index: integer, unique index of this thread.
+      shard_queue: Queue of (shard, start, end) work units, the shard holds the image
+        examples dataset[start:end].
       name: string, unique identifier specifying the data set (e.g. `train` or `test`)
       output_directory: string, file path to store the tfrecord files.
       dataset: list, a list of image example dicts
       num_shards: integer number of shards for this data set.
-      store_images: bool, should the image be stored in the tfrecord
+      options: _ExampleOptions, how the image examples are stored.
+      error_queue: Queue, a queue to place image examples that failed.
+      shard_stats_queue: Queue, a queue to place the statistics of the written shards.
+      journal: _ShardJournal, where the completed shards are recorded.
+      uploader: remote_storage.ShardUploader, uploads the completed shards.
+    """
+    counter = 0
+    num_shards_written = 0
+    while True:
+        if uploader is not None:
+            uploader.wait_for_space()
+        try:
+            shard, start, end = shard_queue.get_nowait()
+        except Empty:
+            break
+
+        shard_stats = _process_image_shard(coder, thread_index, shard, name, output_directory,
+                                           dataset[start:end], num_shards, options,
+                                           error_queue)
+        shard_stats['input_range'] = [int(start), int(end)]
+        if journal is not None:
+            journal.record(shard_stats)
+        if uploader is not None:
+            _upload_shard(uploader, shard_stats)
+        shard_stats_queue.put(shard_stats)
+        counter += shard_stats['count']
+        num_shards_written += 1
+
+    print('%s [thread %d]: Wrote %d images to %d shards.' %
+          (datetime.now(), thread_index, counter, num_shards_written))
+    sys.stdout.flush()
+
+
+# ImageCoder of a worker process, see `_init_worker_process`.
+_worker_coder = None
+
+
+def _init_worker_process(quality=100, png_compression=-1, backend='tensorflow'):
+    """Give the worker process its own ImageCoder, and so its own tf Session."""
+    global _worker_coder
+    _worker_coder = _make_coder(backend, quality, png_compression)
+
+
+def _process_image_shard_in_process(work_unit):
+    """Processes and saves the image examples of one shard in a worker process.
+    Args:
+      work_unit: tuple, the arguments of `_process_image_shard` without the coder and the
+        error queue: (shard, name, output_directory, image_examples, num_shards, options)
+    Returns:
+      tuple : (dict of shard statistics, list of image examples that failed, snapshot of
+        the metrics of the worker, see `metrics.MetricsRegistry.drain`)
+    """
+    shard, name, output_directory, image_examples, num_shards, options = work_unit
+    error_queue = Queue()
+
+    shard_stats = _process_image_shard(_worker_coder, os.getpid(), shard, name,
+                                       output_directory, image_examples, num_shards,
+                                       options, error_queue)
+    errors = []
+    while not error_queue.empty():
+        errors.append(error_queue.get())
+
+    return shard_stats, errors, REGISTRY.drain()
+
+
+def _process_image_stream(coder, worker_index, shards, name, output_directory, num_shards,
+                          options, record_queue, error_queue, target_shard_bytes=None):
+    """Processes and saves image examples as TFRecord as they arrive on a queue.
+    Args:
+      coder: instance of ImageCoder to provide TensorFlow image coding utils.
+      worker_index: integer, index of this worker.
+      shards: list of integers, the shards owned by this worker. Unused when
+        `target_shard_bytes` is set.
+      name: string, unique identifier specifying the data set (e.g. `train` or `test`)
+      output_directory: string, file path to store the tfrecord files.
+      num_shards: integer number of shards for this data set.
+      options: _ExampleOptions, how the image examples are stored.
+      record_queue: Queue of (shard, image example) pairs, ended by None.
       error_queue: Queue, a queue to place image examples that failed.
+      target_shard_bytes: integer, if set the worker writes its records to its own parts
+        and rolls to a new part once a part reaches this size. The parts keep their
+        temporary names, they are numbered and renamed once all the workers are done.
+    Returns:
+      list : the statistics of the written shards, see `_ShardWriter.stats`.
     """
-    # Each thread produces N shards where N = int(num_shards / num_threads).
-    # For instance, if num_shards = 128, and the num_threads = 2, then the first
-    # thread would produce shards [0, 64).
-    num_threads = len(ranges)
-    assert not num_shards % num_threads
-    num_shards_per_batch = int(num_shards / num_threads)
-
-    shard_ranges = np.linspace(ranges[thread_index][0],
-                               ranges[thread_index][1],
-                               num_shards_per_batch + 1).astype(int)
-    num_files_in_thread = ranges[thread_index][1] - ranges[thread_index][0]
+    writers = {}
+    if target_shard_bytes is None:
+        for shard in shards:
+            output_file = _shard_output_file(output_directory, name, shard, num_shards)
+            writers[shard] = _ShardWriter(output_file, shard, options.backend)
 
     counter = 0
+    # images processed so far, written, failed or dropped as duplicates
+    processed = 0
     error_counter = 0
-    for s in range(num_shards_per_batch):
-        # Generate a sharded version of the file name, e.g. 'train-00002-of-00010'
-        shard = thread_index * num_shards_per_batch + s  
-        # output_filename = '%s-%.5d-of-%.5d' % (name, shard, num_shards)
+    duplicate_counter = 0
+    written_parts = []
+    verify_rng = random.Random()
+    while True:
+        item = record_queue.get()
+        if item is None:
+            break
+        shard, image_example = item
+        processed += 1
+
+        try:
+            verify_decode = _should_verify_decode(options.verify_decode_rate, verify_rng)
+            record, image_bytes_in, image_bytes_out, is_duplicate, image_size = \
+                _process_image_example(image_example, coder, options, verify_decode)
+
+            duplicate_counter += is_duplicate
+            if record is not None:
+                if target_shard_bytes is not None:
+                    # Parts are opened when their first record arrives, so none is left empty.
+                    if shard not in writers:
+                        part = len(written_parts)
+                        output_file = _part_output_file(output_directory, name, worker_index,
+                                                        part)
+                        writers[shard] = _ShardWriter(output_file, backend=options.backend)
+
+                writers[shard].write(record, image_bytes_in, image_bytes_out,
+                                     *(_index_id_label(image_example) + image_size))
+                counter += 1
 
-        # write count in tfrecord filename -- tfrecords don't store metadata info - 
-        # so its better to store count in filname - 
-        # it will avoid iterating whole dataset to counting records
-        output_filename = '%s-%.2d-of-%.2d-cnt-.tfrec' % (name, shard, num_shards)
+                if (target_shard_bytes is not None and
+                        writers[shard].size_bytes >= target_shard_bytes):
+                    writers[shard].close()
+                    written_parts.append(writers.pop(shard))
+        except Exception as e:
+            error_counter += 1
+            REGISTRY.inc('errors')
+            error_msg = repr(e)
+            image_example['error_msg'] = error_msg
+            error_queue.put(image_example)
+
+        if not processed % 1000:
+            print('%s [worker %d]: Processed %d images, with %d errors.' %
+                  (datetime.now(), worker_index, processed, error_counter))
+            sys.stdout.flush()
+
+    shard_stats = []
+    if target_shard_bytes is not None:
+        for writer in writers.values():
+            writer.close()
+            written_parts.append(writer)
+        for writer in written_parts:
+            shard_stats.append(writer.stats())
+    else:
+        for shard in shards:
+            writer = writers[shard]
+            writer.close()
+            writer.output_file = _finalize_shard(writer.output_file, writer.count)
+            shard_stats.append(writer.stats())
+
+            print('%s [worker %d]: Wrote %d images to %s. '
+                  'Image bytes in: %d, image bytes out: %d.' %
+                  (datetime.now(), worker_index, writer.count, writer.output_file,
+                   writer.bytes_in, writer.bytes_out))
+
+    print('%s [worker %d]: Wrote %d images to %d shards, with %d errors and %d duplicates.' %
+          (datetime.now(), worker_index, counter, len(shard_stats), error_counter,
+           duplicate_counter))
+    sys.stdout.flush()
+
+    # The errors and duplicates can not be attributed to a shard, they are reported by the
+    # first one.
+    if shard_stats:
+        shard_stats[0]['errors'] = error_counter
+        shard_stats[0]['duplicates'] = duplicate_counter
+
+    return shard_stats
 
-        output_file = os.path.join(output_directory, output_filename)
-        writer = tf.io.TFRecordWriter(output_file)
 
-        shard_counter = 0
-        files_in_shard = np.arange(shard_ranges[s], shard_ranges[s + 1], dtype=int)
-        for i in files_in_shard:
+def _process_image_stream_in_process(worker_index, shards, name, output_directory, num_shards,
+                                     options, record_queue, result_queue, quality=100,
+                                     png_compression=-1, target_shard_bytes=None):
+    """Run `_process_image_stream` inside a worker process with its own ImageCoder.
+
+    The worker puts (worker_index, list of shard statistics, list of image examples
+    that failed, snapshot of its metrics) on `result_queue` once `record_queue` is
+    exhausted.
+    """
+    coder = _make_coder(options.backend, quality, png_compression)
+    error_queue = Queue()
+
+    shard_stats = _process_image_stream(coder, worker_index, shards, name, output_directory,
+                                        num_shards, options, record_queue, error_queue,
+                                        target_shard_bytes)
+    errors = []
+    while not error_queue.empty():
+        errors.append(error_queue.get())
+
+    result_queue.put((worker_index, shard_stats, errors, REGISTRY.drain()))
+
+
+def _process_image_stream_in_thread(coder, worker_index, shards, name, output_directory,
+                                    num_shards, options, record_queue, error_queue,
+                                    shard_stats_queue, target_shard_bytes=None):
+    """Run `_process_image_stream` in a thread, placing the shard statistics on a queue."""
+    shard_stats = _process_image_stream(coder, worker_index, shards, name, output_directory,
+                                        num_shards, options, record_queue, error_queue,
+                                        target_shard_bytes)
+    for stats in shard_stats:
+        shard_stats_queue.put(stats)
+
+
+def _number_shard_parts(output_directory, name, shard_stats):
+    """Give the parts written for a size target their final shard names.
+
+    The parts are numbered in the order of the workers and of their parts, and renamed
+    to the usual `<name>-<shard>-of-<num_shards>-cnt-<count>.tfrec` names.
+    Args:
+      output_directory: string, file path of the tfrecord files.
+      name: string, unique identifier specifying the data set (e.g. `train` or `test`)
+      shard_stats: list, the statistics of the written parts.
+    Returns:
+      list : the statistics of the shards, in shard order.
+    """
+    shard_stats = sorted(shard_stats, key=lambda stats: stats['filename'])
+    num_shards = len(shard_stats)
+    for shard, stats in enumerate(shard_stats):
+        output_file = os.path.join(output_directory, stats['filename'])
+        final_output_file = _shard_output_file(output_directory, name, shard, num_shards)
+        new_output_file = _finalize_shard(output_file, stats['count'], final_output_file)
+        stats['shard'] = shard
+        stats['filename'] = new_output_file.name
+
+        print('%s: Wrote %d images (%d bytes) to %s.' %
+              (datetime.now(), stats['count'], stats['size_bytes'], new_output_file))
+    sys.stdout.flush()
 
-            image_example = dataset[i]
+    return shard_stats
 
-            filename = str(image_example['filename'])
 
+def _write_summary(output_directory, name, profile, shard_stats, pipeline_stats=None):
+    """Write the summary of a build next to its shards, as `<name>-summary.json`: the
+    profile, totals and histograms of the build and the statistics of every shard.
+    Args:
+      output_directory: string, file path of the tfrecord files.
+      name: string, unique identifier specifying the data set (e.g. `train` or `test`)
+      profile: string, the tfrecord_schema profile of the records, read back by the
+        reader and stat tools, see `tfrecord_schema.written_profile`.
+      shard_stats: list, the statistics of the written shards, see `_ShardWriter.stats`.
+      pipeline_stats: dict, the queue depths of the stages of the pipeline executor, see
+        `_PipelineMonitor.stats`.
+    Returns:
+      string : path of the summary file.
+    """
+    shard_stats = sorted(shard_stats, key=lambda stats: stats['shard'])
+    summary = {
+        'dataset_name': name,
+        'profile': profile,
+        'num_shards': len(shard_stats),
+        'num_records': sum(stats['count'] for stats in shard_stats),
+        'num_errors': sum(stats['errors'] for stats in shard_stats),
+        'num_duplicates': sum(stats.get('duplicates', 0) for stats in shard_stats),
+        'bytes_in': sum(stats['bytes_in'] for stats in shard_stats),
+        'bytes_out': sum(stats['bytes_out'] for stats in shard_stats),
+        'size_bytes': sum(stats['size_bytes'] for stats in shard_stats),
+    }
+    # The histograms of the whole build, the sums of the histograms of its shards
+    for histogram in ('class_counts', 'height_counts', 'width_counts', 'record_size_counts'):
+        counts = collections.Counter()
+        for stats in shard_stats:
+            counts.update(stats.get(histogram, {}))
+        summary[histogram] = _sorted_counts(counts)
+    if pipeline_stats is not None:
+        summary['pipeline'] = pipeline_stats
+    summary['shards'] = shard_stats
+
+    summary_file = os.path.join(output_directory, '%s-summary.json' % (name,))
+    with open(summary_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    return summary_file
+
+
+def _iter_manifest(manifest_path):
+    """Yield the image example dicts of a JSON-Lines manifest, one dict per line."""
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _shuffle_stream(image_examples, buffer_size, rng=random):
+    """Shuffle a stream of image examples through a buffer of at most `buffer_size` examples."""
+    buffer = []
+    for image_example in image_examples:
+        if len(buffer) < buffer_size:
+            buffer.append(image_example)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = image_example
+
+    rng.shuffle(buffer)
+    for image_example in buffer:
+        yield image_example
+
+
+def _create_from_stream(image_examples, dataset_name, output_directory, num_shards, num_threads,
+                        options, executor, quality, png_compression, queue_size,
+                        target_shard_bytes=None):
+    """Create the tfrecord files from an iterable of image examples, see `create`.
+
+    Every worker owns the shards `worker_index, worker_index + num_workers, ...` and keeps
+    them open. The image examples are dealt to the shards round robin as they are read,
+    through one bounded queue per worker, so only `queue_size` examples per worker are
+    held in memory. With `target_shard_bytes` the image examples are dealt to the workers
+    round robin instead, and every worker rolls its own shards by size.
+    """
+    if target_shard_bytes is not None:
+        num_workers = num_threads
+        worker_shards = [[] for _ in range(num_workers)]
+        print('Launching %d %s for shards of %d bytes.' %
+              (num_workers, executor, target_shard_bytes))
+    else:
+        num_workers = min(num_threads, num_shards)
+        worker_shards = [list(range(w, num_shards, num_workers)) for w in range(num_workers)]
+        print('Launching %d %s for shards: %s' % (num_workers, executor, worker_shards))
+    sys.stdout.flush()
+
+    if executor == 'processes':
+        # `spawn` gives every worker a fresh interpreter, tensorflow is not fork safe.
+        context = multiprocessing.get_context('spawn')
+        record_queues = [context.Queue(maxsize=queue_size) for _ in range(num_workers)]
+        result_queue = context.Queue()
+        workers = []
+        for worker_index in range(num_workers):
+            args = (worker_index, worker_shards[worker_index], dataset_name, output_directory,
+                    num_shards, options, record_queues[worker_index], result_queue,
+                    quality, png_compression, target_shard_bytes)
+            workers.append(context.Process(target=_process_image_stream_in_process, args=args))
+    else:
+        coder = _make_coder(options.backend, quality, png_compression)
+        record_queues = [Queue(maxsize=queue_size) for _ in range(num_workers)]
+        error_queue = Queue()
+        shard_stats_queue = Queue()
+        workers = []
+        for worker_index in range(num_workers):
+            args = (coder, worker_index, worker_shards[worker_index], dataset_name,
+                    output_directory, num_shards, options, record_queues[worker_index],
+                    error_queue, shard_stats_queue, target_shard_bytes)
+            workers.append(threading.Thread(target=_process_image_stream_in_thread, args=args))
+
+    for worker in workers:
+        worker.start()
+
+    num_examples = 0
+    for image_example in image_examples:
+        if target_shard_bytes is not None:
+            record_queues[num_examples % num_workers].put((None, image_example))
+        else:
+            shard = num_examples % num_shards
+            record_queues[shard % num_workers].put((shard, image_example))
+        num_examples += 1
+
+    for record_queue in record_queues:
+        record_queue.put(None)
+
+    errors = []
+    shard_stats = []
+    if executor == 'processes':
+        # Drain the results before joining, a process with queued data does not exit.
+        num_results = 0
+        while num_results < num_workers:
             try:
-                if store_images:
-                    if 'encoded' in image_example:
-                        image_buffer = image_example['encoded']
-                        height = image_example['height']
-                        width = image_example['width']
-                        colorspace = image_example['colorspace']
-                        image_format = image_example['format']
-                        num_channels = image_example['channels']
-                        example = _convert_to_example(image_example, image_buffer, height,
-                                                    width, colorspace, num_channels,
-                                                    image_format)
-
-                    else:
-                        image_buffer, height, width = _process_image(filename, coder)
-                        example = _convert_to_example(image_example, image_buffer, height,
-                                                    width)
-                else:
-                    image_buffer=''
-                    height = int(image_example['height'])
-                    width = int(image_example['width'])
-                    example = _convert_to_example(image_example, image_buffer, height,
-                                                    width)
-
-                writer.write(example.SerializeToString())
-                shard_counter += 1
-                counter += 1
+                worker_index, worker_shard_stats, worker_errors, worker_metrics = \
+                    result_queue.get(timeout=5)
+            except Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError('Worker processes exited without reporting their results.')
+                continue
+            shard_stats.extend(worker_shard_stats)
+            errors.extend(worker_errors)
+            REGISTRY.merge(worker_metrics)
+            num_results += 1
+
+    for worker in workers:
+        worker.join()
+
+    if executor == 'threads':
+        while not error_queue.empty():
+            errors.append(error_queue.get())
+        while not shard_stats_queue.empty():
+            shard_stats.append(shard_stats_queue.get())
+
+    if target_shard_bytes is not None:
+        shard_stats = _number_shard_parts(output_directory, dataset_name, shard_stats)
+    summary_file = _write_summary(output_directory, dataset_name, options.profile, shard_stats)
+
+    print('%s: Finished writing all %d images in data set, %d shards, summary in %s.' %
+          (datetime.now(), num_examples, len(shard_stats), summary_file))
+    print('%d examples failed.' % (len(errors),))
+    sys.stdout.flush()
+
+    return errors
+
+
+# Seconds between two samples of the queue depths of the pipeline executor, and between
+# two reports of the sampled depths.
+PIPELINE_SAMPLE_INTERVAL = 0.1
+PIPELINE_REPORT_INTERVAL = 10.
+
+# Seconds between two checks of the abort of the pipeline by the blocked threads
+PIPELINE_POLL_INTERVAL = 0.1
+
+
+class _PipelineAborted(Exception):
+    """Raised in the threads of the pipeline executor once another of its threads failed."""
+
+
+class _PipelineAbort(object):
+    """The first error of a thread of the pipeline executor.
+
+    The blocking calls of the pipeline go through `put`, `get`, `acquire` and `join`, which
+    wait with timeouts and raise _PipelineAborted once a thread failed. So a failed thread,
+    e.g. a writer on a full disk, stops the whole pipeline and `create` raises its error,
+    instead of leaving the other threads blocked on the queues it no longer drains.
+    """
+
+    def __init__(self):
+        self.error = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+
+    def fail(self, error):
+        with self._lock:
+            if self.error is None:
+                self.error = error
+        self._event.set()
+
+    def check(self):
+        if self._event.is_set():
+            raise _PipelineAborted()
+
+    def put(self, queue, item):
+        while True:
+            self.check()
+            try:
+                queue.put(item, timeout=PIPELINE_POLL_INTERVAL)
+                return
+            except Full:
+                pass
+
+    def get(self, queue):
+        while True:
+            self.check()
+            try:
+                return queue.get(timeout=PIPELINE_POLL_INTERVAL)
+            except Empty:
+                pass
+
+    def acquire(self, semaphore):
+        while not semaphore.acquire(timeout=PIPELINE_POLL_INTERVAL):
+            self.check()
+
+    def join(self, thread):
+        while thread.is_alive():
+            self.check()
+            thread.join(PIPELINE_POLL_INTERVAL)
+
+    def run(self, target, *args):
+        """Run the target of a thread of the pipeline, recording its error."""
+        try:
+            target(*args)
+        except _PipelineAborted:
+            pass
+        except BaseException as e:
+            self.fail(e)
+
+
+class _PipelineMonitor(threading.Thread):
+    """Samples the depths of the queues that feed the stages of the pipeline executor.
+
+    A queue that stays full is filled faster than its stage empties it, so that stage is
+    the bottleneck. A queue that stays empty starves its stage, the bottleneck is upstream.
+    """
+
+    def __init__(self, stages, sample_interval=PIPELINE_SAMPLE_INTERVAL,
+                 report_interval=PIPELINE_REPORT_INTERVAL):
+        """
+        Args:
+          stages: list of (name, number of workers, queues feeding the stage) tuples.
+          sample_interval: float, seconds between two samples of the depths.
+          report_interval: float, seconds between two prints of the depths.
+        """
+        super(_PipelineMonitor, self).__init__()
+        self.daemon = True
+        self.stages = stages
+        self.sample_interval = sample_interval
+        self.report_interval = report_interval
+        self.num_samples = 0
+        self._depth_sums = [0] * len(stages)
+        self._max_depths = [0] * len(stages)
+        self._stop_event = threading.Event()
+
+    def depths(self):
+        """The number of items waiting in the queues of every stage."""
+        return [sum(queue.qsize() for queue in queues) for _, _, queues in self.stages]
+
+    def capacities(self):
+        return [sum(queue.maxsize for queue in queues) for _, _, queues in self.stages]
+
+    def sample(self):
+        depths = self.depths()
+        self.num_samples += 1
+        for i, depth in enumerate(depths):
+            self._depth_sums[i] += depth
+            self._max_depths[i] = max(self._max_depths[i], depth)
+        return depths
+
+    def report(self, depths):
+        print('%s: Pipeline queue depths: %s.' %
+              (datetime.now(), ', '.join('%s %d/%d' % (name, depth, capacity)
+                                         for (name, _, _), depth, capacity in
+                                         zip(self.stages, depths, self.capacities()))))
+        sys.stdout.flush()
+
+    def run(self):
+        last_report = time.time()
+        while not self._stop_event.wait(self.sample_interval):
+            depths = self.sample()
+            if time.time() - last_report >= self.report_interval:
+                self.report(depths)
+                last_report = time.time()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def stats(self):
+        """For every stage, its number of `workers`, the `capacity` of its queues and their
+        `mean_depth` and `max_depth` over the samples."""
+        stats = collections.OrderedDict()
+        for i, ((name, num_workers, _), capacity) in enumerate(zip(self.stages,
+                                                                   self.capacities())):
+            stats[name] = {
+                'workers': num_workers,
+                'capacity': capacity,
+                'mean_depth': self._depth_sums[i] / max(self.num_samples, 1),
+                'max_depth': self._max_depths[i],
+            }
+        return stats
+
+
+def _pipeline_read(read_queue, decode_queue, options, abort):
+    """Read stage of the pipeline executor: reads the image files, so the CPU workers never
+    wait on storage. A file that can not be read is passed on as its exception."""
+    while True:
+        item = abort.get(read_queue)
+        if item is None:
+            break
+        unit_index, position, image_example = item
+
+        image_data = None
+        if options.store_images and 'encoded' not in image_example:
+            try:
+                image_data = _read_file(str(image_example['filename']))
             except Exception as e:
-                raise
-                error_counter += 1
-                error_msg = repr(e)
-                image_example['error_msg'] = error_msg
+                image_data = e
+        abort.put(decode_queue, (unit_index, position, image_example, image_data))
+
+
+def _pipeline_encode(coder, decode_queue, write_queues, options, abort):
+    """CPU stage of the pipeline executor: checks, transcodes, hashes and serializes the
+    images that were read, and passes the records, or the exceptions, to the writer of
+    their shard."""
+    verify_rng = random.Random()
+    while True:
+        item = abort.get(decode_queue)
+        if item is None:
+            break
+        unit_index, position, image_example, image_data = item
+
+        if isinstance(image_data, Exception):
+            result = image_data
+        else:
+            try:
+                verify_decode = _should_verify_decode(options.verify_decode_rate, verify_rng)
+                result = _process_image_example(image_example, coder, options, verify_decode,
+                                                image_data)
+            except Exception as e:
+                result = e
+        abort.put(write_queues[unit_index % len(write_queues)],
+                  (unit_index, position, image_example, result))
+
+
+def _pipeline_write(worker_index, num_writers, write_queue, work_units, name, output_directory,
+                    num_shards, options, permits, error_queue, shard_stats_queue, journal,
+                    abort, uploader=None):
+    """Write stage of the pipeline executor: writes the shards `worker_index,
+    worker_index + num_writers, ...` of `work_units`.
+
+    The records of a shard arrive in any order from the CPU workers. They are held until
+    the records before them are written, so a shard holds its image examples in the order
+    of the dataset, as with the other executors, and resumes to the same bytes.
+    Every image example written, dropped or failed releases one of the `permits` of the
+    feeder.
+    """
+    writers = {}
+    next_positions = {}
+    pending = {}
+    counter = 0
+    num_shards_written = 0
+    while True:
+        item = abort.get(write_queue)
+        if item is None:
+            break
+        unit_index, position, image_example, result = item
+        pending[unit_index, position] = (image_example, result)
+
+        shard, start, end = work_units[unit_index]
+        if unit_index not in writers:
+            output_file = _shard_output_file(output_directory, name, shard, num_shards)
+            writers[unit_index] = _ShardWriter(output_file, shard, options.backend)
+            next_positions[unit_index] = 0
+        writer = writers[unit_index]
+
+        while (unit_index, next_positions[unit_index]) in pending:
+            image_example, result = pending.pop((unit_index, next_positions[unit_index]))
+            next_positions[unit_index] += 1
+            if isinstance(result, Exception):
+                writer.errors += 1
+                REGISTRY.inc('errors')
+                image_example['error_msg'] = repr(result)
                 error_queue.put(image_example)
-
-            if not counter % 1000:
-                print('%s [thread %d]: Processed %d of %d images in thread batch, with %d errors.' %
-                      (datetime.now(), thread_index, counter, num_files_in_thread, error_counter))
+            else:
+                record, image_bytes_in, image_bytes_out, is_duplicate, image_size = result
+                writer.duplicates += is_duplicate
+                if record is not None:
+                    writer.write(record, image_bytes_in, image_bytes_out,
+                                 *(_index_id_label(image_example) + image_size))
+            permits.release()
+
+            if not next_positions[unit_index] % 1000:
+                print('%s [writer %d]: Processed %d of %d images in shard %d, with %d errors.' %
+                      (datetime.now(), worker_index, next_positions[unit_index], end - start,
+                       shard, writer.errors))
                 sys.stdout.flush()
 
-        # add total image count in tfrecord filename
-        # it will avoid iterating dataset to get count
-        path = pathlib.Path(output_file)
-        old_name = path.stem
-        old_extension = path.suffix
-        directory = path.parent
-        new_name = old_name + str(shard_counter)  + old_extension
-        new_output_file = pathlib.Path(directory, new_name)
-        path.rename(new_output_file) # rename file on disk
-
-        print('%s [thread %d]: Wrote %d images to %s, with %d errors.' %
-              (datetime.now(), thread_index, shard_counter, new_output_file, error_counter))
-        
+        if next_positions[unit_index] == end - start:
+            counter += _finish_pipeline_shard(writers.pop(unit_index), work_units[unit_index],
+                                              worker_index, shard_stats_queue, journal,
+                                              uploader)
+            num_shards_written += 1
+
+    # The empty shards never get a record to write.
+    for unit_index in range(worker_index, len(work_units), num_writers):
+        shard, start, end = work_units[unit_index]
+        if start == end:
+            output_file = _shard_output_file(output_directory, name, shard, num_shards)
+            _finish_pipeline_shard(_ShardWriter(output_file, shard, options.backend),
+                                   work_units[unit_index], worker_index, shard_stats_queue,
+                                   journal, uploader)
+            num_shards_written += 1
+    if writers:
+        raise RuntimeError('The pipeline ended before the shards %s were complete.' %
+                           (sorted(work_units[unit_index][0] for unit_index in writers),))
+
+    print('%s [writer %d]: Wrote %d images to %d shards.' %
+          (datetime.now(), worker_index, counter, num_shards_written))
+    sys.stdout.flush()
+
+
+def _finish_pipeline_shard(writer, work_unit, worker_index, shard_stats_queue, journal,
+                           uploader=None):
+    """Close, rename, record and upload a shard written by the pipeline executor.
+    Returns:
+      integer : the number of records in the shard.
+    """
+    shard, start, end = work_unit
+    writer.close()
+    writer.output_file = _finalize_shard(writer.output_file, writer.count)
+
+    print('%s [writer %d]: Wrote %d images to %s, with %d errors and %d duplicates. '
+          'Image bytes in: %d, image bytes out: %d.' %
+          (datetime.now(), worker_index, writer.count, writer.output_file, writer.errors,
+           writer.duplicates, writer.bytes_in, writer.bytes_out))
+    sys.stdout.flush()
+
+    shard_stats = writer.stats()
+    shard_stats['sha256'] = _file_sha256(writer.output_file)
+    shard_stats['input_range'] = [int(start), int(end)]
+    journal.record(shard_stats)
+    if uploader is not None:
+        _upload_shard(uploader, shard_stats)
+    shard_stats_queue.put(shard_stats)
+
+    return writer.count
+
+
+def _run_pipeline(dataset, work_units, name, output_directory, num_shards, options, coder,
+                  num_io_threads, num_threads, num_writer_threads, queue_size, journal,
+                  uploader=None):
+    """Write the shards of `work_units` with the pipeline executor, see `create`.
+
+    The image examples flow through three stages joined by bounded queues of `queue_size`
+    items: `num_io_threads` threads read the image files, `num_threads` CPU workers
+    process them into records and `num_writer_threads` threads write the shards. The feeder
+    admits at most `4 * queue_size` image examples into the pipeline at once.
+    Returns:
+      tuple : (list of the statistics of the written shards, list of the image examples
+        that failed, dict of the queue depths of every stage, see `_PipelineMonitor.stats`)
+    """
+    num_writers = max(1, min(num_writer_threads, len(work_units)))
+    print('Launching a pipeline of %d readers, %d workers and %d writers for %d shards.' %
+          (num_io_threads, num_threads, num_writers, len(work_units)))
+    sys.stdout.flush()
+
+    read_queue = Queue(maxsize=queue_size)
+    decode_queue = Queue(maxsize=queue_size)
+    write_queues = [Queue(maxsize=queue_size) for _ in range(num_writers)]
+    permits = threading.Semaphore(4 * queue_size)
+    error_queue = Queue()
+    shard_stats_queue = Queue()
+    abort = _PipelineAbort()
+
+    readers = [threading.Thread(target=abort.run,
+                                args=(_pipeline_read, read_queue, decode_queue, options, abort))
+               for _ in range(num_io_threads)]
+    workers = [threading.Thread(target=abort.run,
+                                args=(_pipeline_encode, coder, decode_queue, write_queues,
+                                      options, abort))
+               for _ in range(num_threads)]
+    writers = [threading.Thread(target=abort.run,
+                                args=(_pipeline_write, worker_index, num_writers,
+                                      write_queues[worker_index], work_units, name,
+                                      output_directory, num_shards, options, permits,
+                                      error_queue, shard_stats_queue, journal, abort, uploader))
+               for worker_index in range(num_writers)]
+    monitor = _PipelineMonitor([('read', num_io_threads, [read_queue]),
+                                ('encode', num_threads, [decode_queue]),
+                                ('write', num_writers, write_queues)])
+
+    # The threads are daemons, so a failed build does not hang the interpreter.
+    for thread in readers + workers + writers:
+        thread.daemon = True
+        thread.start()
+    monitor.start()
+
+    try:
+        for unit_index, (shard, start, end) in enumerate(work_units):
+            if uploader is not None:
+                uploader.wait_for_space()
+            for position, image_example in enumerate(dataset[start:end]):
+                abort.acquire(permits)
+                abort.put(read_queue, (unit_index, position, image_example))
+
+        # Every stage is drained before the next one is told to stop.
+        for stage_threads, stage_queues in ((readers, [read_queue]),
+                                            (workers, [decode_queue]),
+                                            (writers, write_queues)):
+            for i in range(len(stage_threads)):
+                abort.put(stage_queues[i % len(stage_queues)], None)
+            for thread in stage_threads:
+                abort.join(thread)
+    except _PipelineAborted:
+        pass
+    except BaseException as e:
+        # e.g. a failed upload, stop the threads of the pipeline too
+        abort.fail(e)
+        raise
+    finally:
+        monitor.stop()
+
+    # The first error of a thread of the pipeline, e.g. of a writer, fails the build.
+    if abort.error is not None:
+        raise abort.error
+
+    shard_stats = []
+    while not shard_stats_queue.empty():
+        shard_stats.append(shard_stats_queue.get())
+    if len(shard_stats) != len(work_units):
+        raise RuntimeError('The pipeline wrote %d of %d shards, see the errors above.' %
+                           (len(shard_stats), len(work_units)))
+
+    errors = []
+    while not error_queue.empty():
+        errors.append(error_queue.get())
+
+    pipeline_stats = monitor.stats()
+    print('%s: Pipeline mean queue depths: %s.' %
+          (datetime.now(), ', '.join('%s %.1f/%d (max %d)' % (stage, stats['mean_depth'],
+                                                               stats['capacity'],
+                                                               stats['max_depth'])
+                                     for stage, stats in pipeline_stats.items())))
+    sys.stdout.flush()
+
+    return shard_stats, errors, pipeline_stats
+
+
+def _wait_for_space(work_units, uploader):
+    """Yield the work units, each once the uploader has room for another shard."""
+    for work_unit in work_units:
+        if uploader is not None:
+            uploader.wait_for_space()
+        yield work_unit
+
+
+def _create_from_list(dataset, dataset_name, output_directory, num_shards, num_threads,
+                      options, executor, quality, png_compression, shuffle, seed, resume,
+                      num_io_threads=8, num_writer_threads=2, queue_size=256, uploader=None):
+    """Create the tfrecord files from a list of image examples split into `num_shards`
+    shards, see `create`. The shards are recorded in a journal, so the build can be resumed.
+    """
+    # Break all images into shards with a [shard_ranges[i], shard_ranges[i + 1]].
+    # The shards are work units that the workers pull from a shared queue, so any
+    # number of shards can be written by any number of workers.
+    shard_ranges = np.linspace(0, len(dataset), num_shards + 1).astype(int)
+    work_units = []
+    for shard in range(num_shards):
+        work_units.append((shard, shard_ranges[shard], shard_ranges[shard + 1]))
+
+    # Record the completed shards, and skip those of an interrupted build. The build holds
+    # every setting that changes the bytes of the shards, so a build resumed with other
+    # settings is refused instead of mixing the shards of both.
+    journal = _ShardJournal(output_directory, dataset_name)
+    build = {
+        'dataset_name': dataset_name,
+        'num_records': len(dataset),
+        'num_shards': num_shards,
+        'shuffle': shuffle,
+        'seed': seed,
+        'profile': options.profile,
+        'store_images': options.store_images,
+        'transcode': options.transcode,
+        'quality': quality,
+        'png_compression': png_compression,
+        'backend': options.backend,
+        'dedup': options.dedup,
+    }
+    completed_shards = {}
+    if resume:
+        completed_shards = journal.resume(build)
+        print('Resuming, %d of %d shards are already complete.' %
+              (len(completed_shards), num_shards))
+    else:
+        journal.start(build)
+    work_units = [work_unit for work_unit in work_units if work_unit[0] not in completed_shards]
+
+    if executor == 'pipeline':
+        coder = _make_coder(options.backend, quality, png_compression)
+        shard_stats, errors, pipeline_stats = _run_pipeline(
+            dataset, work_units, dataset_name, output_directory, num_shards, options, coder,
+            num_io_threads, num_threads, num_writer_threads, queue_size, journal, uploader)
+        shard_stats.extend(completed_shards.values())
+
+        summary_file = _write_summary(output_directory, dataset_name, options.profile,
+                                      shard_stats, pipeline_stats)
+        print('%s: Finished writing all %d images in data set, %d records in %d shards, '
+              'summary in %s.' %
+              (datetime.now(), len(dataset), sum(stats['count'] for stats in shard_stats),
+               len(shard_stats), summary_file))
+        print('%d examples failed.' % (len(errors),))
         sys.stdout.flush()
-        shard_counter = 0
 
-    print('%s [thread %d]: Wrote %d images to %d shards, with %d errors.' %
-          (datetime.now(), thread_index, counter, num_files_in_thread, error_counter))
+        return errors
+
+    num_workers = max(1, min(num_threads, len(work_units)))
+
+    if executor == 'processes':
+        # Launch the worker processes, each pulls the next shard when it is done.
+        print('Launching %d processes for %d shards.' % (num_workers, num_shards))
+        sys.stdout.flush()
+
+        errors = []
+        shard_stats = list(completed_shards.values())
+        input_ranges = dict((shard, [int(start), int(end)]) for shard, start, end in work_units)
+
+        # `spawn` gives every worker a fresh interpreter, tensorflow is not fork safe.
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes=num_workers, initializer=_init_worker_process,
+                          initargs=(quality, png_compression, options.backend)) as pool:
+            process_args = ((shard, dataset_name, output_directory, dataset[start:end],
+                             num_shards, options)
+                            for shard, start, end in _wait_for_space(work_units, uploader))
+            for stats, shard_errors, worker_metrics in pool.imap_unordered(
+                    _process_image_shard_in_process, process_args):
+                REGISTRY.merge(worker_metrics)
+                stats['input_range'] = input_ranges[stats['shard']]
+                journal.record(stats)
+                if uploader is not None:
+                    _upload_shard(uploader, stats)
+                shard_stats.append(stats)
+                errors.extend(shard_errors)
+
+        summary_file = _write_summary(output_directory, dataset_name, options.profile, shard_stats)
+        print('%s: Finished writing all %d images in data set, %d records in %d shards, '
+              'summary in %s.' %
+              (datetime.now(), len(dataset), sum(stats['count'] for stats in shard_stats),
+               len(shard_stats), summary_file))
+        print('%d examples failed.' % (len(errors),))
+
+        return errors
+
+    # Launch the threads, each pulls the next shard when it is done.
+    print('Launching %d threads for %d shards.' % (num_workers, num_shards))
     sys.stdout.flush()
 
+    shard_queue = Queue()
+    for work_unit in work_units:
+        shard_queue.put(work_unit)
+
+    # Create a generic utility for converting all image codings.
+    coder = _make_coder(options.backend, quality, png_compression)
+
+    # A Queue to hold the image examples that fail to process.
+    error_queue = Queue()
+
+    # A Queue to hold the statistics of the written shards.
+    shard_stats_queue = Queue()
 
-def create(dataset, dataset_name, output_directory, num_shards, num_threads, shuffle=True, store_images=True):
+    threads = []
+    for thread_index in range(num_workers):
+        args = (coder, thread_index, shard_queue, dataset_name, output_directory, dataset,
+                num_shards, options, error_queue, shard_stats_queue, journal, uploader)
+        t = threading.Thread(target=_process_image_files_batch, args=args)
+        t.start()
+        threads.append(t)
+
+    # Wait for all the threads to terminate.
+    for t in threads:
+        t.join()
+
+    shard_stats = list(completed_shards.values())
+    while not shard_stats_queue.empty():
+        shard_stats.append(shard_stats_queue.get())
+    summary_file = _write_summary(output_directory, dataset_name, options.profile, shard_stats)
+    print('%s: Finished writing all %d images in data set, summary in %s.' %
+          (datetime.now(), len(dataset), summary_file))
+
+    # Collect the errors
+    errors = []
+    while not error_queue.empty():
+        errors.append(error_queue.get())
+    print ('%d examples failed.' % (len(errors),))
+
+    return errors
+
+
+def create(dataset, dataset_name, output_directory, num_shards, num_threads, shuffle=True, store_images=True,
+           executor='threads', verify_decode_rate=0., transcode='jpeg', quality=100,
+           png_compression=-1, shuffle_buffer_size=10000, queue_size=256,
+           target_shard_mb=None, seed=None, resume=False, dedup=None, dedup_index_path=None,
+           backend='tensorflow', profile='full', num_io_threads=8, num_writer_threads=2,
+           storage_options=None, staging_directory=None, upload_threads=8, upload_retries=5,
+           max_staging_mb=None, metrics_path=None, prometheus_path=None, metrics_interval=10.):
     """Create the tfrecord files to be used to train or test a model.
 
     Args:
-      dataset : [{
+      dataset : a list of image example dicts, an iterable of image example dicts,
+        or the path to a JSON-Lines manifest with one image example dict per line.
+        Lists are processed in memory, iterables and manifests are streamed.
+        [{
         "filename" : <REQUIRED: path to the image file>,
         "id" : <REQUIRED: id of the image>,
         "class" : {
@@ -369,60 +1866,250 @@ def create(dataset, dataset_name, output_directory, num_shards, num_threads, shu
 
       dataset_name: a name for the dataset
 
-      output_directory: path to a directory to write the tfrecord files
+      output_directory: path to a directory to write the tfrecord files, or the url of a
+        remote directory, e.g. `gs://bucket/tfrecords` or `s3://bucket/tfrecords`. A remote
+        build writes to `staging_directory` and uploads every shard as soon as it is complete,
+        see remote_storage. Streamed and `target_shard_mb` builds can not be remote, they only
+        finish their shards at the end of the build.
 
-      num_shards: the number of tfrecord files to create
+      num_shards: the number of tfrecord files to create, unused with `target_shard_mb`
 
-      num_threads: the number of threads to use
+      num_threads: the number of threads (or worker processes) to use. Any number of shards
+        can be written by any number of threads, an idle thread takes the next shard.
 
       shuffle : bool, should the image examples be shuffled or not prior to creating the tfrecords.
 
-    Returns:
-      list : a list of image examples that failed to process.
-    """
+      store_images : bool, should the image be stored in the tfrecord
 
-    # Images in the tfrecords set must be shuffled properly
-    if shuffle:
-        random.shuffle(dataset)
+      executor : `threads` runs the workers as threads of this process, sharing one ImageCoder.
+        `processes` runs them as worker processes that each have their own ImageCoder, so
+        image coding scales with the number of cores. `pipeline` splits the work into
+        stages joined by bounded queues: `num_io_threads` threads read the image files,
+        `num_threads` threads decode, transcode and serialize them and `num_writer_threads`
+        threads write the shards, so reading from slow storage overlaps the image coding.
+        The depths of the queues are printed every PIPELINE_REPORT_INTERVAL seconds and
+        written to the summary. Needs a list `dataset` and `num_shards`.
 
-    # Break all images into batches with a [ranges[i][0], ranges[i][1]].
-    spacing = np.linspace(0, len(dataset), num_threads + 1).astype(np.int)
-    ranges = []
-    threads = []
-    for i in range(len(spacing) - 1):
-        ranges.append([spacing[i], spacing[i+1]])
+      verify_decode_rate : float in [0, 1], fraction of the images that are fully decoded to
+        check their integrity. The dimensions of the other images are read from their headers.
+        0 never decodes, 1 decodes every image.
 
-    # Launch a thread for each batch.
-    print('Launching %d threads for spacings: %s' % (num_threads, ranges))
-    sys.stdout.flush()
+      transcode : how images that are not JPEG encoded are stored, one of TRANSCODE_POLICIES.
+        `passthrough` stores the original file bytes, `jpeg` converts them to JPEG at `quality`,
+        `png` re-compresses them at `png_compression` and `webp` converts them to WebP at
+        `quality` (requires Pillow). JPEG images are always stored as they are.
 
-    # Create a mechanism for monitoring when all threads are finished.
-    coord = tf.train.Coordinator()
+      quality : integer in [0, 100], quality of the JPEG and WebP encodings.
 
-    # Create a generic TensorFlow-based utility for converting all image codings.
-    coder = ImageCoder()
+      png_compression : integer in [-1, 9], zlib compression level of the PNG encoding.
 
-    # A Queue to hold the image examples that fail to process.
-    error_queue = Queue()
+      shuffle_buffer_size : when streaming, the image examples are shuffled through a buffer
+        of this many examples instead of shuffling the whole dataset.
 
-    threads = []
-    for thread_index in range(len(ranges)):
-        args = (coder, thread_index, ranges, dataset_name, output_directory, dataset,
-                num_shards, store_images, error_queue)
-        t = threading.Thread(target=_process_image_files_batch, args=args)
-        t.start()
-        threads.append(t)
+      queue_size : when streaming, the number of image examples queued for every worker.
+        With the `pipeline` executor, the capacity of the queue of every stage.
 
-    # Wait for all the threads to terminate.
-    coord.join(threads)
-    print('%s: Finished writing all %d images in data set.' %
-          (datetime.now(), len(dataset)))
+      target_shard_mb : if set, size every tfrecord file to about this many megabytes instead
+        of splitting the dataset into `num_shards` files. A worker rolls to a new file once its
+        file reaches the target, and the files are numbered and renamed with the usual
+        `-<shard>-of-<num_shards>-cnt-<count>` names once all the images are written.
 
-    # Collect the errors
-    errors = []
-    while not error_queue.empty():
-        errors.append(error_queue.get())
-    print ('%d examples failed.' % (len(errors),))
+      seed : integer, seed of the shuffle. The same seed and dataset give the same shards.
+
+      resume : bool, resume an interrupted build. Every completed shard is recorded in
+        `<dataset_name>-journal.jsonl` with its input range, record count and checksum. On
+        resume the shards in the journal are kept, the unfinished ones are deleted and
+        written again. A shuffled build must be resumed with the same `seed` for the
+        shards to be the same as those of an uninterrupted build. Needs a list `dataset`
+        and `num_shards`.
+
+      dedup : what to do with an image whose sha256 content hash, the `image/key/sha256` of
+        its record, is already in the hash index: `drop` leaves it out of the tfrecords,
+        `count` stores it anyway. Either way the duplicates are counted in the summary.
+        None does not hash check the images. Only stored images are checked.
+
+      dedup_index_path : path of the hash index, defaults to `sha256-index.npy` in the output
+        directory. The hashes of an earlier build are loaded from it, so a later build only
+        adds images that are new, and the index is extended once the build finishes.
+        Delete it to build the same images again.
+
+      backend : `tensorflow` writes the records and codes the images with tensorflow.
+        `python` frames the records itself and codes the images with Pillow, so tensorflow
+        is never imported. Both encode the Examples with tfrecord_io.ExampleSerializer, the
+        records are the same bytes with both backends, except for the images transcoded to
+        JPEG or PNG, that Pillow encodes differently.
+
+      profile : the features written to every record, one of tfrecord_schema.PROFILES:
+        `classification` the image and its class, `detection` also the boxes and objects,
+        `keypoints` the boxes and parts, `full` every feature. Read the records with the
+        same profile, see iterate_tfrecords.
+
+      num_io_threads : with the `pipeline` executor, the number of threads reading the image files.
+
+      num_writer_threads : with the `pipeline` executor, the number of threads writing the shards.
+
+      storage_options : dict, options of the fsspec filesystem of a remote `output_directory`,
+        e.g. `{'client_kwargs': {'endpoint_url': 'http://127.0.0.1:5000'}}` for an s3 server.
+
+      staging_directory : local directory of the files of a remote build until they are
+        uploaded, a temporary directory that is deleted after the build by default.
+
+      upload_threads : number of concurrent uploads of a remote build.
+
+      upload_retries : number of retries of a failed upload, with exponential backoff.
+
+      max_staging_mb : if set, a new shard of a remote build is only started while the shards
+        waiting for their upload take less than this many megabytes of the staging directory.
+
+      metrics_path : path of a JSON-Lines file, a line with the counters, rates, stage
+        timings and worker utilisations of the build is appended to it every
+        `metrics_interval` seconds and once the build is done, see metrics.MetricsReporter.
+
+      prometheus_path : path of a Prometheus textfile replaced with the same metrics.
+
+      metrics_interval : seconds between two reports of the metrics.
+
+    The shard counts, sizes and image bytes are written to `<dataset_name>-summary.json`
+    in the output directory. A remote build uploads it last.
+
+    Returns:
+      list : a list of image examples that failed to process.
+    """
+
+    if executor not in EXECUTORS:
+        raise ValueError("executor must be one of %s, got %r" % (EXECUTORS, executor))
+    if transcode not in TRANSCODE_POLICIES:
+        raise ValueError("transcode must be one of %s, got %r" % (TRANSCODE_POLICIES, transcode))
+    if dedup not in DEDUP_POLICIES:
+        raise ValueError("dedup must be one of %s, got %r" % (DEDUP_POLICIES, dedup))
+    if backend not in BACKENDS:
+        raise ValueError("backend must be one of %s, got %r" % (BACKENDS, backend))
+    if profile not in PROFILES:
+        raise ValueError("profile must be one of %s, got %r" % (tuple(PROFILES), profile))
+
+    target_shard_bytes = None
+    if target_shard_mb is not None:
+        target_shard_bytes = int(target_shard_mb * 1024 * 1024)
+
+    if executor == 'pipeline' and (not isinstance(dataset, list) or
+                                   target_shard_bytes is not None):
+        raise ValueError('The pipeline executor writes a list dataset into num_shards shards.')
+    if resume and (not isinstance(dataset, list) or target_shard_bytes is not None):
+        raise ValueError('Only builds of a list dataset into num_shards shards can be resumed.')
+    if resume and shuffle and seed is None:
+        raise ValueError('A shuffled build can only be resumed with the seed of its shuffle.')
+
+    remote_directory = None
+    if is_remote(output_directory):
+        if resume:
+            raise ValueError('A build to a remote output_directory can not be resumed.')
+        if not isinstance(dataset, list) or target_shard_bytes is not None:
+            # Their shards are only finished at the end of the build, so they would all be
+            # staged locally and max_staging_mb could not be honoured.
+            raise ValueError('Only builds of a list dataset into num_shards shards can be '
+                             'written to a remote output_directory.')
+        if dedup is not None and (dedup_index_path is None or is_remote(dedup_index_path)):
+            raise ValueError('A deduplicated build to a remote output_directory needs a '
+                             'local dedup_index_path.')
+        remote_directory = output_directory
+    elif max_staging_mb is not None:
+        raise ValueError('max_staging_mb only applies to a remote output_directory.')
+
+    if resume and dedup is not None:
+        raise ValueError('A deduplicated build can not be resumed, which copy of a duplicate '
+                         'image is kept depends on the order the workers write them.')
+
+    hash_index = None
+    manager = None
+    if dedup is not None:
+        if dedup_index_path is None:
+            dedup_index_path = os.path.join(output_directory, DEDUP_INDEX_FILENAME)
+        if executor == 'processes':
+            # The worker processes share one index, served by a manager process.
+            manager = HashIndexManager(ctx=multiprocessing.get_context('spawn'))
+            manager.start()
+            hash_index = manager.HashIndex(dedup_index_path)
+        else:
+            hash_index = HashIndex(dedup_index_path)
+        print('Deduplicating against the %d image hashes of %s.' %
+              (len(hash_index), dedup_index_path))
+        sys.stdout.flush()
+
+    options = _ExampleOptions(store_images, verify_decode_rate, transcode, dedup, hash_index,
+                              backend, profile)
+
+    uploader = None
+    remove_staging_directory = False
+    if remote_directory is not None:
+        if staging_directory is None:
+            staging_directory = tempfile.mkdtemp(prefix='%s-staging-' % (dataset_name,))
+            remove_staging_directory = True
+        elif not os.path.isdir(staging_directory):
+            os.makedirs(staging_directory)
+        max_staging_bytes = None
+        if max_staging_mb is not None:
+            max_staging_bytes = int(max_staging_mb * 1024 * 1024)
+        uploader = ShardUploader(staging_directory, remote_directory, storage_options,
+                                 upload_threads, upload_retries, max_staging_bytes)
+        print('Writing to %s through the staging directory %s.' %
+              (remote_directory, staging_directory))
+        sys.stdout.flush()
+        output_directory = staging_directory
+
+    reporter = None
+    if metrics_path is not None or prometheus_path is not None:
+        reporter = MetricsReporter(metrics_path, prometheus_path, metrics_interval,
+                                   job='create')
+        reporter.start()
+
+    try:
+        if not isinstance(dataset, list):
+            if isinstance(dataset, str):
+                dataset = _iter_manifest(dataset)
+            if shuffle:
+                dataset = _shuffle_stream(dataset, shuffle_buffer_size, random.Random(seed))
+            errors = _create_from_stream(dataset, dataset_name, output_directory, num_shards,
+                                         num_threads, options, executor, quality,
+                                         png_compression, queue_size, target_shard_bytes)
+        else:
+            # Images in the tfrecords set must be shuffled properly
+            if shuffle:
+                random.Random(seed).shuffle(dataset)
+
+            if target_shard_bytes is not None:
+                # The shard boundaries are only known while writing, so the list is streamed.
+                errors = _create_from_stream(iter(dataset), dataset_name, output_directory,
+                                             num_shards, num_threads, options, executor,
+                                             quality, png_compression, queue_size,
+                                             target_shard_bytes)
+            else:
+                errors = _create_from_list(dataset, dataset_name, output_directory, num_shards,
+                                           num_threads, options, executor, quality,
+                                           png_compression, shuffle, seed, resume,
+                                           num_io_threads, num_writer_threads, queue_size,
+                                           uploader)
+
+        # Only a finished build extends the index, a failed one can simply be run again.
+        if hash_index is not None:
+            num_hashes = hash_index.save()
+            print('Saved %d image hashes to %s.' % (num_hashes, dedup_index_path))
+            sys.stdout.flush()
+
+        if uploader is not None:
+            _upload_build(uploader, dataset_name)
+            print('%s: Uploaded %d files, %d bytes, to %s.' %
+                  (datetime.now(), uploader.num_uploaded, uploader.bytes_uploaded,
+                   remote_directory))
+            sys.stdout.flush()
+    finally:
+        if manager is not None:
+            manager.shutdown()
+        if uploader is not None:
+            uploader.close()
+        if remove_staging_directory:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+        if reporter is not None:
+            reporter.stop()
 
     return errors
 
@@ -432,20 +2119,22 @@ def parse_args():
     parser = argparse.ArgumentParser(description='Basic statistics on tfrecord files')
 
     parser.add_argument('--dataset_path', dest='dataset_path',
-                        help='Path to the dataset json file.', type=str,
-                        required=True)
+                        help='Path to the dataset json file, or to a JSON-Lines manifest '
+                             '(`.jsonl`) with one image example per line that is streamed.',
+                        type=str, required=True)
 
     parser.add_argument('--prefix', dest='dataset_name',
                         help='Prefix for the tfrecords (e.g. `train`, `test`, `val`).', type=str,
                         required=True)
 
     parser.add_argument('--output_dir', dest='output_dir',
-                        help='Directory for the tfrecords.', type=str,
+                        help='Directory for the tfrecords, or a remote url such as '
+                             'gs://bucket/tfrecords to upload every shard to.', type=str,
                         required=True)
 
     parser.add_argument('--shards', dest='num_shards',
-                        help='Number of shards to make.', type=int,
-                        required=True)
+                        help='Number of shards to make, unused with --target_shard_mb.', type=int,
+                        required=False, default=1)
 
     parser.add_argument('--threads', dest='num_threads',
                         help='Number of threads to make.', type=int,
@@ -459,6 +2148,125 @@ def parse_args():
                         help='Store the images in the tfrecords.',
                         required=False, action='store_true', default=False)
 
+    parser.add_argument('--executor', dest='executor',
+                        help='Run batches in `threads` sharing one image coder, in worker '
+                             '`processes` that each have their own image coder, or in a '
+                             '`pipeline` of reader, worker and writer threads.',
+                        choices=['threads', 'processes', 'pipeline'],
+                        required=False, default='threads')
+
+    parser.add_argument('--io_threads', dest='num_io_threads',
+                        help='Number of threads reading the image files with --executor '
+                             'pipeline.',
+                        type=int, required=False, default=8)
+
+    parser.add_argument('--writer_threads', dest='num_writer_threads',
+                        help='Number of threads writing the shards with --executor pipeline.',
+                        type=int, required=False, default=2)
+
+    parser.add_argument('--queue_size', dest='queue_size',
+                        help='Capacity of the queues between the stages of --executor '
+                             'pipeline, and of the queue of every worker when streaming.',
+                        type=int, required=False, default=256)
+
+    parser.add_argument('--verify_decode_rate', dest='verify_decode_rate',
+                        help='Fraction of the images to fully decode to check their integrity. '
+                             'The dimensions of the other images are read from their headers.',
+                        type=float, required=False, default=0.)
+
+    parser.add_argument('--transcode', dest='transcode',
+                        help='How PNG images are stored: `passthrough` keeps the original bytes, '
+                             '`jpeg` converts to JPEG, `png` re-compresses the PNG and `webp` '
+                             'converts to WebP. JPEG images are always stored as they are.',
+                        choices=['passthrough', 'jpeg', 'png', 'webp'],
+                        required=False, default='jpeg')
+
+    parser.add_argument('--quality', dest='quality',
+                        help='Quality of the JPEG and WebP encodings.',
+                        type=int, required=False, default=100)
+
+    parser.add_argument('--png_compression', dest='png_compression',
+                        help='zlib compression level of the PNG encoding, -1 for the default.',
+                        type=int, required=False, default=-1)
+
+    parser.add_argument('--shuffle_buffer_size', dest='shuffle_buffer_size',
+                        help='Size of the shuffle buffer when streaming a JSON-Lines manifest.',
+                        type=int, required=False, default=10000)
+
+    parser.add_argument('--target_shard_mb', dest='target_shard_mb',
+                        help='Size the shards to about this many megabytes instead of making '
+                             '--shards shards.',
+                        type=float, required=False, default=None)
+
+    parser.add_argument('--seed', dest='seed',
+                        help='Seed of the shuffle, the same seed gives the same shards.',
+                        type=int, required=False, default=None)
+
+    parser.add_argument('--resume', dest='resume',
+                        help='Resume an interrupted build from its journal, skipping the '
+                             'completed shards. Pass the --seed of the interrupted build.',
+                        required=False, action='store_true', default=False)
+
+    parser.add_argument('--dedup', dest='dedup',
+                        help='`drop` or `count` the images whose content hash is already in '
+                             'the hash index, of this build or of an earlier one.',
+                        choices=['drop', 'count'],
+                        required=False, default=None)
+
+    parser.add_argument('--dedup_index_path', dest='dedup_index_path',
+                        help='Path of the hash index, defaults to sha256-index.npy in the '
+                             'output directory.',
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--backend', dest='backend',
+                        help='Write the records with `tensorflow`, or with `python` that does '
+                             'not need tensorflow and codes the images with Pillow.',
+                        choices=['tensorflow', 'python'],
+                        required=False, default='tensorflow')
+
+    parser.add_argument('--profile', dest='profile',
+                        help='Features written to every record: `classification`, `detection`, '
+                             '`keypoints` or `full`.',
+                        choices=list(PROFILES),
+                        required=False, default='full')
+
+    parser.add_argument('--storage_options', dest='storage_options',
+                        help='JSON dict of the options of the fsspec filesystem of a remote '
+                             '--output_dir, e.g. \'{"client_kwargs": {"endpoint_url": '
+                             '"http://127.0.0.1:5000"}}\'.',
+                        type=json.loads, required=False, default=None)
+
+    parser.add_argument('--staging_dir', dest='staging_directory',
+                        help='Local directory of the shards of a remote --output_dir until '
+                             'they are uploaded, a temporary directory by default.',
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--upload_threads', dest='upload_threads',
+                        help='Number of concurrent uploads to a remote --output_dir.',
+                        type=int, required=False, default=8)
+
+    parser.add_argument('--upload_retries', dest='upload_retries',
+                        help='Number of retries of a failed upload.',
+                        type=int, required=False, default=5)
+
+    parser.add_argument('--max_staging_mb', dest='max_staging_mb',
+                        help='Only start a new shard while the shards waiting for their upload '
+                             'take less than this many megabytes.',
+                        type=float, required=False, default=None)
+
+    parser.add_argument('--metrics_path', dest='metrics_path',
+                        help='JSON-Lines file to append the throughput and stage timings of '
+                             'the build to, every --metrics_interval seconds.',
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--prometheus_path', dest='prometheus_path',
+                        help='Prometheus textfile to write the same metrics to.',
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--metrics_interval', dest='metrics_interval',
+                        help='Seconds between two reports of the metrics.',
+                        type=float, required=False, default=10.)
+
     parsed_args = parser.parse_args()
 
     return parsed_args
@@ -467,8 +2275,15 @@ def main():
 
     args = parse_args()
 
-    with open(args.dataset_path) as f:
-        dataset = json.load(f)
+    if args.dataset_path.endswith('.jsonl'):
+        # stream the manifest instead of loading it
+        dataset = args.dataset_path
+    else:
+        with open(args.dataset_path) as f:
+            dataset = json.load(f)
+        # a mimicked structure json of dataset_utils holds the list in "images"
+        if isinstance(dataset, dict):
+            dataset = dataset['images']
 
     errors = create(
         dataset=dataset,
@@ -477,7 +2292,31 @@ def main():
         num_shards=args.num_shards,
         num_threads=args.num_threads,
         shuffle=args.shuffle,
-        store_images=args.store_images
+        store_images=args.store_images,
+        executor=args.executor,
+        verify_decode_rate=args.verify_decode_rate,
+        transcode=args.transcode,
+        quality=args.quality,
+        png_compression=args.png_compression,
+        shuffle_buffer_size=args.shuffle_buffer_size,
+        target_shard_mb=args.target_shard_mb,
+        seed=args.seed,
+        resume=args.resume,
+        dedup=args.dedup,
+        dedup_index_path=args.dedup_index_path,
+        backend=args.backend,
+        profile=args.profile,
+        queue_size=args.queue_size,
+        num_io_threads=args.num_io_threads,
+        num_writer_threads=args.num_writer_threads,
+        storage_options=args.storage_options,
+        staging_directory=args.staging_directory,
+        upload_threads=args.upload_threads,
+        upload_retries=args.upload_retries,
+        max_staging_mb=args.max_staging_mb,
+        metrics_path=args.metrics_path,
+        prometheus_path=args.prometheus_path,
+        metrics_interval=args.metrics_interval
     )
 
     return errors
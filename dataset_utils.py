@@ -1,7 +1,123 @@
 import os, sys
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 import json
 
+# Version of the mimicked structure json written by `save_dataset_structure`. The first
+# version was the list of the image dicts only.
+DATASET_STRUCTURE_VERSION = 2
+
+def _list_dir(abs_dir, lowered_filter_ext, with_stats):
+    """
+    List a directory in natural sorted order.
+    Returns:
+        tuple: (files, subdirs), the names of the files, or [name, size, mtime] lists
+            with `with_stats`, and the names of the subdirectories.
+    """
+    from natsort import natsorted
+
+    with os.scandir(abs_dir) as dir_entries:
+        entries = natsorted(dir_entries, key=lambda entry: entry.name)
+
+    files, subdirs = [], []
+    for entry in entries:
+        if entry.is_dir():
+            # like os.walk, symlinks to directories are not followed
+            if not entry.is_symlink():
+                subdirs.append(entry.name)
+            continue
+
+        if lowered_filter_ext and not entry.name.lower().endswith(lowered_filter_ext):
+            continue
+
+        if with_stats:
+            stat = entry.stat()
+            files.append([entry.name, stat.st_size, stat.st_mtime])
+        else:
+            files.append(entry.name)
+
+    return files, subdirs
+
+def _stat_files(abs_dir, names):
+    """
+    The [name, size, mtime] lists of files of a directory, None if one of them is gone.
+    """
+    files = []
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(abs_dir, name))
+        except FileNotFoundError:
+            return None
+        files.append([name, stat.st_size, stat.st_mtime])
+    return files
+
+def _scan_dir(abs_dir, rel_dir, depth, mindepth, maxdepth, lowered_filter_ext,
+              return_relative_path, with_stats, cached_directories, scanned_directories):
+    """
+    Yield the files of `abs_dir`, then recurse into its subdirectories, in natural sorted order.
+    `rel_dir` is the path of `abs_dir` relative to the scanned root, ending with a separator.
+    """
+    if scanned_directories is None:
+        files, subdirs = _list_dir(abs_dir, lowered_filter_ext, with_stats)
+    else:
+        # Adding, removing or renaming an entry changes the mtime of its directory, so a
+        # directory with the mtime it was cached with still has the cached entries. Editing
+        # a file in place does not, so the files are always stat'ed again.
+        mtime_ns = os.stat(abs_dir).st_mtime_ns
+        directory = cached_directories.get(abs_dir)
+        files = None
+        if directory is not None and directory["mtime_ns"] == mtime_ns:
+            files = _stat_files(abs_dir, [file[0] for file in directory["files"]])
+        if files is None:
+            files, subdirs = _list_dir(abs_dir, lowered_filter_ext, with_stats=True)
+        else:
+            subdirs = directory["subdirs"]
+        directory = {"mtime_ns": mtime_ns, "files": files, "subdirs": subdirs}
+        scanned_directories[abs_dir] = directory
+        files, subdirs = directory["files"], directory["subdirs"]
+
+    if depth >= mindepth:
+        for file in files:
+            name = file if isinstance(file, str) else file[0]
+            path = rel_dir + name if return_relative_path else os.path.join(abs_dir, name)
+            if with_stats:
+                yield path, file[1], file[2]
+            else:
+                yield path
+
+    if depth < maxdepth:
+        for subdir in subdirs:
+            yield from _scan_dir(
+                os.path.join(abs_dir, subdir), rel_dir + subdir + os.path.sep, depth + 1,
+                mindepth, maxdepth, lowered_filter_ext, return_relative_path, with_stats,
+                cached_directories, scanned_directories
+            )
+
+def scan_files(root_dir, mindepth = 1, maxdepth = float('inf'), filter_ext=[], return_relative_path=False,
+               with_stats=False, cached_directories=None, scanned_directories=None):
+    """
+    Generator version of `list_files`, built on `os.scandir`: the files are yielded as the
+    directories are listed, in a deterministic natural sorted order. The files of a
+    directory come first, then those of each of its subdirectories.
+
+    with_stats(bool): Default false. If true yield (path, size, mtime) tuples instead of
+        paths, from the stat call of the directory entry.
+    cached_directories(dict, optional): the `scanned_directories` of an earlier scan. A
+        directory whose mtime did not change since is not listed again, the names of its
+        cached files and subdirectories are used. The files are stat'ed again either way,
+        editing a file in place does not change the mtime of its directory.
+    scanned_directories(dict, optional): filled with the mtime, files and subdirectories of
+        every scanned directory, keyed by path. Pass it to cache the scan.
+    """
+    root_dir = os.path.normcase(root_dir)
+    lowered_filter_ext = tuple([ext.lower() for ext in filter_ext])
+    if cached_directories is not None and scanned_directories is None:
+        raise ValueError("Pass scanned_directories to scan with cached_directories.")
+
+    yield from _scan_dir(root_dir, "", 1, mindepth, maxdepth, lowered_filter_ext,
+                         return_relative_path, with_stats, cached_directories or {},
+                         scanned_directories)
+
 def list_files(root_dir, mindepth = 1, maxdepth = float('inf'), filter_ext=[], return_relative_path=False):
     """
     Usage:
@@ -9,7 +125,8 @@ def list_files(root_dir, mindepth = 1, maxdepth = float('inf'), filter_ext=[], r
     d = get_all_files(rootdir, mindepth = 1, maxdepth = 2)
 
     This returns a list of all files of a directory, including all files in
-    subdirectories. Full paths are returned.
+    subdirectories. Full paths are returned. See `scan_files` to iterate over
+    them instead.
 
     WARNING: this may create a very large list if many files exists in the 
     directory and subdirectories. Make sure you set the maxdepth appropriately.
@@ -25,33 +142,31 @@ def list_files(root_dir, mindepth = 1, maxdepth = float('inf'), filter_ext=[], r
     filter_ext(list, optional) :  filter files ex. [".jpg", ".jpeg", ".png"]
     return_relative_path(bool): Default false. If true return relative path else return absolute path
     """
-    root_dir = os.path.normcase(root_dir)
-    file_paths = []
-    root_depth = root_dir.rstrip(os.path.sep).count(os.path.sep) - 1
-    lowered_filter_ext = tuple([ext.lower() for ext in filter_ext])
+    return list(scan_files(root_dir, mindepth, maxdepth, filter_ext, return_relative_path))
+
+def scan_class_folders(dataset_dir, class_folders, filter_ext=[], with_stats=False, num_threads=8,
+                       cached_directories=None, scanned_directories=None):
+    """
+    Scan the class folders of a dataset concurrently, with a pool of `num_threads` threads.
 
-    for abs_dir, dirs, files in sorted(os.walk(root_dir)):
-        depth = abs_dir.count(os.path.sep) - root_depth
-        if mindepth <= depth <= maxdepth:
-            for filename in files:
-                if filter_ext:
-                    if not filename.lower().endswith(lowered_filter_ext):
-                        continue
-
-                if return_relative_path:
-                    rel_dir = os.path.relpath(abs_dir, root_dir)
-                    if rel_dir == ".":
-                        file_paths.append(filename)
-                    else:
-                        file_paths.append(os.path.join(rel_dir, filename))
-                else:
-                    # append full absolute path
-                    file_paths.append(os.path.join(abs_dir, filename))
-
-        elif depth > maxdepth:
-            # del dirs[:] 
-            pass
-    return file_paths
+    Yields (class_folder, files) tuples in the order of `class_folders`, as soon as the
+    folder and those before it are scanned. files is the list of the paths, relative to
+    the class folder, or (path, size, mtime) tuples with `with_stats`. See `scan_files`
+    for `cached_directories` and `scanned_directories`.
+    """
+    def scan(class_folder):
+        return list(scan_files(
+            os.path.join(dataset_dir, class_folder),
+            filter_ext=filter_ext,
+            return_relative_path=True,
+            with_stats=with_stats,
+            cached_directories=cached_directories,
+            scanned_directories=scanned_directories
+        ))
+
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        for class_folder, files in zip(class_folders, executor.map(scan, class_folders)):
+            yield class_folder, files
 
 def _get_folder_labels(dataset_dir, skip_hidden=True):
     """
@@ -75,6 +190,39 @@ def _get_folder_labels(dataset_dir, skip_hidden=True):
 
     return sorted(class_names)
 
+def load_dataset_structure(filepath):
+    """
+    Load a mimicked structure json, of any version.
+
+    Returns:
+        dict: {"version", "directories", "images"}, the image dicts and the scanned
+            directories, see `scan_files`. The first version has no directories.
+    """
+    with open(filepath) as f:
+        structure = json.load(f)
+
+    if isinstance(structure, list):
+        return {"version": 1, "directories": {}, "images": structure}
+    if structure.get("version", 0) > DATASET_STRUCTURE_VERSION:
+        raise ValueError(
+            f"{filepath} has version {structure['version']}, only versions up to "
+            f"{DATASET_STRUCTURE_VERSION} can be read."
+        )
+    return structure
+
+def save_dataset_structure(filepath, images, directories=None):
+    """
+    Write a mimicked structure json: the image dicts and, to cache the scan of the
+    dataset, its scanned directories.
+    """
+    structure = {
+        "version": DATASET_STRUCTURE_VERSION,
+        "directories": directories or {},
+        "images": images,
+    }
+    with open(filepath, 'w') as fout:
+        json.dump(structure, fout)
+
 def encode_labels_sklearn(lst_classnames):
     from sklearn import preprocessing
     le = preprocessing.LabelEncoder()
@@ -85,11 +233,21 @@ def parse_dataset_mimic_final_structure(
         dataset_dir, explicit_labels=set(), 
         store_mimicked_structure_json=False, mimicked_json_filepath=None,
         silent_on_extra_explicit_labels=False, show_labels_int_mapping=True,
-        save_labels=True, labels_out_filepath=None,
+        save_labels=True, labels_out_filepath=None, collect_file_stats=False,
+        scan_threads=8, scan_cache=None, scanned_directories=None,
     ):
     """
     Iterate dataset and build structure for tfrecords
     Each dict represents an image and should have a structure that mimics the tfrecord structure.
+
+    collect_file_stats(bool): Default false. If true add the "size" and "mtime" of every image
+        file to its dict, so a later build can tell which images changed.
+    scan_threads(int): Default 8. Number of class folders scanned concurrently.
+    scan_cache(dict, optional): an earlier structure, see `load_dataset_structure`. The
+        directories that did not change since are not listed again, and the images that
+        did not change keep their ids. New images get ids after the largest cached id.
+    scanned_directories(dict, optional): filled with the scanned directories, see
+        `scan_files`. The scan is cached in the mimicked structure json either way.
     """
     if explicit_labels:
         logger.info(f"Explicit labels: {explicit_labels}")
@@ -153,42 +311,111 @@ def parse_dataset_mimic_final_structure(
 
     lst_data_dicts = [] # holds dataset structure
     image_index = 0 # index number of image, increase after adding it in list
-    for idx, label_text in enumerate(labels):
-        class_folderpath = os.path.join(dataset_dir, label_text)
 
-        # list all image files of class folder
-        lst_imagefiles = list_files(
-            class_folderpath, 
-            filter_ext=[".jpg", ".jpeg", ".png"],
-            return_relative_path=True
-        )
+    # ids of the cached images, by filename, size and mtime
+    cached_ids = {}
+    if scan_cache is not None:
+        for image_data in scan_cache["images"]:
+            cached_ids[(image_data["filename"], image_data.get("size"), image_data.get("mtime"))] = \
+                image_data["id"]
+        image_index = 1 + max([int(image_id) for image_id in cached_ids.values()] or [-1])
+
+    if scanned_directories is None:
+        scanned_directories = {}
+    scanned_class_folders = scan_class_folders(
+        dataset_dir,
+        labels,
+        filter_ext=[".jpg", ".jpeg", ".png"],
+        with_stats=True,
+        num_threads=scan_threads,
+        cached_directories=scan_cache["directories"] if scan_cache is not None else None,
+        scanned_directories=scanned_directories
+    )
+    for idx, (label_text, lst_imagefiles) in enumerate(scanned_class_folders):
+        class_folderpath = os.path.join(dataset_dir, label_text)
 
         logger.info(f"Total {len(lst_imagefiles)} images found in {class_folderpath}")
 
-        for imagefile in lst_imagefiles:
+        for imagefile, size, mtime in lst_imagefiles:
             image_abs_path = os.path.join(class_folderpath, imagefile)
+            image_id = cached_ids.get((image_abs_path, size, mtime))
+            if image_id is None:
+                image_id = image_index
+                # increase image index
+                image_index += 1
             image_data = {
                 "filename" : image_abs_path, 
-                "id" : image_index,
+                "id" : image_id,
                 "class" : {
                     "label" : idx,
                     "text": label_text # optional
                 }
             }
+            if collect_file_stats:
+                image_data["size"] = size
+                image_data["mtime"] = mtime
             lst_data_dicts.append(image_data)
-            # increase image index
-            image_index += 1
 
     if store_mimicked_structure_json:
         if not mimicked_json_filepath:
             mimicked_json_filepath = os.path.join(dataset_dir, "mimicked_structure.json")
 
-        with open(mimicked_json_filepath, 'w') as fout:
-            json.dump(lst_data_dicts , fout)
+        save_dataset_structure(mimicked_json_filepath, lst_data_dicts, scanned_directories)
 
     return lst_data_dicts
 
 
+def diff_dataset_structures(previous_data_dicts, current_data_dicts):
+    """
+    Compare the structure of the previous build of a dataset with its current structure.
+
+    Images are matched by filename, an image whose "size" or "mtime" changed is both
+    removed and added. Images that are kept keep the id of the previous build, added
+    images get new ids after the largest id of the previous build.
+
+    Returns:
+        tuple: (kept, added, removed) lists of image dicts. kept and added hold the
+            current dicts with their final ids, removed holds the previous dicts.
+    """
+    previous_by_filename = {}
+    for image_data in previous_data_dicts:
+        previous_by_filename[image_data["filename"]] = image_data
+
+    next_id = 1 + max([int(image_data["id"]) for image_data in previous_data_dicts] or [-1])
+
+    kept, added = [], []
+    current_filenames = set()
+    for image_data in current_data_dicts:
+        current_filenames.add(image_data["filename"])
+        previous = previous_by_filename.get(image_data["filename"])
+        unchanged = previous is not None and all(
+            previous.get(key) == image_data.get(key) for key in ("size", "mtime")
+        )
+        if unchanged:
+            if previous["class"]["label"] != image_data["class"]["label"]:
+                raise ValueError(
+                    f"Label of {image_data['filename']} changed from {previous['class']['label']} "
+                    f"to {image_data['class']['label']}, the labels order changed. "
+                    f"Rebuild the dataset instead of updating it."
+                )
+            image_data["id"] = previous["id"]
+            kept.append(image_data)
+        else:
+            image_data["id"] = next_id
+            next_id += 1
+            added.append(image_data)
+
+    # deleted images, and the previous version of changed images
+    added_filenames = set(image_data["filename"] for image_data in added)
+    removed = [
+        image_data for image_data in previous_data_dicts
+        if image_data["filename"] not in current_filenames
+        or image_data["filename"] in added_filenames
+    ]
+
+    return kept, added, removed
+
+
 def main():
     dataset_train_dir = "dataset_sample/train"
     # classes = _get_folder_labels(dataset_train_dir)
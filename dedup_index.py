@@ -0,0 +1,125 @@
+"""
+A persistent index of image content hashes, to drop or count duplicate images.
+
+The index holds the sha256 digest of every stored image, the same digest that is
+written to `image/key/sha256`. It is saved as a `.npy` file holding a sorted
+(num_digests, 32) uint8 array. The saved digests are memory mapped, and only their
+first 8 bytes are kept in memory as a sorted uint64 array, so looking up a digest is a
+binary search followed by an exact comparison of the few digests that share its prefix.
+"""
+
+import os
+import threading
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+
+DIGEST_SIZE = 32
+
+
+class HashIndex(object):
+    """Set of image digests, loaded from and saved to a `.npy` file.
+
+    `add` is thread safe. To share one index between processes, serve it from a
+    `HashIndexManager`.
+    """
+
+    def __init__(self, path=None):
+        """
+        Args:
+          path: string, path of the `.npy` index file. The digests already saved there
+            are loaded, it is created on `save` if it does not exist.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # digests added since the index was loaded or saved
+        self._new_digests = set()
+
+        digests = np.zeros((0, DIGEST_SIZE), dtype=np.uint8)
+        if path is not None and os.path.exists(path):
+            digests = np.load(path, mmap_mode='r')
+            if digests.ndim != 2 or digests.shape[1] != DIGEST_SIZE or digests.dtype != np.uint8:
+                raise ValueError('%s is not a sha256 index, it holds a %s array of shape %s.' %
+                                 (path, digests.dtype, digests.shape))
+        self._set_saved_digests(digests)
+
+    def _set_saved_digests(self, digests):
+        self._saved_digests = digests
+        # The digests are sorted, so their big-endian 8 byte prefixes are sorted too.
+        self._saved_prefixes = np.ascontiguousarray(digests[:, :8]).view('>u8').ravel()
+
+    def _is_saved(self, digest):
+        prefix = int.from_bytes(digest[:8], 'big')
+        start = np.searchsorted(self._saved_prefixes, prefix, side='left')
+        end = np.searchsorted(self._saved_prefixes, prefix, side='right')
+        for i in range(start, end):
+            if self._saved_digests[i].tobytes() == digest:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self._saved_digests) + len(self._new_digests)
+
+    def __contains__(self, digest):
+        with self._lock:
+            return digest in self._new_digests or self._is_saved(digest)
+
+    def add(self, digest):
+        """Add a digest to the index.
+        Args:
+          digest: bytes, the 32 byte sha256 digest of an image.
+        Returns:
+          bool : True if the digest is new, False if it was already in the index.
+        """
+        if len(digest) != DIGEST_SIZE:
+            raise ValueError('Expected a %d byte digest, got %d bytes.' % (DIGEST_SIZE, len(digest)))
+        with self._lock:
+            if digest in self._new_digests or self._is_saved(digest):
+                return False
+            self._new_digests.add(digest)
+            return True
+
+    def save(self, path=None):
+        """Merge the new digests into the saved ones and write the index.
+        Args:
+          path: string, where to write the index, defaults to the path it was loaded from.
+        Returns:
+          integer : the number of digests in the index.
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError('The index has no path to be saved to.')
+
+        with self._lock:
+            new_digests = np.frombuffer(b''.join(self._new_digests), dtype=np.uint8)
+            digests = np.concatenate([np.asarray(self._saved_digests),
+                                      new_digests.reshape(-1, DIGEST_SIZE)])
+            # lexsort sorts by its last key first, so the first byte goes last.
+            digests = digests[np.lexsort(digests.T[::-1])]
+
+            # Write next to the index and rename, a reader never sees a partial index.
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, digests)
+            os.replace(tmp_path, path)
+
+            self.path = path
+            self._new_digests = set()
+            self._set_saved_digests(digests)
+
+            return len(digests)
+
+
+class HashIndexManager(BaseManager):
+    """Serves a HashIndex to worker processes, e.g.
+
+        manager = HashIndexManager(ctx=multiprocessing.get_context('spawn'))
+        manager.start()
+        hash_index = manager.HashIndex(path)
+
+    The proxy can be passed to the workers, every `add` is run by the manager process.
+    """
+
+
+HashIndexManager.register('HashIndex', HashIndex,
+                          exposed=('add', 'save', '__len__', '__contains__'))
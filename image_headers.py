@@ -0,0 +1,114 @@
+"""
+Read image dimensions from the encoded image headers.
+
+Decoding a whole image just to learn its size is most of the work done per image
+when creating tfrecords. The JPEG start-of-frame (SOF) segment and the PNG IHDR chunk
+already hold the height, width and number of channels, so they are read directly
+from the encoded bytes instead.
+"""
+
+import struct
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG color type -> number of channels
+_PNG_COLOR_TYPE_CHANNELS = {
+    0: 1, # grayscale
+    2: 3, # RGB
+    3: 3, # palette
+    4: 2, # grayscale + alpha
+    6: 4, # RGBA
+}
+
+# SOF0 - SOF15, except DHT (0xC4), JPG (0xC8) and DAC (0xCC) which share the range
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Markers that stand alone, without a length field: TEM, RST0 - RST7, SOI
+_JPEG_STANDALONE_MARKERS = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+
+
+def _read_png_header(image_data):
+    """Read the IHDR chunk of a PNG image.
+    Args:
+      image_data: bytes, PNG encoded image.
+    Returns:
+      tuple : (height, width, channels)
+    """
+    # signature (8) + chunk length (4) + chunk type (4) + width (4) + height (4)
+    # + bit depth (1) + color type (1)
+    if len(image_data) < 26 or image_data[12:16] != b'IHDR':
+        raise ValueError('PNG image has no IHDR chunk')
+
+    width, height = struct.unpack('>II', image_data[16:24])
+    color_type = image_data[25]
+    if color_type not in _PNG_COLOR_TYPE_CHANNELS:
+        raise ValueError('PNG image has unknown color type %d' % (color_type,))
+
+    return height, width, _PNG_COLOR_TYPE_CHANNELS[color_type]
+
+
+def _read_jpeg_header(image_data):
+    """Read the start-of-frame segment of a JPEG image.
+    Args:
+      image_data: bytes, JPEG encoded image.
+    Returns:
+      tuple : (height, width, channels)
+    """
+    data_length = len(image_data)
+    offset = 2
+    while offset < data_length:
+        # Every marker starts with 0xFF, possibly padded with extra 0xFF fill bytes.
+        if image_data[offset] != 0xFF:
+            raise ValueError('JPEG image has a corrupt marker at byte %d' % (offset,))
+        while offset < data_length and image_data[offset] == 0xFF:
+            offset += 1
+        if offset >= data_length:
+            break
+
+        marker = image_data[offset]
+        offset += 1
+
+        if marker in _JPEG_STANDALONE_MARKERS:
+            continue
+        if marker == 0xD9 or marker == 0xDA:
+            # End of image, or start of the entropy coded scan data: no SOF before it.
+            break
+        if offset + 2 > data_length:
+            break
+
+        segment_length = struct.unpack('>H', image_data[offset:offset + 2])[0]
+        if marker in _JPEG_SOF_MARKERS:
+            # length (2) + precision (1) + height (2) + width (2) + components (1)
+            if offset + 8 > data_length:
+                break
+            height, width = struct.unpack('>HH', image_data[offset + 3:offset + 7])
+            channels = image_data[offset + 7]
+            if height == 0 or width == 0:
+                raise ValueError('JPEG image has no dimensions in its SOF segment')
+            return height, width, channels
+
+        offset += segment_length
+
+    raise ValueError('JPEG image has no SOF segment')
+
+
+def read_image_header(image_data):
+    """Read the dimensions of an encoded image without decoding it.
+    Args:
+      image_data: bytes, JPEG or PNG encoded image.
+    Returns:
+      tuple : (height, width, channels, image_format), where image_format is
+        `JPEG` or `PNG`.
+    Raises:
+      ValueError: if the image is not a JPEG or PNG or its header can not be read.
+    """
+    image_data = memoryview(image_data)
+    if image_data[:8] == _PNG_SIGNATURE:
+        height, width, channels = _read_png_header(image_data)
+        return height, width, channels, 'PNG'
+
+    if image_data[:2] == b'\xff\xd8':
+        height, width, channels = _read_jpeg_header(image_data)
+        return height, width, channels, 'JPEG'
+
+    raise ValueError('Image is neither a JPEG nor a PNG')
@@ -1,147 +1,256 @@
 from __future__ import absolute_import
 
+import collections
+import functools
+
 import tensorflow as tf
 
-def decode_serialized_example(serialized_example, features_to_fetch, decode_image=True):
+try:
+    from metrics import REGISTRY
+    from tfrecord_schema import FEATURES_BY_KEY, profile_keys, written_profile
+except ImportError:
+    from tfrecords_creater.metrics import REGISTRY
+    from tfrecords_creater.tfrecord_schema import FEATURES_BY_KEY, profile_keys, written_profile
+
+_FEATURE_DTYPES = {'int64': tf.int64, 'float': tf.float32, 'bytes': tf.string}
+
+# The functions of the pipeline have no python control flow on tensors, converting them
+# with autograph would only take about a second more to build the pipeline.
+_do_not_convert = tf.autograph.experimental.do_not_convert
+
+
+def _feature_spec(feature_key):
+    """The parsing spec of a feature of tfrecord_schema."""
+    feature = FEATURES_BY_KEY[feature_key]
+    if feature.fixed_len:
+        return tf.io.FixedLenFeature([], _FEATURE_DTYPES[feature.dtype])
+    return tf.io.VarLenFeature(dtype=_FEATURE_DTYPES[feature.dtype])
+
+
+# Parse plan of a features_to_fetch tuple, see `_parse_plan`.
+_ParsePlan = collections.namedtuple('_ParsePlan', ['feature_map', 'outputs'])
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_parse_plan(features_to_fetch, profile):
+    written_keys = profile_keys(profile)
+    missing_keys = [feature_key for feature_key, _ in features_to_fetch
+                    if feature_key not in written_keys]
+    if missing_keys:
+        raise ValueError('The %s profile does not write %s' % (profile, ', '.join(missing_keys)))
+
+    feature_map = {}
+    outputs = []
+    for feature_key, feature_name in features_to_fetch:
+        feature_map[feature_key] = _feature_spec(feature_key)
+        outputs.append((feature_key, feature_name, not FEATURES_BY_KEY[feature_key].fixed_len))
+    return _ParsePlan(feature_map, tuple(outputs))
+
+
+def _parse_plan(features_to_fetch, profile='full'):
+    """
+    The parse plan of a list of features to fetch, built once per distinct list.
+    Args:
+        features_to_fetch : a list of tuples (feature key, name for feature)
+        profile : the tfrecord_schema profile the records were written with, every
+            fetched feature must be part of it.
+    Returns:
+        _ParsePlan : `feature_map`, the parsing specs of only the fetched features, and
+            `outputs`, a (feature key, name, is variable length) tuple per fetched feature.
+    """
+    return _cached_parse_plan(tuple((feature_key, feature_name)
+                                    for feature_key, feature_name in features_to_fetch),
+                              profile)
+
+
+def _decode_rgb(encoded_image):
+    """Decode a JPEG, PNG or WebP image, as stored by the transcode policies, as RGB."""
+    def decode_webp():
+        # the WebP decoder only gives the channels of the image, RGB or RGBA
+        return tf.io.decode_image(encoded_image, expand_animations=False)[:, :, :3]
+
+    def decode_jpeg_or_png():
+        return tf.io.decode_image(encoded_image, channels=3, expand_animations=False)
+
+    is_webp = tf.equal(tf.strings.substr(encoded_image, 8, 4), b'WEBP')
+    image = tf.cond(is_webp, decode_webp, decode_jpeg_or_png)
+    image.set_shape([None, None, 3])
+    return image
+
+
+def decode_serialized_example(serialized_example, features_to_fetch, decode_image=True,
+                              profile='full'):
     """
     Args:
         serialized_example : A tfrecord example
         features_to_fetch : a list of tuples (feature key, name for feature)
+        decode_image : decode `image/encoded` as an RGB image, if it is fetched.
+        profile : the tfrecord_schema profile the example was written with.
     Returns:
         dictionary : maps name to parsed example
     """
+    plan = _parse_plan(features_to_fetch, profile)
 
-    feature_map = {}
-    for feature_key, feature_name in features_to_fetch:
-        feature_map[feature_key] = {
-            'image/height': tf.FixedLenFeature([], tf.int64),
-            'image/width': tf.FixedLenFeature([], tf.int64),
-            'image/colorspace': tf.FixedLenFeature([], tf.string),
-            'image/channels': tf.FixedLenFeature([], tf.int64),
-            'image/format': tf.FixedLenFeature([], tf.string),
-            'image/filename': tf.FixedLenFeature([], tf.string),
-            'image/id': tf.FixedLenFeature([], tf.string),
-            'image/encoded': tf.FixedLenFeature([], tf.string),
-            'image/extra': tf.FixedLenFeature([], tf.string),
-            'image/class/label': tf.FixedLenFeature([], tf.int64),
-            'image/class/text': tf.FixedLenFeature([], tf.string),
-            'image/class/conf':  tf.FixedLenFeature([], tf.float32),
-            'image/object/bbox/xmin': tf.VarLenFeature(dtype=tf.float32),
-            'image/object/bbox/xmax': tf.VarLenFeature(dtype=tf.float32),
-            'image/object/bbox/ymin': tf.VarLenFeature(dtype=tf.float32),
-            'image/object/bbox/ymax': tf.VarLenFeature(dtype=tf.float32),
-            'image/object/bbox/label': tf.VarLenFeature(dtype=tf.int64),
-            'image/object/bbox/text': tf.VarLenFeature(dtype=tf.string),
-            'image/object/bbox/conf': tf.VarLenFeature(dtype=tf.float32),
-            'image/object/bbox/score' : tf.VarLenFeature(dtype=tf.float32),
-            'image/object/parts/x' : tf.VarLenFeature(dtype=tf.float32),
-            'image/object/parts/y' : tf.VarLenFeature(dtype=tf.float32),
-            'image/object/parts/v' : tf.VarLenFeature(dtype=tf.int64),
-            'image/object/parts/score' : tf.VarLenFeature(dtype=tf.float32),
-            'image/object/count' : tf.FixedLenFeature([], tf.int64),
-            'image/object/area' : tf.VarLenFeature(dtype=tf.float32),
-            'image/object/id' : tf.VarLenFeature(dtype=tf.string)
-        }[feature_key]
-
-    features = tf.parse_single_example(
+    # Only the fetched features are parsed, the image is left alone unless it is fetched.
+    features = tf.io.parse_single_example(
       serialized_example,
-      features = feature_map
+      features = plan.feature_map
     )
 
     # return a dictionary of the features
     parsed_features = {}
 
-    for feature_key, feature_name in features_to_fetch:
-        if feature_key == 'image/height':
-            parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/width':
-            parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/colorspace':
-            parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/channels':
-            parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/format':
-            parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/filename':
-            parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/id':
-            parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/encoded':
-            if decode_image:
-                parsed_features[feature_name] = tf.image.decode_jpeg(features[feature_key], channels=3)
-            else:
-                parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/extra':
-            parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/class/label':
-            parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/class/text':
-            parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/class/conf':
-            parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/object/bbox/xmin':
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/bbox/xmax':
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/bbox/ymin':
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/bbox/ymax':
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/bbox/label':
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/bbox/text':
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/bbox/conf':
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/bbox/score' :
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/parts/x' :
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/parts/y' :
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/parts/v' :
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/parts/score' :
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/count' :
-            parsed_features[feature_name] = features[feature_key]
-        elif feature_key == 'image/object/area' :
-            parsed_features[feature_name] = features[feature_key].values
-        elif feature_key == 'image/object/id' :
-            parsed_features[feature_name] = features[feature_key].values
+    for feature_key, feature_name, var_len in plan.outputs:
+        feature = features[feature_key]
+        if var_len:
+            feature = feature.values
+        elif feature_key == 'image/encoded' and decode_image:
+            feature = _decode_rgb(feature)
+        parsed_features[feature_name] = feature
 
     return parsed_features
 
 
-def yield_record(tfrecords, features_to_extract):
+def decode_serialized_examples(serialized_examples, features_to_fetch, profile='full'):
+    """
+    Parse a batch of tfrecord examples at once, without decoding the images.
+    Args:
+        serialized_examples : a 1-D string tensor of tfrecord examples
+        features_to_fetch : a list of tuples (feature key, name for feature)
+        profile : the tfrecord_schema profile the examples were written with.
+    Returns:
+        dictionary : maps name to the batch of parsed features, a SparseTensor for the
+            variable length features
+    """
+    features = tf.io.parse_example(
+        serialized_examples,
+        features=_parse_plan(features_to_fetch, profile).feature_map
+    )
+    return dict((feature_name, features[feature_key])
+                for feature_key, feature_name in features_to_fetch)
+
+
+def _densify(parsed_features, batch_size):
+    """Replace every SparseTensor of a parsed batch by a (dense values, lengths) pair."""
+    outputs = {}
+    for feature_name, feature in parsed_features.items():
+        if isinstance(feature, tf.SparseTensor):
+            lengths = tf.math.bincount(tf.cast(feature.indices[:, 0], tf.int32),
+                                       minlength=batch_size, maxlength=batch_size)
+            feature = (tf.sparse.to_dense(feature), lengths[:feature.dense_shape[0]])
+        outputs[feature_name] = feature
+    return outputs
 
-    with tf.device('/cpu:0'):
 
-        filename_queue = tf.train.string_input_producer(
-            tfrecords,
-            num_epochs=1
-        )
+def make_dataset(tfrecords, features_to_fetch, decode_image=True, num_readers=4,
+                 num_parsers=4, batch_size=256, prefetch=2, profile=None):
+    """
+    A tf.data pipeline over tfrecord files: the files are read in parallel, interleaving
+    `num_readers` files, and the examples are parsed by `num_parsers` parallel calls.
+    Args:
+        tfrecords : list of paths to tfrecord files
+        features_to_fetch : a list of tuples (feature key, name for feature)
+        decode_image : decode `image/encoded`, if it is fetched, as an RGB image.
+        num_readers : number of files read in parallel.
+        num_parsers : number of parallel parsing calls.
+        batch_size : number of examples parsed at once, when the images are not decoded.
+        prefetch : number of elements prepared ahead of the consumer.
+        profile : the tfrecord_schema profile the records were written with, see
+            `create_tfrecords.create`. Fetching a feature it does not write is an error.
+            Defaults to the profile in the summaries of the builds of the files, and to
+            `full` if they do not record it.
+    Returns:
+        tf.data.Dataset : when images are decoded its elements are single examples, see
+            `decode_serialized_example`, otherwise batches of up to `batch_size` examples of
+            a single file, see `decode_serialized_examples`.
+    """
+    if profile is None:
+        profile = written_profile(tfrecords) or 'full'
+    # Check the features against the profile before building the pipeline.
+    _parse_plan(features_to_fetch, profile)
+
+    files = tf.data.Dataset.from_tensor_slices(list(tfrecords))
 
-        # Construct a Reader to read examples from the .tfrecords file
-        reader = tf.TFRecordReader()
-        _, serialized_example = reader.read(filename_queue)
+    decode_images = decode_image and any(
+        feature_key == 'image/encoded' for feature_key, _ in features_to_fetch)
+    if decode_images:
+        # Images have different sizes, so they are decoded and delivered one at a time.
+        records = files.interleave(tf.data.TFRecordDataset, cycle_length=num_readers,
+                                   block_length=1, num_parallel_calls=num_readers)
+        dataset = records.map(_do_not_convert(
+            lambda record: decode_serialized_example(record, features_to_fetch, True, profile)),
+            num_parallel_calls=num_parsers)
+    else:
+        # Every file is batched before the interleave, which then moves a batch at a time
+        # instead of every record. A batch holds the records of a single file.
+        batches = files.interleave(_do_not_convert(
+            lambda tfrecord: tf.data.TFRecordDataset(tfrecord).batch(batch_size)),
+            cycle_length=num_readers, block_length=1, num_parallel_calls=num_readers)
+        dataset = batches.map(_do_not_convert(
+            lambda records: decode_serialized_examples(records, features_to_fetch, profile)),
+            num_parallel_calls=num_parsers)
 
-        features = decode_serialized_example(serialized_example, features_to_extract)	
+    return dataset.prefetch(prefetch)
 
-    coord = tf.train.Coordinator()
-    with tf.Session() as sess:
 
-        tf.global_variables_initializer().run()
-        tf.local_variables_initializer().run()
-        tf.train.start_queue_runners(sess=sess, coord=coord)
+def _iterate_dataset(dataset):
+    """Yield the elements of a dataset as numpy values, eagerly or with a Session."""
+    if tf.executing_eagerly():
+        for element in dataset:
+            yield tf.nest.map_structure(lambda tensor: tensor.numpy(), element)
+        return
 
-        try:
+    next_element = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+    with tf.compat.v1.Session() as sess:
+        while True:
+            try:
+                yield sess.run(next_element)
+            except tf.errors.OutOfRangeError:
+                break
 
-            while not coord.should_stop():
 
-                outputs = sess.run(features)
+def yield_record(tfrecords, features_to_extract, decode_image=True, num_readers=4,
+                 num_parsers=4, batch_size=256, prefetch=2, profile=None):
+    """
+    Yield the examples of tfrecord files one at a time, see `make_dataset`.
+    Args:
+        tfrecords : list of paths to tfrecord files
+        features_to_extract : a list of tuples (feature key, name for feature)
+    Returns:
+        generator : dictionaries that map name to parsed feature, the variable length
+            features are 1-D arrays
+    """
+    with tf.device('/cpu:0'):
+        dataset = make_dataset(tfrecords, features_to_extract, decode_image, num_readers,
+                               num_parsers, batch_size, prefetch, profile)
+        decode_images = decode_image and any(
+            feature_key == 'image/encoded' for feature_key, _ in features_to_extract)
+        if not decode_images:
+            dataset = dataset.map(_do_not_convert(
+                lambda features: _densify(features, batch_size)))
+
+    elements = _iterate_dataset(dataset)
+    while True:
+        # the time spent waiting on the input pipeline, see metrics
+        with REGISTRY.timer('read'):
+            outputs = next(elements, None)
+        if outputs is None:
+            break
 
-                yield outputs
+        if decode_images:
+            REGISTRY.inc('records_read')
+            yield outputs
+            continue
 
-        except tf.errors.OutOfRangeError as e:
-            pass
\ No newline at end of file
+        # Split the batch into examples column by column, cutting the padding off the
+        # variable length features.
+        feature_names = list(outputs)
+        columns = []
+        for feature in outputs.values():
+            if isinstance(feature, tuple):
+                values, lengths = feature
+                feature = [row[:length] for row, length in zip(values, lengths)]
+            columns.append(feature)
+        REGISTRY.inc('records_read', len(columns[0]))
+        for example_values in zip(*columns):
+            yield dict(zip(feature_names, example_values))
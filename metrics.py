@@ -0,0 +1,303 @@
+"""
+Throughput and per-stage timings of the tfrecord creation and of the readers.
+
+The workers of a process record into its registry, `REGISTRY`:
+
+    counters: e.g. `images`, the records written, or `image_in_bytes`, the bytes of the
+      image files read. The counters ending in `_bytes` are reported in MB/sec.
+    stages: a histogram of the duration of every call of a stage, e.g. `read`, `decode`,
+      `hash`, `serialize` and `write`, see `MetricsRegistry.timer`.
+    busy time: the seconds every worker thread spent in the stages, its utilisation is
+      its busy time over the wall time.
+
+A worker process sends its registry to the parent with `drain`, which merges it.
+
+A `MetricsReporter` writes the metrics recorded since it started, every `interval`
+seconds and once more when it stops, as a line of a JSON-Lines file and as a Prometheus
+textfile, e.g. for the textfile collector of the node exporter.
+"""
+
+import bisect
+import collections
+import contextlib
+from datetime import datetime
+import json
+import os
+import threading
+import time
+
+# Upper bounds, in seconds, of the buckets of the stage histograms
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                 0.25, 0.5, 1., 2.5, 5., 10.)
+
+
+def worker_name():
+    """The name of the calling worker, its process id and thread name."""
+    return '%d/%s' % (os.getpid(), threading.current_thread().name)
+
+
+class MetricsRegistry(object):
+    """Counters, stage histograms and worker busy times, thread safe."""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._counters = collections.Counter()
+        # stage -> [count of every bucket and of +Inf, number of calls, seconds]
+        self._stages = {}
+        self._busy = collections.Counter()
+
+    def inc(self, name, value=1):
+        """Add `value` to a counter."""
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, stage, seconds, worker=None):
+        """Record a call of `stage` that took `seconds`, busy time of `worker`."""
+        index = bisect.bisect_left(self.buckets, seconds)
+        if worker is None:
+            worker = worker_name()
+        with self._lock:
+            stage_stats = self._stages.get(stage)
+            if stage_stats is None:
+                stage_stats = self._stages[stage] = [[0] * (len(self.buckets) + 1), 0, 0.]
+            stage_stats[0][index] += 1
+            stage_stats[1] += 1
+            stage_stats[2] += seconds
+            self._busy[worker] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Time the calls of a stage: `with REGISTRY.timer('decode'): ...`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def _snapshot(self):
+        return {
+            'counters': dict(self._counters),
+            'stages': dict((stage, {'buckets': list(buckets), 'count': count, 'seconds': seconds})
+                           for stage, (buckets, count, seconds) in self._stages.items()),
+            'busy': dict(self._busy),
+        }
+
+    def snapshot(self):
+        """The metrics as a dict of plain values, that pickles and dumps to JSON."""
+        with self._lock:
+            return self._snapshot()
+
+    def drain(self):
+        """The snapshot of the metrics, which are then reset, e.g. in a worker process."""
+        with self._lock:
+            snapshot = self._snapshot()
+            self._reset()
+        return snapshot
+
+    def merge(self, snapshot, sign=1):
+        """Add the metrics of a snapshot, e.g. drained by a worker process."""
+        with self._lock:
+            for name, value in snapshot['counters'].items():
+                self._counters[name] += sign * value
+            for stage, stage_snapshot in snapshot['stages'].items():
+                stage_stats = self._stages.get(stage)
+                if stage_stats is None:
+                    stage_stats = self._stages[stage] = [[0] * (len(self.buckets) + 1), 0, 0.]
+                for index, count in enumerate(stage_snapshot['buckets']):
+                    stage_stats[0][index] += sign * count
+                stage_stats[1] += sign * stage_snapshot['count']
+                stage_stats[2] += sign * stage_snapshot['seconds']
+            for worker, seconds in snapshot['busy'].items():
+                self._busy[worker] += sign * seconds
+
+
+# The registry of this process
+REGISTRY = MetricsRegistry()
+
+
+def _subtract(snapshot, baseline):
+    """The metrics recorded between two snapshots."""
+    registry = MetricsRegistry()
+    registry.merge(snapshot)
+    registry.merge(baseline, sign=-1)
+    difference = registry.snapshot()
+    # the stages and workers that were idle in between
+    difference['stages'] = dict((stage, stage_snapshot)
+                                for stage, stage_snapshot in difference['stages'].items()
+                                if stage_snapshot['count'])
+    difference['busy'] = dict((worker, seconds) for worker, seconds in difference['busy'].items()
+                              if seconds > 0)
+    return difference
+
+
+def _rates(counters, seconds):
+    rates = collections.OrderedDict()
+    for name in sorted(counters):
+        if name.endswith('_bytes'):
+            rates[name[:-len('_bytes')] + '_mb_per_sec'] = counters[name] / 1e6 / seconds
+        else:
+            rates[name + '_per_sec'] = counters[name] / seconds
+    return rates
+
+
+def _prometheus_labels(labels):
+    return '{%s}' % (','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                                                         .replace('"', '\\"')
+                                                         .replace('\n', '\\n'))
+                               for key, value in labels),)
+
+
+class MetricsReporter(threading.Thread):
+    """Writes the metrics of a registry recorded since the reporter started, every
+    `interval` seconds and once more when it stops.
+
+        with MetricsReporter('build-metrics.jsonl', 'build.prom', job='create'):
+            ...
+
+    Every line of the JSON-Lines file holds the `counters`, their `rates` over the whole run
+    and `interval_rates` over the last interval, per second or in MB per second, the
+    `stages` with their number of calls, seconds, mean and share of the busy time, and the
+    `workers` with their busy seconds and utilisation. The Prometheus textfile is replaced
+    atomically, with the metrics prefixed by `tfrecords_` and labelled with the `job`.
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_path=None, interval=10., job='tfrecords',
+                 registry=REGISTRY):
+        """
+        Args:
+          jsonl_path: string, path of the JSON-Lines file, the lines are appended.
+          prometheus_path: string, path of the Prometheus textfile, e.g. `<name>.prom` in
+            the directory of the textfile collector.
+          interval: float, seconds between two reports.
+          job: string, name of the job in the reports, e.g. `create` or `stats`.
+          registry: MetricsRegistry, the metrics to report.
+        """
+        super(MetricsReporter, self).__init__()
+        self.daemon = True
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.job = job
+        self.registry = registry
+        self._stop_event = threading.Event()
+        self._baseline = registry.snapshot()
+        self._start_time = time.time()
+        self._last_time = self._start_time
+        self._last_counters = {}
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        """Stop the reports and write the last one."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        return self.report()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def report(self):
+        """Write the metrics recorded so far.
+        Returns:
+          dict : the JSON record of the report.
+        """
+        now = time.time()
+        snapshot = _subtract(self.registry.snapshot(), self._baseline)
+        elapsed = max(now - self._start_time, 1e-9)
+        interval = max(now - self._last_time, 1e-9)
+        counters = snapshot['counters']
+        interval_counters = dict((name, value - self._last_counters.get(name, 0))
+                                 for name, value in counters.items())
+        self._last_time = now
+        self._last_counters = counters
+
+        busy_seconds = sum(stage['seconds'] for stage in snapshot['stages'].values())
+        stages = collections.OrderedDict()
+        for name in sorted(snapshot['stages']):
+            stage = snapshot['stages'][name]
+            stages[name] = {
+                'count': stage['count'],
+                'seconds': stage['seconds'],
+                'mean_ms': 1000. * stage['seconds'] / max(stage['count'], 1),
+                'share': stage['seconds'] / busy_seconds if busy_seconds else 0.,
+                'buckets': stage['buckets'],
+            }
+        workers = collections.OrderedDict(
+            (worker, {'busy_seconds': seconds, 'utilisation': seconds / elapsed})
+            for worker, seconds in sorted(snapshot['busy'].items()))
+
+        record = collections.OrderedDict([
+            ('time', datetime.now().isoformat()),
+            ('job', self.job),
+            ('elapsed_seconds', elapsed),
+            ('counters', collections.OrderedDict(sorted(counters.items()))),
+            ('rates', _rates(counters, elapsed)),
+            ('interval_rates', _rates(interval_counters, interval)),
+            ('stage_buckets', list(self.registry.buckets)),
+            ('stages', stages),
+            ('workers', workers),
+        ])
+
+        if self.jsonl_path is not None:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if self.prometheus_path is not None:
+            self._write_prometheus(record)
+
+        return record
+
+    def _write_prometheus(self, record):
+        job = (('job', self.job),)
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP tfrecords_%s %s' % (name, help_text))
+            lines.append('# TYPE tfrecords_%s %s' % (name, metric_type))
+            for suffix, labels, value in samples:
+                lines.append('tfrecords_%s%s%s %r' % (name, suffix,
+                                                      _prometheus_labels(job + labels),
+                                                      float(value)))
+
+        metric('elapsed_seconds', 'gauge', 'Seconds since the job started.',
+               [('', (), record['elapsed_seconds'])])
+        for name, value in record['counters'].items():
+            metric(name + '_total', 'counter', 'Total %s.' % (name.replace('_', ' '),),
+                   [('', (), value)])
+        for name, value in record['rates'].items():
+            metric(name, 'gauge', 'Mean %s since the job started.' % (name.replace('_', ' '),),
+                   [('', (), value)])
+
+        samples = []
+        for stage, stage_stats in record['stages'].items():
+            cumulative = 0
+            for upper_bound, count in zip(record['stage_buckets'] + ['+Inf'],
+                                          stage_stats['buckets']):
+                cumulative += count
+                samples.append(('_bucket', (('stage', stage), ('le', upper_bound)), cumulative))
+            samples.append(('_sum', (('stage', stage),), stage_stats['seconds']))
+            samples.append(('_count', (('stage', stage),), stage_stats['count']))
+        metric('stage_seconds', 'histogram', 'Duration of the calls of every stage.', samples)
+
+        metric('worker_busy_seconds_total', 'counter', 'Seconds every worker spent in the stages.',
+               [('', (('worker', worker),), stats['busy_seconds'])
+                for worker, stats in record['workers'].items()])
+        metric('worker_utilisation', 'gauge', 'Busy seconds of every worker over the wall time.',
+               [('', (('worker', worker),), stats['utilisation'])
+                for worker, stats in record['workers'].items()])
+
+        # Replace the file at once, so the collector never reads half of it.
+        temporary_path = self.prometheus_path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temporary_path, self.prometheus_path)
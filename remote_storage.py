@@ -0,0 +1,178 @@
+"""
+Upload of the tfrecords to object storage, e.g. `gs://bucket/tfrecords` or
+`s3://bucket/tfrecords`.
+
+The files are written to a local staging directory and every file is uploaded as soon as
+it is complete, by a pool of threads, then deleted. A file is copied to its final name in
+a single put, so on an object store it appears complete, or not at all.
+
+The files are copied with fsspec when it is installed (gcsfs for `gs://`, s3fs for
+`s3://`), with `storage_options` passed to the filesystem, e.g. the endpoint of a fake
+object-store server, and with tensorflow's gfile otherwise.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+import sys
+import threading
+import time
+
+try:
+    from metrics import REGISTRY
+except ImportError:
+    from tfrecords_creater.metrics import REGISTRY
+
+
+def is_remote(path):
+    """Whether a path is a `scheme://` url rather than a local path."""
+    return '://' in str(path)
+
+
+def join_remote(directory, filename):
+    return str(directory).rstrip('/') + '/' + filename
+
+
+class _FsspecFilesystem(object):
+
+    def __init__(self, url, storage_options):
+        import fsspec
+        self.fs, _ = fsspec.core.url_to_fs(url, **storage_options)
+
+    def makedirs(self, url):
+        self.fs.makedirs(url, exist_ok=True)
+
+    def put(self, local_path, url):
+        self.fs.put_file(local_path, url)
+
+
+class _GfileFilesystem(object):
+
+    def __init__(self):
+        import tensorflow as tf
+        self.gfile = tf.io.gfile
+
+    def makedirs(self, url):
+        self.gfile.makedirs(url)
+
+    def put(self, local_path, url):
+        self.gfile.copy(local_path, url, overwrite=True)
+
+
+def open_filesystem(url, storage_options=None):
+    """The filesystem of a remote url: fsspec if it is installed with the package of the
+    url scheme, e.g. s3fs for `s3://`, tensorflow's gfile otherwise.
+    Args:
+      url: string, e.g. `gs://bucket/tfrecords`.
+      storage_options: dict, keyword arguments of the fsspec filesystem, e.g.
+        `{'client_kwargs': {'endpoint_url': 'http://127.0.0.1:5000'}}` for s3fs.
+    """
+    try:
+        import fsspec
+        fsspec.get_filesystem_class(url.split('://', 1)[0])
+    except (ImportError, ValueError):
+        fsspec = None
+
+    if fsspec is None:
+        if storage_options:
+            raise ValueError('storage_options need fsspec and the package of the scheme of '
+                             '%s, e.g. `pip install fsspec s3fs`.' % (url,))
+        return _GfileFilesystem()
+    return _FsspecFilesystem(url, storage_options or {})
+
+
+class ShardUploader(object):
+    """Uploads files of a local staging directory to a remote directory in the background,
+    with `num_threads` threads, and deletes every local file once it is uploaded.
+
+    A failed put is retried up to `max_retries` times, waiting `retry_delay` seconds and
+    twice as long after every further failure. With `max_staging_bytes`, `wait_for_space`
+    blocks while the files waiting for their upload take more than that many bytes.
+    """
+
+    def __init__(self, staging_directory, output_directory, storage_options=None, num_threads=8,
+                 max_retries=5, max_staging_bytes=None, retry_delay=1.):
+        """
+        Args:
+          staging_directory: string, local directory of the files to upload.
+          output_directory: string, remote directory, see `open_filesystem`.
+          storage_options: dict, see `open_filesystem`.
+          num_threads: integer, number of concurrent uploads.
+          max_retries: integer, number of retries of a failed put.
+          max_staging_bytes: integer, bytes of the files waiting for their upload above which
+            `wait_for_space` blocks, None for no limit.
+          retry_delay: float, seconds before the first retry.
+        """
+        self.staging_directory = staging_directory
+        self.output_directory = output_directory
+        self.max_retries = max_retries
+        self.max_staging_bytes = max_staging_bytes
+        self.retry_delay = retry_delay
+        self.num_uploaded = 0
+        self.bytes_uploaded = 0
+        self.filesystem = open_filesystem(output_directory, storage_options)
+        self.filesystem.makedirs(output_directory)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, num_threads))
+        self._futures = []
+        # bytes of the files submitted and not yet uploaded
+        self._staged_bytes = 0
+        self._condition = threading.Condition()
+
+    def upload(self, local_paths):
+        """Upload files of the staging directory in the background, one after the other,
+        e.g. the index sidecars of a shard before the shard itself."""
+        size = sum(os.path.getsize(path) for path in local_paths)
+        with self._condition:
+            self._staged_bytes += size
+        self._futures.append(self._executor.submit(self._upload, local_paths, size))
+
+    def _upload(self, local_paths, size):
+        try:
+            for path in local_paths:
+                self._put(path)
+                with self._condition:
+                    self.num_uploaded += 1
+                    self.bytes_uploaded += os.path.getsize(path)
+                os.remove(path)
+        finally:
+            with self._condition:
+                self._staged_bytes -= size
+                self._condition.notify_all()
+
+    def _put(self, local_path):
+        url = join_remote(self.output_directory, os.path.basename(local_path))
+        for attempt in range(self.max_retries + 1):
+            try:
+                with REGISTRY.timer('upload'):
+                    self.filesystem.put(local_path, url)
+                REGISTRY.inc('upload_bytes', os.path.getsize(local_path))
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                print('%s: Upload of %s failed with %r, retry %d of %d in %.1f seconds.' %
+                      (datetime.now(), url, e, attempt + 1, self.max_retries, delay))
+                sys.stdout.flush()
+                time.sleep(delay)
+
+    def wait_for_space(self):
+        """Block while the files waiting for their upload take more than max_staging_bytes."""
+        if self.max_staging_bytes is None:
+            return
+        with self._condition:
+            while self._staged_bytes > self.max_staging_bytes:
+                self._condition.wait()
+
+    def wait(self):
+        """Wait for the uploads submitted so far, raise the error of the first one that failed."""
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """Wait for the uploads and stop the threads."""
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
@@ -1,62 +1,294 @@
 """
 These utility functions are meant for computing basic statistics in a set of tfrecord
 files. They can be used to sanity check the training and testing files.
+
+The shards are read in parallel by worker processes, without tensorflow, and every
+requested statistic is computed in a single pass. Each worker returns the partial
+statistics of its shard and the partials are merged at the end.
+
+The bbox widths and heights are aggregated by streaming_stats.Distribution, in constant
+memory however many boxes there are.
+
+The class statistics are read from the `<name>-summary.json` written by
+create_tfrecords.py instead, when it holds every shard. The bboxes are not verified when
+the summaries record a profile without bboxes, e.g. `classification`.
 """
 
 from __future__ import absolute_import
 
 import argparse
+import json
+import multiprocessing
+import os
+
 import numpy as np
-import tensorflow as tf
 
-def class_stats(tfrecords):
-    """
-    Sum the number of images and compute the number of images available for each class.
-    """
+try:
+    from metrics import REGISTRY, MetricsReporter
+    from streaming_stats import Distribution
+    from tfrecord_io import MappedTFRecordDataset
+    from tfrecord_schema import FEATURES_BY_KEY, SHARD_FILENAME, profile_keys, written_profile
+except ImportError:
+    from tfrecords_creater.metrics import REGISTRY, MetricsReporter
+    from tfrecords_creater.streaming_stats import Distribution
+    from tfrecords_creater.tfrecord_io import MappedTFRecordDataset
+    from tfrecords_creater.tfrecord_schema import (FEATURES_BY_KEY, SHARD_FILENAME,
+                                                   profile_keys, written_profile)
 
-    filename_queue = tf.train.string_input_producer(
-        tfrecords,
-        num_epochs=1
-    )
+STATS = ('class_stats', 'verify_bboxes')
 
-    # Construct a Reader to read examples from the .tfrecords file
-    reader = tf.TFRecordReader()
-    _, serialized_example = reader.read(filename_queue)
+BBOX_KEYS = ('image/object/bbox/xmin', 'image/object/bbox/ymin',
+             'image/object/bbox/xmax', 'image/object/bbox/ymax')
 
-    features = tf.parse_single_example(
-        serialized_example,
-        features={
-            'image/class/label' : tf.FixedLenFeature([], tf.int64)
-        }
-    )
+# Bin edges, in pixels, of the bbox width and height histograms
+BBOX_HISTOGRAM_EDGES = np.arange(0, 4096 + 1, 32)
 
-    label = features['image/class/label']
+# Size of the bbox width and height quantile sketches, their ranks are within about 0.1%
+BBOX_SKETCH_SIZE = 2000
 
-    image_count = 0
-    class_image_count = {}
+# The features read for every statistic
+_STAT_FEATURES = {
+    'class_stats': ('image/class/label',),
+    'verify_bboxes': ('image/id', 'image/height', 'image/width', 'image/object/count') + BBOX_KEYS,
+}
 
-    coord = tf.train.Coordinator()
-    with tf.Session() as sess:
 
-        tf.global_variables_initializer().run()
-        tf.local_variables_initializer().run()
-        tf.train.start_queue_runners(sess=sess, coord=coord)
+def _read_columns(dataset, features):
+    """
+    Read the features of every example of a dataset as columns.
+    Args:
+        dataset : a MappedTFRecordDataset
+        features : the feature keys to read
+    Returns:
+        dictionary : maps every feature key to a NumPy array with a value per example, or
+            for the variable length features to a (concatenated values, lengths) tuple.
+            The arrays are copies, nothing refers to the memory maps of the dataset.
+            A feature missing from an example is empty, or 0 if it is an int64 feature of
+            fixed length, e.g. the `image/object/count` of a record without objects.
+    """
+    defaults = dict((key, 0 if FEATURES_BY_KEY[key].fixed_len
+                     and FEATURES_BY_KEY[key].dtype == 'int64' else ()) for key in features)
+    values = dict((key, []) for key in features)
+    for example in dataset:
+        for key in features:
+            values[key].append(example.get(key, defaults[key]))
+
+    columns = {}
+    for key in features:
+        if key in BBOX_KEYS:
+            lengths = np.array([len(value) for value in values[key]], dtype=np.int64)
+            concatenated = np.concatenate(values[key] or [np.zeros(0, dtype=np.float32)])
+            columns[key] = (concatenated.astype(np.float64), lengths)
+        elif key == 'image/id':
+            columns[key] = np.array([bytes(value).decode('utf8') for value in values[key]],
+                                    dtype=object)
+        else:
+            columns[key] = np.array(values[key], dtype=np.int64)
+    return columns
+
+
+def _class_stats_partial(columns):
+    labels = columns['image/class/label']
+    classes, counts = np.unique(labels, return_counts=True)
+    return {
+        'image_count': len(labels),
+        'class_image_count': dict(zip(classes.tolist(), counts.tolist())),
+    }
+
+
+def _verify_bboxes_partial(columns):
+    """The bbox checks of a shard, vectorized over all the boxes of the shard."""
+    image_ids = columns['image/id']
+    (xmin, num_bboxes), (ymin, _), (xmax, _), (ymax, _) = [columns[key] for key in BBOX_KEYS]
+
+    # The image of every box
+    bbox_image = np.repeat(np.arange(len(image_ids)), num_bboxes)
+
+    reversed_coords = (xmin > xmax) | (ymin > ymax)
+    widths = np.abs(xmax - xmin) * columns['image/width'][bbox_image]
+    heights = np.abs(ymax - ymin) * columns['image/height'][bbox_image]
+    small_bboxes = widths * heights < 10
+    count_mismatch = num_bboxes != columns['image/object/count']
+
+    bbox_widths = Distribution(BBOX_HISTOGRAM_EDGES, BBOX_SKETCH_SIZE)
+    bbox_widths.update(np.round(widths))
+    bbox_heights = Distribution(BBOX_HISTOGRAM_EDGES, BBOX_SKETCH_SIZE)
+    bbox_heights.update(np.round(heights))
+
+    return {
+        'image_count': len(image_ids),
+        'images_with_small_bboxes': set(image_ids[np.unique(bbox_image[small_bboxes])]),
+        'images_with_reversed_coords': set(image_ids[np.unique(bbox_image[reversed_coords])]),
+        'images_with_bbox_count_mismatch': set(image_ids[count_mismatch]),
+        'bbox_widths': bbox_widths,
+        'bbox_heights': bbox_heights,
+    }
+
+
+_PARTIALS = {
+    'class_stats': _class_stats_partial,
+    'verify_bboxes': _verify_bboxes_partial,
+}
+
+
+def _shard_stats(work_unit):
+    """
+    Compute the partial statistics of a shard.
+    Args:
+        work_unit : a (tfrecord, stat types) tuple
+    Returns:
+        dictionary : maps every stat type to the partial statistics of the shard
+    """
+    tfrecord, stat_types = work_unit
+    features = sorted(set(key for stat_type in stat_types for key in _STAT_FEATURES[stat_type]))
 
+    with REGISTRY.timer('stats'):
+        dataset = MappedTFRecordDataset([tfrecord], features=features)
         try:
+            columns = _read_columns(dataset, features)
+            num_records = len(dataset)
+        finally:
+            dataset.close()
+
+        partial = dict((stat_type, _PARTIALS[stat_type](columns)) for stat_type in stat_types)
+    REGISTRY.inc('records_read', num_records)
+    REGISTRY.inc('shard_bytes', os.path.getsize(tfrecord))
+
+    return partial
+
+
+def _shard_stats_in_process(work_unit):
+    """`_shard_stats` in a worker process, with the snapshot of the metrics of the worker."""
+    return _shard_stats(work_unit), REGISTRY.drain()
+
+
+def _merge(stats, partial):
+    """Merge the partial statistics of a shard into `stats`, in place."""
+    for stat_type, shard_stats in partial.items():
+        if stat_type not in stats:
+            stats[stat_type] = shard_stats
+            continue
+        merged = stats[stat_type]
+        for name, value in shard_stats.items():
+            if isinstance(value, set):
+                merged[name] |= value
+            elif isinstance(value, dict):
+                for key, count in value.items():
+                    merged[name][key] = merged[name].get(key, 0) + count
+            elif isinstance(value, Distribution):
+                merged[name].merge(value)
+            else:
+                merged[name] += value
+
+
+def _summary_shard_stats(tfrecords):
+    """
+    Find the statistics of the tfrecord files in the summaries of their builds.
+    Args:
+        tfrecords : list of paths to tfrecord files
+    Returns:
+        list : the statistics of every shard, see `create_tfrecords._ShardWriter.stats`,
+            None if a shard is not in a summary, or has changed since it was written.
+    """
+    summaries = {}
+    shard_stats = []
+    for tfrecord in tfrecords:
+        directory, filename = os.path.split(tfrecord)
+        match = SHARD_FILENAME.match(filename)
+        if match is None:
+            return None
+
+        summary_file = os.path.join(directory, '%s-summary.json' % (match.group(1),))
+        if summary_file not in summaries:
+            if not os.path.exists(summary_file):
+                return None
+            with open(summary_file) as f:
+                summary = json.load(f)
+            summaries[summary_file] = dict((stats['filename'], stats)
+                                           for stats in summary['shards'])
+
+        stats = summaries[summary_file].get(filename)
+        # Summaries of older builds have no histograms
+        if (stats is None or 'class_counts' not in stats
+                or stats['size_bytes'] != os.path.getsize(tfrecord)):
+            return None
+        shard_stats.append(stats)
+    return shard_stats
+
+
+def _class_stats_from_summary(shard_stats):
+    stats = {'image_count': 0, 'class_image_count': {}}
+    for shard in shard_stats:
+        stats['image_count'] += shard['count']
+        for class_label, count in shard['class_counts'].items():
+            class_label = int(class_label)
+            stats['class_image_count'][class_label] = \
+                stats['class_image_count'].get(class_label, 0) + count
+    return stats
+
+
+def compute_stats(tfrecords, stat_types=STATS, num_workers=None, use_summary=True):
+    """
+    Compute statistics of a set of tfrecord files in a single pass.
+    Args:
+        tfrecords : list of paths to tfrecord files
+        stat_types : the statistics to compute, from `STATS`
+        num_workers : number of processes reading the shards in parallel, defaults to
+            the number of cpus. 1 reads the shards in this process.
+        use_summary : read the class statistics from the build summaries when they hold
+            every shard, instead of reading the shards.
+    Returns:
+        dictionary : maps every stat type to its statistics
+    """
+    stat_types = tuple(stat_types)
+    for stat_type in stat_types:
+        if stat_type not in STATS:
+            raise ValueError('Unknown stat %r, expected one of %s' % (stat_type, STATS))
+
+    if 'verify_bboxes' in stat_types:
+        profile = written_profile(tfrecords)
+        if profile is not None and not set(BBOX_KEYS) <= set(profile_keys(profile)):
+            raise ValueError('The tfrecord files were written with the %s profile, which has '
+                             'no bboxes to verify' % (profile,))
+
+    if use_summary and 'class_stats' in stat_types:
+        shard_stats = _summary_shard_stats(tfrecords)
+        if shard_stats is not None:
+            remaining_stat_types = tuple(stat_type for stat_type in stat_types
+                                         if stat_type != 'class_stats')
+            stats = {}
+            if remaining_stat_types:
+                stats = compute_stats(tfrecords, remaining_stat_types, num_workers,
+                                      use_summary=False)
+            stats['class_stats'] = _class_stats_from_summary(shard_stats)
+            return stats
+
+    stats = dict((stat_type, _PARTIALS[stat_type](_read_columns([], _STAT_FEATURES[stat_type])))
+                 for stat_type in stat_types)
+    work_units = [(tfrecord, stat_types) for tfrecord in tfrecords]
+
+    num_workers = min(num_workers or os.cpu_count() or 1, len(work_units))
+    if num_workers <= 1:
+        for work_unit in work_units:
+            _merge(stats, _shard_stats(work_unit))
+    else:
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes=num_workers) as pool:
+            for partial, worker_metrics in pool.imap_unordered(_shard_stats_in_process,
+                                                               work_units):
+                _merge(stats, partial)
+                REGISTRY.merge(worker_metrics)
+
+    return stats
+
+
+def print_class_stats(stats):
+    """
+    Print the number of images and the number of images available for each class.
+    """
 
-            while not coord.should_stop():
-
-                outputs = sess.run([label])
-
-                class_label = outputs[0]
-                if class_label not in class_image_count:
-                    class_image_count[class_label] = 0
-                class_image_count[class_label] += 1
-                image_count += 1
-
-
-        except tf.errors.OutOfRangeError as e:
-            pass
+    image_count = stats['image_count']
+    class_image_count = stats['class_image_count']
 
     # Basic info
     print("Found %d images" % (image_count,))
@@ -86,154 +318,112 @@ def class_stats(tfrecords):
         for index in missing_values:
             print("Missing class %d" % (index,))
 
-def verify_bboxes(tfrecords):
-
-    filename_queue = tf.train.string_input_producer(
-        tfrecords,
-        num_epochs=1
-    )
-
-    # Construct a Reader to read examples from the .tfrecords file
-    reader = tf.TFRecordReader()
-    _, serialized_example = reader.read(filename_queue)
-
-    features = tf.parse_single_example(
-        serialized_example,
-        features={
-            'image/id' : tf.FixedLenFeature([], tf.string),
-            'image/height' : tf.FixedLenFeature([], tf.int64),
-            'image/width' : tf.FixedLenFeature([], tf.int64),
-            'image/object/bbox/xmin' : tf.VarLenFeature(dtype=tf.float32),
-            'image/object/bbox/ymin' : tf.VarLenFeature(dtype=tf.float32),
-            'image/object/bbox/xmax' : tf.VarLenFeature(dtype=tf.float32),
-            'image/object/bbox/ymax' : tf.VarLenFeature(dtype=tf.float32),
-            'image/object/count' : tf.FixedLenFeature([], tf.int64)
-        }
-    )
-
-    image_height = tf.cast(features['image/height'], tf.float32)
-    image_width = tf.cast(features['image/width'], tf.float32)
-
-    image_id = features['image/id']
-
-    xmin = tf.expand_dims(features['image/object/bbox/xmin'].values, 0)
-    ymin = tf.expand_dims(features['image/object/bbox/ymin'].values, 0)
-    xmax = tf.expand_dims(features['image/object/bbox/xmax'].values, 0)
-    ymax = tf.expand_dims(features['image/object/bbox/ymax'].values, 0)
-
-    num_bboxes = tf.cast(features['image/object/count'], tf.int32)
-
-    bboxes = tf.concat(axis=0, values=[xmin, ymin, xmax, ymax])
-    bboxes = tf.transpose(bboxes, [1, 0])
-
-    fetches = [image_id, image_height, image_width, bboxes, num_bboxes]
-
-    image_count = 0
-    bbox_widths = []
-    bbox_heights = []
-    images_with_small_bboxes = set()
-    images_with_reversed_coords = set()
-    images_with_bbox_count_mismatch = set()
-
-    coord = tf.train.Coordinator()
-    with tf.Session() as sess:
-
-        tf.global_variables_initializer().run()
-        tf.local_variables_initializer().run()
-        tf.train.start_queue_runners(sess=sess, coord=coord)
-
-        try:
-
-            while not coord.should_stop():
-
-                outputs = sess.run(fetches)
-
-                img_id = outputs[0]
-                img_h = outputs[1]
-                img_w = outputs[2]
-                img_bboxes = outputs[3]
-                img_num_bboxes = outputs[4]
-
-                if img_bboxes.shape[0] != img_num_bboxes:
-                    images_with_bbox_count_mismatch.add(img_id)
-
-                for img_bbox in img_bboxes:
-                    x1, y1, x2, y2 = img_bbox
-
-                    # Reversed coordinates?
-                    if x1 > x2:
-                        images_with_reversed_coords.add(img_id)
-                        t = x1
-                        x1 = x2
-                        x2 = t
-                    if y1 > y2:
-                        images_with_reversed_coords.add(img_id)
-                        t = y1
-                        y1 = y2
-                        y2 = t
-
-                    w = (x2 - x1) * img_w
-                    h = (y2 - y1) * img_h
-
-                    # Too small of an area?
-                    if w * h < 10:
-                        images_with_small_bboxes.add(img_id)
-
-                    bbox_widths.append(w)
-                    bbox_heights.append(h)
-
-                image_count += 1
-
-
-        except tf.errors.OutOfRangeError as e:
-            pass
+def print_verify_bboxes(stats, percentiles=()):
+    """
+    Print the number of images with bbox issues and the bbox dimensions.
+    Args:
+        stats : the `verify_bboxes` statistics, see `compute_stats`
+        percentiles : list of percentiles, in [0, 100], of the bbox dimensions to print
+    """
 
     # Basic info
-    print("Found %d images" % (image_count,))
+    print("Found %d images" % (stats['image_count'],))
     print()
-    print("Found %d images with small bboxes" % (len(images_with_small_bboxes),))
-    #print("Images with areas < 10:")
-    #for img_id in images_with_small_bboxes:
-    #    print(img_id)
+    print("Found %d images with small bboxes" % (len(stats['images_with_small_bboxes']),))
     print()
     print("Found %d images with reversed coordinates" %
-          (len(images_with_reversed_coords),))
-    #print("Images with reversed coordinates:")
-    #for img_id in images_with_reversed_coords:
-    #    print(img_id)
+          (len(stats['images_with_reversed_coords']),))
     print()
     print("Found %d images with bbox count mismatches" %
-          (len(images_with_bbox_count_mismatch),))
-    #for img_id in images_with_bbox_count_mismatch:
-    #    print(img_id)
+          (len(stats['images_with_bbox_count_mismatch']),))
     print()
 
-    bbox_widths = np.round(np.array(bbox_widths)).astype(int)
-    bbox_heights = np.round(np.array(bbox_heights)).astype(int)
+    if len(stats['bbox_widths']) == 0:
+        return
 
-    print("Mean width: %0.4f" % (np.mean(bbox_widths),))
-    print("Median width: %d" % (np.median(bbox_widths),))
-    print("Max width: %d" % (np.max(bbox_widths),))
-    print("Min width: %d" % (np.min(bbox_widths),))
+    # The median and percentiles are read from the quantile sketches, their ranks are
+    # within about 0.1% of the exact ones.
+    print("The medians and percentiles are approximate.")
     print()
-    print("Mean height: %0.4f" % (np.mean(bbox_heights),))
-    print("Median height: %d" % (np.median(bbox_heights),))
-    print("Max height: %d" % (np.max(bbox_heights),))
-    print("Min height: %d" % (np.min(bbox_heights),))
+    for dimension, distribution in (('width', stats['bbox_widths']),
+                                    ('height', stats['bbox_heights'])):
+        print("Mean %s: %0.4f" % (dimension, distribution.moments.mean))
+        print("Median %s (approx.): %d" % (dimension, distribution.sketch.quantile(0.5)))
+        print("Max %s: %d" % (dimension, distribution.moments.max))
+        print("Min %s: %d" % (dimension, distribution.moments.min))
+        values = distribution.sketch.quantiles(np.asarray(percentiles, dtype=np.float64) / 100.)
+        for percentile, value in zip(percentiles, values):
+            print("Percentile %g %s (approx.): %d" % (percentile, dimension, value))
+        print()
+        print_histogram(distribution.histogram, dimension)
+        print()
+
+
+def print_histogram(histogram, dimension):
+    """
+    Print the counts of the non-empty bins of a bbox dimension histogram.
+    Args:
+        histogram : a streaming_stats.FixedHistogram
+        dimension : name of the dimension, e.g. `width`
+    """
+    edges = histogram.edges
+    print("Histogram of the %s, in pixels, empty bins omitted:" % (dimension,))
+    if histogram.underflow:
+        print("  < %d: %d" % (edges[0], histogram.underflow))
+    for start, end, count in zip(edges[:-1], edges[1:], histogram.counts):
+        if count:
+            print("  [%d, %d): %d" % (start, end, count))
+    if histogram.overflow:
+        print("  >= %d: %d" % (edges[-1], histogram.overflow))
+
+
+def class_stats(tfrecords, num_workers=None, use_summary=True):
+    """
+    Sum the number of images and compute the number of images available for each class.
+    """
+    print_class_stats(compute_stats(tfrecords, ['class_stats'], num_workers,
+                                    use_summary)['class_stats'])
+
+def verify_bboxes(tfrecords, num_workers=None, percentiles=()):
+    """
+    Check the bboxes for reversed coordinates, small areas and count mismatches.
+    """
+    print_verify_bboxes(compute_stats(tfrecords, ['verify_bboxes'], num_workers)['verify_bboxes'],
+                        percentiles)
 
 
 def parse_args():
 
     parser = argparse.ArgumentParser(description='Basic statistics on tfrecord files')
 
-    parser.add_argument('--stat', dest='stat_type',
-                        choices=['class_stats', 'verify_bboxes'],
+    parser.add_argument('--stat', dest='stat_types',
+                        help='statistics to compute, all of them are computed in a single pass',
+                        choices=STATS, nargs='+',
                         required=True)
 
     parser.add_argument('--tfrecords', dest='tfrecords',
                         help='paths to tfrecords files', type=str,
                         nargs='+', required=True)
 
+    parser.add_argument('--num_workers', dest='num_workers',
+                        help='number of processes reading the tfrecords, defaults to the number of cpus',
+                        type=int, required=False, default=None)
+
+    parser.add_argument('--percentiles', dest='percentiles',
+                        help='percentiles, in [0, 100], of the bbox widths and heights to print',
+                        type=float, nargs='+', required=False, default=[])
+
+    parser.add_argument('--scan', dest='use_summary',
+                        help='read the shards even if the build summary has the statistics',
+                        action='store_false', required=False)
+
+    parser.add_argument('--metrics_path', dest='metrics_path',
+                        help='JSON-Lines file to append the throughput and timings of the reads to',
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--prometheus_path', dest='prometheus_path',
+                        help='Prometheus textfile to write the same metrics to',
+                        type=str, required=False, default=None)
 
     parsed_args = parser.parse_args()
 
@@ -242,10 +432,22 @@ def parse_args():
 def main():
     parsed_args = parse_args()
 
-    if parsed_args.stat_type == 'class_stats':
-        class_stats(parsed_args.tfrecords)
-    elif parsed_args.stat_type == 'verify_bboxes':
-        verify_bboxes(parsed_args.tfrecords)
+    reporter = None
+    if parsed_args.metrics_path is not None or parsed_args.prometheus_path is not None:
+        reporter = MetricsReporter(parsed_args.metrics_path, parsed_args.prometheus_path,
+                                   job='stats')
+        reporter.start()
+    try:
+        stats = compute_stats(parsed_args.tfrecords, parsed_args.stat_types,
+                              parsed_args.num_workers, parsed_args.use_summary)
+    finally:
+        if reporter is not None:
+            reporter.stop()
+    for stat_type in parsed_args.stat_types:
+        if stat_type == 'class_stats':
+            print_class_stats(stats[stat_type])
+        elif stat_type == 'verify_bboxes':
+            print_verify_bboxes(stats[stat_type], parsed_args.percentiles)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,212 @@
+"""
+Statistics of a stream of values in a fixed amount of memory.
+
+Every aggregator is updated with batches of values, NumPy arrays, and can be merged
+with an aggregator of the same kind, e.g. one computed by another worker process:
+
+    RunningMoments: count, mean, variance, min and max.
+    QuantileSketch: approximate quantiles, a KLL sketch.
+    FixedHistogram: counts of the values in fixed bins.
+    Distribution: all three of them.
+"""
+
+import numpy as np
+
+
+class RunningMoments(object):
+    """Count, mean, variance, min and max of the values seen so far."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        # sum of the squared differences to the mean
+        self._m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    def _combine(self, count, mean, m2, minimum, maximum):
+        # Chan et al. update of the moments of two sets of values
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self._m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+
+    def update(self, values):
+        """Add a batch of values."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        mean = values.mean()
+        self._combine(len(values), mean, ((values - mean) ** 2).sum(),
+                      values.min(), values.max())
+
+    def merge(self, other):
+        """Add the values of another RunningMoments."""
+        self._combine(other.count, other.mean, other._m2, other.min, other.max)
+
+    @property
+    def variance(self):
+        if self.count == 0:
+            return np.nan
+        return self._m2 / self.count
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+class QuantileSketch(object):
+    """Approximate quantiles of the values seen so far, in O(k log(n / k)) memory.
+
+    A KLL sketch: the values are kept in levels, a value of level `i` stands for `2 ** i`
+    values. When a level holds more values than its capacity it is sorted and every other
+    value, starting at a random offset, moves up a level. The top level holds `k` values
+    and every level below it 2/3 of the level above. Until the first compaction, i.e. for
+    up to `k` values, the quantiles are exact.
+    """
+
+    def __init__(self, k=200, seed=None):
+        """
+        Args:
+          k: integer, capacity of the top level, the larger the more accurate.
+          seed: integer, seed of the random compaction offsets.
+        """
+        self.k = k
+        self.count = 0
+        self._levels = [np.zeros(0)]
+        self._rng = np.random.RandomState(seed)
+
+    def _capacity(self, level):
+        depth = len(self._levels) - level - 1
+        return max(int(np.ceil(self.k * (2. / 3) ** depth)), 2)
+
+    def _compress(self):
+        level = 0
+        while level < len(self._levels):
+            if len(self._levels[level]) > self._capacity(level):
+                if level + 1 == len(self._levels):
+                    self._levels.append(np.zeros(0))
+                values = np.sort(self._levels[level])
+                # an odd value out stays at its level
+                leftover = values[len(values) - len(values) % 2:]
+                values = values[:len(values) - len(values) % 2]
+                offset = self._rng.randint(2)
+                self._levels[level + 1] = np.concatenate([self._levels[level + 1],
+                                                          values[offset::2]])
+                self._levels[level] = leftover
+            level += 1
+
+    def update(self, values):
+        """Add a batch of values."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.count += len(values)
+        self._levels[0] = np.concatenate([self._levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        """Add the values of another QuantileSketch."""
+        while len(self._levels) < len(other._levels):
+            self._levels.append(np.zeros(0))
+        for level, values in enumerate(other._levels):
+            self._levels[level] = np.concatenate([self._levels[level], values])
+        self.count += other.count
+        self._compress()
+
+    def quantiles(self, qs):
+        """
+        Args:
+          qs: list of floats in [0, 1].
+        Returns:
+          np.ndarray : for every q, the smallest value with a rank of at least `q * count`,
+            NaN if no value was added.
+        """
+        qs = np.asarray(qs, dtype=np.float64)
+        if self.count == 0:
+            return np.full(qs.shape, np.nan)
+        values = np.concatenate(self._levels)
+        weights = np.concatenate([np.full(len(level_values), 2 ** level, dtype=np.float64)
+                                  for level, level_values in enumerate(self._levels)])
+        order = np.argsort(values, kind='mergesort')
+        values = values[order]
+        cumulative_weights = np.cumsum(weights[order])
+        ranks = qs * cumulative_weights[-1]
+        indices = np.searchsorted(cumulative_weights, ranks, side='left')
+        return values[np.clip(indices, 0, len(values) - 1)]
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+
+class FixedHistogram(object):
+    """Counts of the values in the bins `[edges[i], edges[i + 1])`, with an underflow
+    count of the values below `edges[0]` and an overflow count of the values from
+    `edges[-1]` on."""
+
+    def __init__(self, edges):
+        """
+        Args:
+          edges: increasing list of the bin edges.
+        """
+        self.edges = np.asarray(edges, dtype=np.float64)
+        # underflow, the bins, overflow
+        self._counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+
+    def update(self, values):
+        """Add a batch of values."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        bins = np.searchsorted(self.edges, values, side='right')
+        self._counts += np.bincount(bins, minlength=len(self._counts))
+
+    def merge(self, other):
+        """Add the counts of another FixedHistogram with the same edges."""
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Can not merge histograms with different bin edges.')
+        self._counts += other._counts
+
+    @property
+    def counts(self):
+        return self._counts[1:-1]
+
+    @property
+    def underflow(self):
+        return int(self._counts[0])
+
+    @property
+    def overflow(self):
+        return int(self._counts[-1])
+
+
+class Distribution(object):
+    """Moments, quantile sketch and histogram of a stream of values."""
+
+    def __init__(self, edges, k=200, seed=None):
+        """
+        Args:
+          edges: the bin edges of the histogram, see `FixedHistogram`.
+          k: the accuracy of the quantile sketch, see `QuantileSketch`.
+          seed: integer, seed of the quantile sketch.
+        """
+        self.moments = RunningMoments()
+        self.sketch = QuantileSketch(k, seed)
+        self.histogram = FixedHistogram(edges)
+
+    def __len__(self):
+        return self.moments.count
+
+    def update(self, values):
+        """Add a batch of values."""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.moments.update(values)
+        self.sketch.update(values)
+        self.histogram.update(values)
+
+    def merge(self, other):
+        """Add the values of another Distribution."""
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+        self.histogram.merge(other.histogram)
@@ -0,0 +1,203 @@
+import glob
+import os
+
+import pytest
+from PIL import Image
+
+from create_tfrecords import create
+from tfrecord_io import MappedTFRecordDataset
+
+# Pillow mode -> (channels, colorspace) of a PNG stored as it is
+PNG_MODES = {
+    'L': (1, 'GRAY'),
+    'LA': (2, 'GRAY_ALPHA'),
+    'RGB': (3, 'RGB'),
+    'RGBA': (4, 'RGBA'),
+}
+
+
+def _build(tmp_path, images, transcode, backend='python', verify_decode_rate=0.):
+    image_directory = tmp_path / 'images'
+    image_directory.mkdir()
+    dataset = []
+    for i, (mode, image_format) in enumerate(images):
+        path = str(image_directory / ('%d.%s' % (i, image_format.lower())))
+        Image.new(mode, (24, 16)).save(path, format=image_format)
+        dataset.append({'filename': path, 'id': str(i), 'class': {'label': 0}})
+
+    output_directory = str(tmp_path / 'tfrecords')
+    os.makedirs(output_directory)
+    errors = create(dataset, 'train', output_directory, 1, 1, shuffle=False,
+                    transcode=transcode, backend=backend, verify_decode_rate=verify_decode_rate)
+    assert errors == []
+
+    tfrecords = glob.glob(os.path.join(output_directory, '*.tfrec'))
+    dataset = MappedTFRecordDataset(tfrecords, features=['image/id', 'image/channels',
+                                                         'image/colorspace', 'image/format'])
+    records = sorted((int(bytes(example['image/id'])), int(example['image/channels']),
+                      bytes(example['image/colorspace']).decode('utf8'),
+                      bytes(example['image/format']).decode('utf8'))
+                     for example in dataset)
+    dataset.close()
+    return tfrecords, [record[1:] for record in records]
+
+
+@pytest.mark.parametrize('transcode', ['passthrough', 'png'])
+def test_png_channels_are_kept(tmp_path, transcode):
+    _, records = _build(tmp_path, [(mode, 'PNG') for mode in PNG_MODES], transcode,
+                        verify_decode_rate=1.)
+    assert records == [PNG_MODES[mode] + ('PNG',) for mode in PNG_MODES]
+
+
+def test_png_converted_to_jpeg_is_rgb(tmp_path):
+    _, records = _build(tmp_path, [(mode, 'PNG') for mode in PNG_MODES], 'jpeg')
+    assert records == [(3, 'RGB', 'JPEG')] * len(PNG_MODES)
+
+
+def test_png_converted_to_webp_keeps_alpha(tmp_path):
+    pytest.importorskip('PIL.WebPImagePlugin')
+    _, records = _build(tmp_path, [(mode, 'PNG') for mode in PNG_MODES], 'webp')
+    assert records == [(3, 'RGB', 'WEBP'), (4, 'RGBA', 'WEBP'), (3, 'RGB', 'WEBP'),
+                       (4, 'RGBA', 'WEBP')]
+
+
+def test_jpeg_channels_are_read_from_the_header(tmp_path):
+    _, records = _build(tmp_path, [('L', 'JPEG'), ('RGB', 'JPEG'), ('CMYK', 'JPEG')],
+                        'jpeg')
+    assert records == [(1, 'GRAY', 'JPEG'), (3, 'RGB', 'JPEG'), (4, 'CMYK', 'JPEG')]
+
+
+@pytest.mark.parametrize('backend', ['python', 'tensorflow'])
+@pytest.mark.parametrize('transcode', ['jpeg', 'png'])
+def test_images_without_a_header_are_decoded_and_converted(tmp_path, backend, transcode):
+    if backend == 'tensorflow':
+        pytest.importorskip('tensorflow')
+    _, records = _build(tmp_path, [('P', 'GIF'), ('RGB', 'BMP')], transcode, backend,
+                        verify_decode_rate=1.)
+    assert [image_format for _, _, image_format in records] == [transcode.upper()] * 2
+    # the black GIF is gray for some Pillow versions, which the PNG keeps
+    assert records[1][:2] == (3, 'RGB')
+    if transcode == 'jpeg':
+        assert records[0][:2] == (3, 'RGB')
+
+
+@pytest.mark.parametrize('backend', ['python', 'tensorflow'])
+def test_undecodable_image_is_an_error(tmp_path, backend):
+    if backend == 'tensorflow':
+        pytest.importorskip('tensorflow')
+    path = str(tmp_path / 'broken.png')
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + b'\x00' * 100)
+    output_directory = str(tmp_path / 'tfrecords')
+    os.makedirs(output_directory)
+
+    errors = create([{'filename': path, 'id': '0', 'class': {'label': 0}}], 'train',
+                    output_directory, 1, 1, backend=backend)
+    assert len(errors) == 1
+    assert 'PNG image has no IHDR chunk, and it can not be decoded' in errors[0]['error_msg']
+
+
+@pytest.mark.parametrize('transcode', ['passthrough', 'webp'])
+def test_images_are_read_back_as_rgb(tmp_path, transcode):
+    tf = pytest.importorskip('tensorflow')
+    if transcode == 'webp' and not hasattr(tf.io, 'decode_webp'):
+        pytest.skip('this tensorflow can not decode WebP')
+    from iterate_tfrecords import yield_record
+
+    tfrecords, _ = _build(tmp_path, [(mode, 'PNG') for mode in PNG_MODES], transcode)
+    images = [record['image'] for record in
+              yield_record(tfrecords, [('image/encoded', 'image')], profile='full')]
+    assert [image.shape for image in images] == [(16, 24, 3)] * len(PNG_MODES)
+
+
+def _png_dataset(image_directory, num_images=8):
+    image_directory.mkdir()
+    dataset = []
+    for i in range(num_images):
+        path = str(image_directory / ('%d.png' % (i,)))
+        Image.new('RGB', (24, 16), (30 * i, 0, 0)).save(path, format='PNG')
+        dataset.append({'filename': path, 'id': str(i), 'class': {'label': i % 2}})
+    return dataset
+
+
+def _shard_bytes(output_directory):
+    shard_bytes = {}
+    for tfrecord in sorted(glob.glob(os.path.join(output_directory, '*.tfrec'))):
+        with open(tfrecord, 'rb') as f:
+            shard_bytes[os.path.basename(tfrecord)] = f.read()
+    return shard_bytes
+
+
+def test_resume_with_other_settings_is_refused(tmp_path):
+    dataset = _png_dataset(tmp_path / 'images')
+    output_directory = str(tmp_path / 'tfrecords')
+    os.makedirs(output_directory)
+    create([dict(image_example) for image_example in dataset], 'train', output_directory, 2, 1,
+           seed=1, backend='python')
+
+    with pytest.raises(ValueError, match='Can not resume'):
+        create([dict(image_example) for image_example in dataset], 'train', output_directory,
+               2, 1, seed=1, backend='python', transcode='png', resume=True)
+
+
+def test_resume_rewrites_a_damaged_shard(tmp_path):
+    dataset = _png_dataset(tmp_path / 'images')
+    output_directory = str(tmp_path / 'tfrecords')
+    os.makedirs(output_directory)
+    create([dict(image_example) for image_example in dataset], 'train', output_directory, 2, 1,
+           seed=1, backend='python')
+    expected = _shard_bytes(output_directory)
+
+    # same size, other bytes
+    damaged = os.path.join(output_directory, sorted(expected)[0])
+    with open(damaged, 'r+b') as f:
+        f.seek(20)
+        byte = f.read(1)
+        f.seek(20)
+        f.write(bytes(bytearray([byte[0] ^ 0xff])))
+
+    create([dict(image_example) for image_example in dataset], 'train', output_directory, 2, 1,
+           seed=1, backend='python', resume=True)
+    assert _shard_bytes(output_directory) == expected
+
+
+@pytest.mark.parametrize('executor,stream', [('threads', False), ('pipeline', False),
+                                             ('threads', True)])
+def test_progress_is_printed_per_processed_image(tmp_path, capfd, executor, stream):
+    dataset = [{'filename': str(tmp_path / ('missing-%d.png' % (i,))), 'id': str(i)}
+               for i in range(1500)]
+    output_directory = str(tmp_path / 'tfrecords')
+    os.makedirs(output_directory)
+
+    errors = create(iter(dataset) if stream else dataset, 'train', output_directory, 1, 1,
+                    shuffle=False, executor=executor, backend='python')
+
+    assert len(errors) == len(dataset)
+    progress = [line for line in capfd.readouterr().out.splitlines() if 'Processed' in line]
+    assert len(progress) == 1
+    assert 'Processed 1000 ' in progress[0]
+    assert 'with 1000 errors' in progress[0]
+
+
+def test_readers_default_to_the_profile_of_the_build(tmp_path):
+    pytest.importorskip('tensorflow')
+    from iterate_tfrecords import yield_record
+    from tfrecord_schema import written_profile
+
+    image_directory = tmp_path / 'images'
+    image_directory.mkdir()
+    dataset = []
+    for i in range(3):
+        path = str(image_directory / ('%d.png' % (i,)))
+        Image.new('RGB', (24, 16)).save(path, format='PNG')
+        dataset.append({'filename': path, 'id': str(i), 'class': {'label': i}})
+    output_directory = str(tmp_path / 'tfrecords')
+    os.makedirs(output_directory)
+    create(dataset, 'train', output_directory, 1, 1, backend='python', profile='classification')
+    tfrecords = glob.glob(os.path.join(output_directory, '*.tfrec'))
+
+    assert written_profile(tfrecords) == 'classification'
+    records = yield_record(tfrecords, [('image/class/label', 'label')], decode_image=False)
+    assert sorted(int(record['label']) for record in records) == [0, 1, 2]
+    with pytest.raises(ValueError, match='classification profile does not write'):
+        next(yield_record(tfrecords, [('image/object/count', 'count')], decode_image=False))
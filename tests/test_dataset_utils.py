@@ -0,0 +1,85 @@
+import json
+import os
+
+from PIL import Image
+
+from dataset_utils import load_dataset_structure, scan_files
+from wrapper_create_tfrecords import generate_tfrecords
+
+
+def _write_image(path, value):
+    Image.new('RGB', (16, 8), (value, value, value)).save(path, format='PNG')
+
+
+def _class_folders(dataset_dir):
+    for label in ('live', 'spoof'):
+        os.makedirs(os.path.join(dataset_dir, label))
+        for i in range(3):
+            _write_image(os.path.join(dataset_dir, label, '%d.png' % (i,)), 40 * i)
+
+
+def _append_in_place(path, num_bytes=1000):
+    directory = os.path.dirname(path)
+    directory_mtime_ns = os.stat(directory).st_mtime_ns
+    with open(path, 'ab') as f:
+        f.write(b'\0' * num_bytes)
+    assert os.stat(directory).st_mtime_ns == directory_mtime_ns
+
+
+def test_cached_scan_stats_files_edited_in_place(tmp_path):
+    dataset_dir = str(tmp_path / 'dataset')
+    _class_folders(dataset_dir)
+
+    scanned_directories = {}
+    before = list(scan_files(dataset_dir, with_stats=True, return_relative_path=True,
+                             scanned_directories=scanned_directories))
+
+    edited = os.path.join(dataset_dir, 'live', '1.png')
+    _append_in_place(edited)
+
+    rescanned_directories = {}
+    after = list(scan_files(dataset_dir, with_stats=True, return_relative_path=True,
+                            cached_directories=scanned_directories,
+                            scanned_directories=rescanned_directories))
+
+    assert [path for path, _, _ in after] == [path for path, _, _ in before]
+    sizes = dict((path, size) for path, size, _ in after)
+    assert sizes[os.path.join('live', '1.png')] == os.path.getsize(edited)
+    assert rescanned_directories[os.path.join(dataset_dir, 'live')]['files'][1][1] == \
+        os.path.getsize(edited)
+
+
+def test_incremental_update_of_image_edited_in_place(tmp_path):
+    dataset_dir = str(tmp_path / 'dataset')
+    output_directory = str(tmp_path / 'tfrecords')
+    _class_folders(dataset_dir)
+
+    generate_tfrecords(dataset_dir, output_directory=output_directory, num_shards=2,
+                       num_threads=1, backend='python')
+    structure_path = os.path.join(output_directory, 'mimicked_structure-train.json')
+    previous_ids = dict((image_data['filename'], image_data['id'])
+                        for image_data in load_dataset_structure(structure_path)['images'])
+
+    edited = os.path.join(dataset_dir, 'live', '1.png')
+    _append_in_place(edited)
+
+    generate_tfrecords(dataset_dir, output_directory=output_directory, num_shards=2,
+                       num_threads=1, backend='python', incremental=True)
+
+    update_shards = [filename for filename in os.listdir(output_directory)
+                     if filename.startswith('train-update-') and filename.endswith('.tfrec')]
+    assert len(update_shards) == 1
+    assert update_shards[0].endswith('-cnt-1.tfrec')
+
+    with open(os.path.join(output_directory, 'train-tombstones.json')) as f:
+        tombstones = json.load(f)
+    assert [(image_data['filename'], image_data['id']) for image_data in tombstones] == \
+        [(edited, previous_ids[edited])]
+
+    images = load_dataset_structure(structure_path)['images']
+    by_filename = dict((image_data['filename'], image_data) for image_data in images)
+    assert by_filename[edited]['size'] == os.path.getsize(edited)
+    assert by_filename[edited]['id'] != previous_ids[edited]
+    for filename, image_id in previous_ids.items():
+        if filename != edited:
+            assert by_filename[filename]['id'] == image_id
@@ -0,0 +1,75 @@
+import io
+
+import pytest
+from PIL import Image
+
+from image_headers import read_image_header
+
+
+def _encode(mode, image_format, size=(40, 30), **save_options):
+    output = io.BytesIO()
+    Image.new(mode, size).save(output, format=image_format, **save_options)
+    return output.getvalue()
+
+
+def _exif():
+    exif = Image.Exif()
+    exif[0x010F] = 'camera maker'
+    exif[0x0110] = 'camera model'
+    return exif.tobytes()
+
+
+def test_baseline_jpeg():
+    image_data = _encode('RGB', 'JPEG')
+    assert b'\xff\xc0' in image_data
+    assert read_image_header(image_data) == (30, 40, 3, 'JPEG')
+
+
+def test_progressive_jpeg():
+    image_data = _encode('RGB', 'JPEG', progressive=True)
+    # a progressive JPEG has a SOF2 segment
+    assert b'\xff\xc2' in image_data
+    assert read_image_header(image_data) == (30, 40, 3, 'JPEG')
+
+
+def test_jpeg_with_exif_and_icc_profile_before_the_frame():
+    icc_profile = b'\x00' * 5000
+    image_data = _encode('RGB', 'JPEG', exif=_exif(), icc_profile=icc_profile)
+    exif_offset = image_data.index(b'Exif\x00\x00')
+    assert exif_offset < image_data.index(b'ICC_PROFILE') < image_data.index(b'\xff\xc0')
+    assert read_image_header(image_data) == (30, 40, 3, 'JPEG')
+
+
+@pytest.mark.parametrize('mode, channels', [('L', 1), ('CMYK', 4)])
+def test_jpeg_channels(mode, channels):
+    assert read_image_header(_encode(mode, 'JPEG')) == (30, 40, channels, 'JPEG')
+
+
+@pytest.mark.parametrize('mode, channels', [('L', 1), ('LA', 2), ('RGB', 3), ('P', 3),
+                                            ('RGBA', 4)])
+def test_png_channels(mode, channels):
+    assert read_image_header(_encode(mode, 'PNG')) == (30, 40, channels, 'PNG')
+
+
+@pytest.mark.parametrize('image_format', ['JPEG', 'PNG'])
+def test_truncated_header(image_format):
+    image_data = _encode('RGB', image_format, exif=_exif())
+    if image_format == 'JPEG':
+        # the SOF0 segment ends 10 bytes after its marker
+        header_length = image_data.index(b'\xff\xc0') + 10
+    else:
+        # the color type is the 26th byte
+        header_length = 26
+
+    assert read_image_header(image_data[:header_length])[:3] == (30, 40, 3)
+    for length in range(header_length):
+        with pytest.raises(ValueError):
+            read_image_header(image_data[:length])
+
+
+@pytest.mark.parametrize('image_format', ['GIF', 'BMP', 'WEBP'])
+def test_other_formats_are_refused(image_format):
+    if image_format == 'WEBP':
+        pytest.importorskip('PIL.WebPImagePlugin')
+    with pytest.raises(ValueError, match='neither a JPEG nor a PNG'):
+        read_image_header(_encode('RGB', image_format))
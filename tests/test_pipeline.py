@@ -0,0 +1,115 @@
+import os
+import threading
+
+import pytest
+
+import create_tfrecords
+from create_tfrecords import create
+
+from test_create_tfrecords import _png_dataset, _shard_bytes
+
+
+def _metadata_dataset(num_images):
+    # store_images=False, the records are built from the dimensions alone
+    return [{'filename': '/data/%d.jpg' % (i,), 'id': str(i), 'height': 16, 'width': 24,
+             'class': {'label': i % 3}} for i in range(num_images)]
+
+
+def _create_in_thread(*args, **kwargs):
+    """Run `create` in a thread, so a hanging build fails the test instead of blocking it."""
+    outcome = {}
+
+    def run():
+        try:
+            outcome['errors'] = create(*args, **kwargs)
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), 'the build hangs'
+    return outcome
+
+
+def test_pipeline_writes_the_shards_of_the_threads_executor(tmp_path):
+    dataset = _png_dataset(tmp_path / 'images', num_images=30)
+    directories = {}
+    for executor in ('threads', 'pipeline'):
+        directories[executor] = str(tmp_path / executor)
+        os.makedirs(directories[executor])
+        errors = create([dict(image_example) for image_example in dataset], 'train',
+                        directories[executor], 4, 2, seed=3, executor=executor,
+                        backend='python', num_io_threads=2, num_writer_threads=2,
+                        queue_size=4)
+        assert errors == []
+
+    assert len(_shard_bytes(directories['pipeline'])) == 4
+    assert _shard_bytes(directories['pipeline']) == _shard_bytes(directories['threads'])
+
+
+def test_pipeline_with_more_shards_than_images(tmp_path):
+    output_directory = str(tmp_path / 'tfrecords')
+    os.makedirs(output_directory)
+    errors = create(_metadata_dataset(3), 'train', output_directory, 5, 2, store_images=False,
+                    executor='pipeline', backend='python')
+
+    assert errors == []
+    counts = sorted(int(filename.split('-cnt-')[1].split('.')[0])
+                    for filename in _shard_bytes(output_directory))
+    assert counts == [0, 0, 1, 1, 1]
+
+
+def test_failed_writer_fails_the_build(tmp_path, monkeypatch):
+    write = create_tfrecords._ShardWriter.write
+
+    def failing_write(self, *args, **kwargs):
+        if self.shard == 0:
+            raise OSError(28, 'No space left on device')
+        write(self, *args, **kwargs)
+
+    monkeypatch.setattr(create_tfrecords._ShardWriter, 'write', failing_write)
+    output_directory = str(tmp_path / 'tfrecords')
+    os.makedirs(output_directory)
+
+    outcome = _create_in_thread(_metadata_dataset(2000), 'train', output_directory, 4, 2,
+                                store_images=False, executor='pipeline', backend='python',
+                                queue_size=16)
+
+    assert isinstance(outcome.get('error'), OSError)
+    assert 'No space left on device' in str(outcome['error'])
+
+
+def test_writer_failing_after_the_feed_fails_the_build(tmp_path, monkeypatch):
+    def failing_record(self, shard_stats):
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(create_tfrecords._ShardJournal, 'record', failing_record)
+    output_directory = str(tmp_path / 'tfrecords')
+    os.makedirs(output_directory)
+
+    outcome = _create_in_thread(_metadata_dataset(200), 'train', output_directory, 1, 2,
+                                store_images=False, executor='pipeline', backend='python',
+                                queue_size=16)
+
+    assert isinstance(outcome.get('error'), OSError)
+
+
+@pytest.mark.parametrize('num_writer_threads', [1, 3])
+def test_pipeline_resumes_to_the_same_shards(tmp_path, num_writer_threads):
+    dataset = _metadata_dataset(50)
+    output_directory = str(tmp_path / 'tfrecords')
+    os.makedirs(output_directory)
+    create([dict(image_example) for image_example in dataset], 'train', output_directory, 5,
+           2, seed=1, store_images=False, executor='pipeline', backend='python',
+           num_writer_threads=num_writer_threads)
+    expected = _shard_bytes(output_directory)
+
+    removed = sorted(expected)[2]
+    os.remove(os.path.join(output_directory, removed))
+    create([dict(image_example) for image_example in dataset], 'train', output_directory, 5,
+           2, seed=1, store_images=False, executor='pipeline', backend='python',
+           num_writer_threads=num_writer_threads, resume=True)
+
+    assert _shard_bytes(output_directory) == expected
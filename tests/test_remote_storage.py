@@ -0,0 +1,159 @@
+import collections
+import os
+import re
+
+import pytest
+from PIL import Image
+
+import remote_storage
+from create_tfrecords import create
+from remote_storage import ShardUploader
+
+fsspec = pytest.importorskip('fsspec')
+
+
+def _dataset(image_directory, num_images=12):
+    os.makedirs(image_directory)
+    dataset = []
+    for i in range(num_images):
+        path = os.path.join(image_directory, '%d.png' % (i,))
+        Image.new('RGB', (16, 8), (20 * i, 0, 0)).save(path, format='PNG')
+        dataset.append({'filename': path, 'id': str(i), 'class': {'label': i % 2, 'text': 'c'}})
+    return dataset
+
+
+def _remote_files(url):
+    fs, path = fsspec.core.url_to_fs(url)
+    return sorted(os.path.basename(name) for name in fs.ls(path, detail=False))
+
+
+@pytest.fixture
+def remote_directory(tmp_path):
+    url = 'memory://bucket/%s/train' % (tmp_path.name,)
+    yield url
+    fs, path = fsspec.core.url_to_fs(url)
+    if fs.exists(path):
+        fs.rm(path, recursive=True)
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    delays = []
+    monkeypatch.setattr(remote_storage.time, 'sleep', delays.append)
+    return delays
+
+
+@pytest.mark.parametrize('executor', ['threads', 'pipeline', 'processes'])
+def test_build_to_memory_filesystem(tmp_path, remote_directory, executor):
+    dataset = _dataset(str(tmp_path / 'images'))
+    staging_directory = str(tmp_path / 'staging')
+
+    errors = create(dataset, 'train', remote_directory, 3, 2, executor=executor,
+                    backend='python', staging_directory=staging_directory)
+
+    assert errors == []
+    assert os.listdir(staging_directory) == []
+    files = _remote_files(remote_directory)
+    shards = [name for name in files if name.endswith('.tfrec')]
+    assert len(shards) == 3
+    counts = []
+    for shard in shards:
+        match = re.match(r'^train-\d+-of-03-cnt-(\d+)\.tfrec$', shard)
+        assert match is not None
+        counts.append(int(match.group(1)))
+        assert shard + '.idx' in files
+        assert shard + '.ids' in files
+    assert sum(counts) == len(dataset)
+    assert 'train-summary.json' in files
+
+
+def test_failed_puts_are_retried(tmp_path, remote_directory, monkeypatch, no_sleep):
+    attempts = collections.Counter()
+    put = remote_storage._FsspecFilesystem.put
+
+    def flaky_put(self, local_path, url):
+        attempts[url] += 1
+        if attempts[url] == 1:
+            raise OSError('connection reset')
+        put(self, local_path, url)
+
+    monkeypatch.setattr(remote_storage._FsspecFilesystem, 'put', flaky_put)
+    dataset = _dataset(str(tmp_path / 'images'))
+    staging_directory = str(tmp_path / 'staging')
+
+    errors = create(dataset, 'train', remote_directory, 2, 1, backend='python',
+                    staging_directory=staging_directory, upload_retries=2)
+
+    assert errors == []
+    assert os.listdir(staging_directory) == []
+    assert set(attempts.values()) == {2}
+    assert no_sleep == [1.] * len(attempts)
+    assert len([name for name in _remote_files(remote_directory)
+                if name.endswith('.tfrec')]) == 2
+
+
+def test_failed_put_is_raised_after_the_retries(tmp_path, remote_directory, monkeypatch,
+                                                no_sleep):
+    attempts = collections.Counter()
+
+    def failing_put(self, local_path, url):
+        attempts[url] += 1
+        raise OSError('service unavailable')
+
+    monkeypatch.setattr(remote_storage._FsspecFilesystem, 'put', failing_put)
+    dataset = _dataset(str(tmp_path / 'images'))
+
+    with pytest.raises(OSError, match='service unavailable'):
+        create(dataset, 'train', remote_directory, 2, 1, backend='python',
+               staging_directory=str(tmp_path / 'staging'), upload_retries=3)
+
+    assert attempts
+    assert set(attempts.values()) == {4}
+    assert no_sleep[:3] == [1., 2., 4.]
+
+
+def test_uploader_retries(tmp_path, remote_directory, monkeypatch, no_sleep):
+    attempts = []
+
+    def failing_put(self, local_path, url):
+        attempts.append(url)
+        raise OSError('service unavailable')
+
+    monkeypatch.setattr(remote_storage._FsspecFilesystem, 'put', failing_put)
+    staging_directory = str(tmp_path)
+    local_path = os.path.join(staging_directory, 'train-0-of-1-cnt-1.tfrec')
+    with open(local_path, 'wb') as f:
+        f.write(b'record')
+
+    uploader = ShardUploader(staging_directory, remote_directory, num_threads=1, max_retries=2,
+                             retry_delay=0.5)
+    uploader.upload([local_path])
+    with pytest.raises(OSError):
+        uploader.close()
+
+    assert attempts == [remote_directory + '/train-0-of-1-cnt-1.tfrec'] * 3
+    assert no_sleep == [0.5, 1.]
+    # the file is kept for another attempt
+    assert os.path.exists(local_path)
+
+
+@pytest.mark.parametrize('streamed, target_shard_mb', [(True, None), (False, 1.)])
+def test_builds_that_finish_their_shards_at_the_end_are_refused(tmp_path, remote_directory,
+                                                                streamed, target_shard_mb):
+    dataset = _dataset(str(tmp_path / 'images'))
+    if streamed:
+        dataset = iter(dataset)
+
+    with pytest.raises(ValueError, match='remote output_directory'):
+        create(dataset, 'train', remote_directory, 3, 2, backend='python',
+               target_shard_mb=target_shard_mb, staging_directory=str(tmp_path / 'staging'),
+               max_staging_mb=1.)
+    fs, path = fsspec.core.url_to_fs(remote_directory)
+    assert not fs.exists(path)
+
+
+def test_max_staging_mb_needs_a_remote_output(tmp_path):
+    dataset = _dataset(str(tmp_path / 'images'))
+    with pytest.raises(ValueError, match='max_staging_mb'):
+        create(dataset, 'train', str(tmp_path / 'tfrecords'), 3, 2, backend='python',
+               max_staging_mb=1.)
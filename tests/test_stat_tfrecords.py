@@ -0,0 +1,73 @@
+import glob
+import os
+
+import pytest
+from PIL import Image
+
+from create_tfrecords import create
+from stat_tfrecords import compute_stats, print_verify_bboxes
+
+
+def _build_with_bboxes(tmp_path, profile='full'):
+    image_directory = tmp_path / 'images'
+    image_directory.mkdir()
+    dataset = []
+    for i in range(6):
+        path = str(image_directory / ('%d.png' % (i,)))
+        Image.new('RGB', (200, 100)).save(path, format='PNG')
+        dataset.append({
+            'filename': path,
+            'id': str(i),
+            'class': {'label': i % 2},
+            'object': {
+                'count': 2,
+                # 20 and 100 pixels wide, 10 and 50 pixels high
+                'bbox': {'xmin': [0., 0.5], 'xmax': [0.1, 1.], 'ymin': [0., 0.5],
+                         'ymax': [0.1, 1.], 'label': [0, 1]},
+            },
+        })
+    output_directory = str(tmp_path / 'tfrecords')
+    os.makedirs(output_directory)
+    create(dataset, 'train', output_directory, 2, 1, backend='python', profile=profile)
+    return sorted(glob.glob(os.path.join(output_directory, '*.tfrec')))
+
+
+def test_verify_bboxes_prints_the_histograms(tmp_path, capsys):
+    tfrecords = _build_with_bboxes(tmp_path)
+    stats = compute_stats(tfrecords, ['verify_bboxes'], num_workers=1)['verify_bboxes']
+
+    assert stats['bbox_widths'].histogram.counts.sum() == 12
+    capsys.readouterr()
+    print_verify_bboxes(stats, percentiles=[90])
+    output = capsys.readouterr().out
+
+    assert 'Median width (approx.): ' in output
+    assert 'Percentile 90 height (approx.): ' in output
+    assert ('Histogram of the width, in pixels, empty bins omitted:\n'
+            '  [0, 32): 6\n'
+            '  [96, 128): 6\n') in output
+    assert ('Histogram of the height, in pixels, empty bins omitted:\n'
+            '  [0, 32): 6\n'
+            '  [32, 64): 6\n') in output
+
+
+def test_verify_bboxes_refuses_a_profile_without_bboxes(tmp_path):
+    tfrecords = _build_with_bboxes(tmp_path, profile='classification')
+    with pytest.raises(ValueError, match='classification profile'):
+        compute_stats(tfrecords, ['verify_bboxes'], num_workers=1)
+    # the class statistics of the build are still available
+    stats = compute_stats(tfrecords, ['class_stats'], num_workers=1)['class_stats']
+    assert stats['class_image_count'] == {0: 3, 1: 3}
+
+
+def test_verify_bboxes_of_records_without_objects(tmp_path, capsys):
+    tfrecords = _build_with_bboxes(tmp_path, profile='classification')
+    # without the summary the profile is unknown, the records are read
+    os.remove(os.path.join(os.path.dirname(tfrecords[0]), 'train-summary.json'))
+    stats = compute_stats(tfrecords, ['verify_bboxes'], num_workers=1)['verify_bboxes']
+
+    assert stats['image_count'] == 6
+    assert stats['images_with_bbox_count_mismatch'] == set()
+    assert stats['bbox_widths'].histogram.counts.sum() == 0
+    print_verify_bboxes(stats)
+    assert 'Found 0 images with bbox count mismatches' in capsys.readouterr().out
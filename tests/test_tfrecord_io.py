@@ -0,0 +1,116 @@
+import pytest
+
+from create_tfrecords import (_ExampleOptions, _example_feature_values, _process_image_example,
+                              _serialize_example)
+from tfrecord_io import decode_example, encode_example
+from tfrecord_schema import FEATURES_BY_KEY, PROFILES
+
+IMAGE_BUFFER = bytes(bytearray(range(256))) * 4
+
+
+def _image_example(num_objects=2):
+    return {
+        'filename': '/data/images/0000001.jpg',
+        'id': '1',
+        'class': {'label': 7, 'text': u'chien éè 犬 \U0001f415', 'conf': 0.25,
+                  'extra': u'{"source": "café"}'},
+        'object': {
+            'count': num_objects,
+            'area': [0.5 * (j + 1) for j in range(num_objects)],
+            'id': [u'1-%d-ü' % (j,) for j in range(num_objects)],
+            'is_crowd': [j % 2 for j in range(num_objects)],
+            'bbox': {
+                'xmin': [0.125 * j for j in range(num_objects)],
+                'xmax': [0.5 + 0.125 * j for j in range(num_objects)],
+                'ymin': [0.0625 * j for j in range(num_objects)],
+                'ymax': [0.75 for _ in range(num_objects)],
+                'label': [-1 + j for j in range(num_objects)],
+                'text': [u'étiquette %d' % (j,) for j in range(num_objects)],
+                'conf': [1. for _ in range(num_objects)],
+                'score': [0.3 for _ in range(num_objects)],
+            },
+            'parts': {
+                'x': [0.1 * j for j in range(3 * num_objects)],
+                'y': [0.2 * j for j in range(3 * num_objects)],
+                'v': [j % 3 for j in range(3 * num_objects)],
+                'score': [0.9 for _ in range(3 * num_objects)],
+            },
+        },
+    }
+
+
+def _empty_bboxes_example():
+    image_example = _image_example(num_objects=0)
+    image_example['object']['bbox'] = {'xmin': [], 'xmax': [], 'ymin': [], 'ymax': [],
+                                       'label': []}
+    return image_example
+
+
+def _no_objects_example():
+    image_example = _image_example()
+    del image_example['object']
+    return image_example
+
+
+IMAGE_EXAMPLES = [
+    ('objects', _image_example()),
+    ('empty_bboxes', _empty_bboxes_example()),
+    ('no_objects', _no_objects_example()),
+]
+
+
+def _encode_example(image_example, image_buffer, profile):
+    feature_values = _example_feature_values(image_example, image_buffer, 480, 640,
+                                             profile=profile)
+    return encode_example((feature_key, FEATURES_BY_KEY[feature_key].dtype, values)
+                          for feature_key, values in feature_values.items())
+
+
+def _protobuf_example(image_example, image_buffer, profile):
+    pytest.importorskip('tensorflow')
+    from create_tfrecords import _convert_to_example
+
+    example = _convert_to_example(image_example, image_buffer, 480, 640, profile=profile)
+    return example.SerializeToString(deterministic=True)
+
+
+@pytest.mark.parametrize('profile', list(PROFILES))
+@pytest.mark.parametrize('name,image_example', IMAGE_EXAMPLES)
+def test_serializer_matches_encode_example(profile, name, image_example):
+    record = _serialize_example(image_example, IMAGE_BUFFER, 480, 640, profile=profile)
+    assert record == _encode_example(image_example, IMAGE_BUFFER, profile)
+
+
+@pytest.mark.parametrize('profile', list(PROFILES))
+@pytest.mark.parametrize('name,image_example', IMAGE_EXAMPLES)
+def test_serializer_matches_protobuf(profile, name, image_example):
+    record = _serialize_example(image_example, IMAGE_BUFFER, 480, 640, profile=profile)
+    assert record == _protobuf_example(image_example, IMAGE_BUFFER, profile)
+
+
+@pytest.mark.parametrize('profile', list(PROFILES))
+def test_record_without_image(profile):
+    image_example = _image_example()
+    image_example['height'] = 480
+    image_example['width'] = 640
+    options = _ExampleOptions(store_images=False, verify_decode_rate=0., transcode='jpeg',
+                              dedup=None, hash_index=None, backend='python', profile=profile)
+
+    record, image_bytes_in, image_bytes_out, _, image_size = \
+        _process_image_example(image_example, None, options)
+
+    assert (image_bytes_in, image_bytes_out, image_size) == (0, 0, (480, 640))
+    assert record == _encode_example(image_example, b'', profile)
+    assert record == _protobuf_example(image_example, b'', profile)
+    assert bytes(decode_example(record)['image/encoded']) == b''
+
+
+def test_decoded_unicode_text():
+    record = _serialize_example(_image_example(), IMAGE_BUFFER, 480, 640, profile='full')
+    example = decode_example(record)
+
+    assert bytes(example['image/class/text']).decode('utf8') == \
+        u'chien éè 犬 \U0001f415'
+    assert [bytes(text).decode('utf8') for text in example['image/object/bbox/text']] == \
+        [u'étiquette 0', u'étiquette 1']
+    assert bytes(example['image/encoded']) == IMAGE_BUFFER
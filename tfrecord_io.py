@@ -0,0 +1,610 @@
+"""
+Read and write tfrecord files without tensorflow.
+
+A tfrecord file is a sequence of records, each framed as
+
+    uint64 length
+    uint32 masked crc32c of length
+    byte   data[length]
+    uint32 masked crc32c of data
+
+with all the integers little endian. The records written here are `tf.train.Example`
+protocol buffers, encoded directly from their feature lists. Map entries are written in
+key order, so the bytes are the same as those of tensorflow's deterministic serialization
+and the files can be read by `tf.data.TFRecordDataset` or any other tfrecord reader.
+
+crc32c is computed by the `crc32c` or `google_crc32c` package when one is installed,
+otherwise by a much slower pure Python implementation.
+
+Every shard written by create_tfrecords has two index sidecars, see `index_files`: `.idx`
+holds the `offset size` of every record, one record per line, in the format of the DALI
+tfrecord index, and `.ids` holds the `id<TAB>class label` of the record on the same line.
+`MappedTFRecordDataset` uses them to read any record of a set of shards directly.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+try:
+    from tfrecord_schema import FEATURES_BY_KEY
+except ImportError:
+    from tfrecords_creater.tfrecord_schema import FEATURES_BY_KEY
+
+_CRC32C_POLYNOMIAL = 0x82F63B78
+_CRC32C_MASK_DELTA = 0xA282EAD8
+
+
+def _make_crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ (_CRC32C_POLYNOMIAL if crc & 1 else 0)
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def _crc32c_python(data):
+    """crc32c (Castagnoli) of bytes, one table lookup per byte."""
+    table = _CRC32C_TABLE
+    crc = 0xFFFFFFFF
+    for byte in bytes(data):
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+try:
+    from crc32c import crc32c
+except ImportError:
+    try:
+        from google_crc32c import value as crc32c
+    except ImportError:
+        crc32c = _crc32c_python
+
+
+def masked_crc32c(data):
+    """crc32c of bytes, masked the way tfrecord files store it."""
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + _CRC32C_MASK_DELTA) & 0xFFFFFFFF
+
+
+def frame_record(record):
+    """The header and footer of a record: (length and its crc, crc of the record)."""
+    length = struct.pack('<Q', len(record))
+    header = length + struct.pack('<I', masked_crc32c(length))
+    footer = struct.pack('<I', masked_crc32c(record))
+    return header, footer
+
+
+class TFRecordWriter(object):
+    """Writes records to an uncompressed tfrecord file, like `tf.io.TFRecordWriter`."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+
+    def write(self, record):
+        header, footer = frame_record(record)
+        self._file.write(header)
+        self._file.write(record)
+        self._file.write(footer)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _varint(value):
+    """Protocol buffer varint of a non negative integer."""
+    if value < 0x80:
+        return bytes((value,))
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _length_delimited(tag, payload):
+    return tag + _varint(len(payload)) + payload
+
+
+def _encode_feature(dtype, values):
+    """Encode a `tf.train.Feature` holding a list of values.
+    Args:
+      dtype: string, `int64`, `float` or `bytes`, the list the values are stored in.
+      values: list, the values, bytes for `bytes` features.
+    Returns:
+      bytes : the encoded Feature.
+    """
+    if dtype == 'bytes':
+        # BytesList: repeated bytes value = 1
+        value_list = b''.join([_length_delimited(b'\x0a', value) for value in values])
+        return _length_delimited(b'\x0a', value_list)
+
+    if dtype == 'float':
+        # FloatList: repeated float value = 1 [packed = true]
+        packed = np.asarray(values, dtype='<f4').tobytes()
+        value_list = _length_delimited(b'\x0a', packed) if packed else b''
+        return _length_delimited(b'\x12', value_list)
+
+    if dtype == 'int64':
+        # Int64List: repeated int64 value = 1 [packed = true], negative values take 10 bytes
+        packed = b''.join([_varint(int(value) & 0xFFFFFFFFFFFFFFFF) for value in values])
+        value_list = _length_delimited(b'\x0a', packed) if packed else b''
+        return _length_delimited(b'\x1a', value_list)
+
+    raise ValueError('Unknown feature type %r' % (dtype,))
+
+
+def encode_example(features):
+    """Encode a `tf.train.Example`.
+    Args:
+      features: iterable of (key, dtype, values) tuples, see `_encode_feature`.
+    Returns:
+      bytes : the serialized Example, the same bytes as
+        `Example.SerializeToString(deterministic=True)`.
+    """
+    entries = []
+    for key, dtype, values in sorted(features, key=lambda feature: feature[0]):
+        # map<string, Feature> entry: string key = 1, Feature value = 2
+        entry = (_length_delimited(b'\x0a', key.encode('utf8')) +
+                 _length_delimited(b'\x12', _encode_feature(dtype, values)))
+        entries.append(_length_delimited(b'\x0a', entry))
+
+    # Example: Features features = 1, Features: map<string, Feature> feature = 1
+    return _length_delimited(b'\x0a', b''.join(entries))
+
+
+def _varint_size(value):
+    """Number of bytes of the varint of a non negative integer."""
+    if value < 0x80:
+        return 1
+    return (value.bit_length() + 6) // 7
+
+
+def _write_varint(buffer, value):
+    """Append the varint of a non negative integer to a bytearray."""
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _pack_floats(values):
+    """Little endian float32s of a list or array of numbers."""
+    if isinstance(values, np.ndarray):
+        return values.astype('<f4').tobytes()
+    try:
+        return struct.pack('<%df' % (len(values),), *values)
+    except OverflowError:
+        # beyond the float32 range, NumPy rounds to infinity
+        return np.asarray(values, dtype='<f4').tobytes()
+
+
+# Tag of the value list field of a Feature, by dtype
+_FEATURE_LIST_TAGS = {'bytes': 0x0a, 'float': 0x12, 'int64': 0x1a}
+
+
+class ExampleSerializer(object):
+    """Encodes `tf.train.Example`s of a fixed set of features, the same bytes as
+    `encode_example`.
+
+    The encoding of every key and the tags around it are computed once. The lengths of the
+    nested messages are computed from the values, so every record is written in a single
+    pass into a buffer that is reused by the following records of the same thread.
+    """
+
+    def __init__(self, features):
+        """
+        Args:
+          features: iterable of (key, dtype) tuples, dtype is `int64`, `float` or `bytes`.
+        """
+        self._features = []
+        for key, dtype in sorted(features):
+            if dtype not in _FEATURE_LIST_TAGS:
+                raise ValueError('Unknown feature type %r' % (dtype,))
+            encoded_key = key.encode('utf8')
+            # map<string, Feature> entry: string key = 1, then the tag of Feature value = 2
+            key_field = b'\x0a' + _varint(len(encoded_key)) + encoded_key + b'\x12'
+            self._features.append((key, dtype, key_field, _FEATURE_LIST_TAGS[dtype]))
+        self._local = threading.local()
+
+    def serialize(self, feature_values):
+        """Encode an Example.
+        Args:
+          feature_values: dict, maps the key of every feature to its list of values, bytes
+            for `bytes` features, numbers or a NumPy array otherwise.
+        Returns:
+          bytes : the serialized Example.
+        """
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            buffer = self._local.buffer = bytearray()
+        del buffer[:]
+
+        for key, dtype, key_field, list_tag in self._features:
+            values = feature_values[key]
+            if dtype == 'bytes':
+                packed = None
+                list_length = 0
+                for value in values:
+                    length = len(value)
+                    list_length += length + (2 if length < 0x80 else 1 + _varint_size(length))
+            else:
+                if not len(values):
+                    packed = b''
+                elif dtype == 'float':
+                    packed = _pack_floats(values)
+                elif len(values) == 1 and 0 <= values[0] < 0x80:
+                    packed = bytes((int(values[0]),))
+                else:
+                    packed = b''.join([_varint(int(value) & 0xFFFFFFFFFFFFFFFF)
+                                       for value in values])
+                # an empty list has no packed field
+                list_length = 1 + _varint_size(len(packed)) + len(packed) if packed else 0
+
+            feature_length = 1 + _varint_size(list_length) + list_length
+            entry_length = len(key_field) + _varint_size(feature_length) + feature_length
+
+            # Features: map<string, Feature> feature = 1
+            buffer.append(0x0a)
+            _write_varint(buffer, entry_length)
+            buffer += key_field
+            _write_varint(buffer, feature_length)
+            buffer.append(list_tag)
+            _write_varint(buffer, list_length)
+            if packed is None:
+                for value in values:
+                    buffer.append(0x0a)
+                    length = len(value)
+                    if length < 0x80:
+                        buffer.append(length)
+                    else:
+                        _write_varint(buffer, length)
+                    buffer += value
+            elif packed:
+                buffer.append(0x0a)
+                _write_varint(buffer, len(packed))
+                buffer += packed
+
+        # Example: Features features = 1
+        return b'\x0a' + _varint(len(buffer)) + buffer
+
+
+def index_files(path):
+    """Paths of the index sidecars of a tfrecord file: (`<path>.idx`, `<path>.ids`)."""
+    return path + '.idx', path + '.ids'
+
+
+def read_index(path):
+    """Read the `.idx` sidecar of a tfrecord file.
+    Args:
+      path: string, path of the tfrecord file.
+    Returns:
+      tuple : (offsets, sizes), int64 arrays of the byte offset and framed size of every
+        record, the size includes the 12 byte header and the 4 byte footer of the record.
+    """
+    with open(index_files(path)[0]) as f:
+        index = np.array(f.read().split(), dtype=np.int64).reshape(-1, 2)
+    return index[:, 0], index[:, 1]
+
+
+def read_index_ids(path):
+    """Read the `.ids` sidecar of a tfrecord file.
+    Args:
+      path: string, path of the tfrecord file.
+    Returns:
+      tuple : (ids, labels), the list of image ids and an int64 array of class labels.
+    """
+    ids = []
+    labels = []
+    with open(index_files(path)[1]) as f:
+        for line in f:
+            image_id, label = line.rstrip('\n').rsplit('\t', 1)
+            ids.append(image_id)
+            labels.append(int(label))
+    return ids, np.asarray(labels, dtype=np.int64)
+
+
+def build_index(path):
+    """Index a tfrecord file by reading the length of every record.
+    Args:
+      path: string, path of the tfrecord file.
+    Returns:
+      tuple : (offsets, sizes), see `read_index`.
+    """
+    offsets = []
+    sizes = []
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            header = f.read(12)
+            if len(header) < 12:
+                raise ValueError('%s is truncated, its last record has no header.' % (path,))
+            length = struct.unpack('<Q', header[:8])[0]
+            if struct.unpack('<I', header[8:])[0] != masked_crc32c(header[:8]):
+                raise ValueError('%s is corrupt, bad length crc at byte %d.' % (path, offset))
+            offsets.append(offset)
+            sizes.append(length + 16)
+            offset += length + 16
+    if offset != file_size:
+        raise ValueError('%s is truncated, its last record is incomplete.' % (path,))
+    return np.asarray(offsets, dtype=np.int64), np.asarray(sizes, dtype=np.int64)
+
+
+def _read_varint(data, pos):
+    """Read a protocol buffer varint of `data` at `pos`, returns (value, next pos)."""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _to_int64(value):
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _decode_feature(data, start, end):
+    """Decode a `tf.train.Feature` of `data[start:end]`.
+    Returns:
+      tuple : (dtype, values), the values are a list of memoryviews for a `bytes` list, and
+        a NumPy array for a `float` or `int64` list.
+    """
+    if start == end:
+        # a Feature with no list set
+        return None, []
+    tag = data[start]
+    length, pos = _read_varint(data, start + 1)
+    list_end = pos + length
+    dtype = {0x0a: 'bytes', 0x12: 'float', 0x1a: 'int64'}.get(tag)
+    if dtype is None:
+        raise ValueError('Unknown Feature field with tag %#x.' % (tag,))
+
+    values = []
+    packed_floats = []
+    while pos < list_end:
+        tag = data[pos]
+        pos += 1
+        if tag == 0x0a:
+            # length delimited: a bytes value or a packed list of numbers
+            length, pos = _read_varint(data, pos)
+            if dtype == 'bytes':
+                values.append(data[pos:pos + length])
+            elif dtype == 'float':
+                packed_floats.append(np.frombuffer(data[pos:pos + length], dtype='<f4'))
+            else:
+                packed_end = pos + length
+                value_pos = pos
+                while value_pos < packed_end:
+                    value, value_pos = _read_varint(data, value_pos)
+                    values.append(_to_int64(value))
+            pos += length
+        elif tag == 0x0d:
+            # an unpacked float
+            packed_floats.append(np.frombuffer(data[pos:pos + 4], dtype='<f4'))
+            pos += 4
+        elif tag == 0x08:
+            # an unpacked int64
+            value, pos = _read_varint(data, pos)
+            values.append(_to_int64(value))
+        else:
+            raise ValueError('Unknown %s list field with tag %#x.' % (dtype, tag))
+
+    if dtype == 'float':
+        if len(packed_floats) == 1:
+            # no copy, the array is a view of the record
+            return dtype, packed_floats[0]
+        return dtype, np.concatenate(packed_floats or [np.zeros(0, dtype='<f4')])
+    if dtype == 'int64':
+        return dtype, np.asarray(values, dtype=np.int64)
+    return dtype, values
+
+
+def decode_example(data, features=None):
+    """Decode a serialized `tf.train.Example`.
+    Args:
+      data: bytes or memoryview, the serialized Example.
+      features: collection of feature keys to decode, None decodes all the features.
+    Returns:
+      dict : maps every feature key to its values. A fixed length feature of
+        tfrecord_schema is a single value, any other feature is a list of memoryviews
+        (`bytes`) or a NumPy array (`float`, `int64`). The bytes and the packed floats are
+        views of `data`, not copies.
+    """
+    data = memoryview(data)
+    decoded = {}
+    pos = 0
+    data_end = len(data)
+    while pos < data_end:
+        # Example: Features features = 1
+        tag = data[pos]
+        length, pos = _read_varint(data, pos + 1)
+        if tag != 0x0a:
+            pos += length
+            continue
+        features_end = pos + length
+        while pos < features_end:
+            # Features: map<string, Feature> feature = 1
+            tag = data[pos]
+            length, pos = _read_varint(data, pos + 1)
+            entry_end = pos + length
+            if tag != 0x0a:
+                pos = entry_end
+                continue
+            key = None
+            value_start = value_end = None
+            while pos < entry_end:
+                tag = data[pos]
+                length, pos = _read_varint(data, pos + 1)
+                if tag == 0x0a:
+                    key = bytes(data[pos:pos + length]).decode('utf8')
+                elif tag == 0x12:
+                    value_start, value_end = pos, pos + length
+                pos += length
+            if key is None or (features is not None and key not in features):
+                continue
+            if value_start is None:
+                value_start = value_end = entry_end
+            _, values = _decode_feature(data, value_start, value_end)
+            schema_feature = FEATURES_BY_KEY.get(key)
+            if schema_feature is not None and schema_feature.fixed_len:
+                values = values[0] if len(values) else None
+            decoded[key] = values
+    return decoded
+
+
+class MappedTFRecordDataset(object):
+    """Random access to the records of a set of tfrecord files, through memory maps.
+
+    The files are opened when they are first read. Their records are located with their
+    `.idx` sidecars, or by reading the length of every record when a file has none. The
+    records are returned as views of the memory maps, the payload bytes are not copied.
+
+        dataset = MappedTFRecordDataset(sorted(glob.glob('train-*.tfrec')))
+        len(dataset)
+        dataset[10]                # dict of the features of the 11th record
+        dataset[10:20]             # list of dicts
+        dataset[[3, 1000, 7]]      # list of dicts, for a sampler's batch of indices
+
+    A dataset can be pickled, e.g. to the worker processes of a data loader, the files are
+    opened again in every process.
+    """
+
+    def __init__(self, paths, features=None, verify_crc=False):
+        """
+        Args:
+          paths: string or list of strings, the tfrecord files, their records are
+            numbered in this order.
+          features: collection of feature keys to decode, None decodes all the features.
+          verify_crc: bool, check the crc32c of every record that is read.
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        self.paths = list(paths)
+        self.features = None if features is None else frozenset(features)
+        self.verify_crc = verify_crc
+        self._lock = threading.Lock()
+        self._indexes = [None] * len(self.paths)
+        self._maps = [None] * len(self.paths)
+        self._cumulative_counts = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_maps'] = [None] * len(self.paths)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _index(self, shard):
+        """(offsets, sizes) of the records of a file, from its sidecar or by reading it."""
+        index = self._indexes[shard]
+        if index is None:
+            path = self.paths[shard]
+            if os.path.exists(index_files(path)[0]):
+                index = read_index(path)
+            else:
+                index = build_index(path)
+            self._indexes[shard] = index
+        return index
+
+    def _map(self, shard):
+        memory_map = self._maps[shard]
+        if memory_map is None:
+            with self._lock:
+                memory_map = self._maps[shard]
+                if memory_map is None:
+                    with open(self.paths[shard], 'rb') as f:
+                        if os.fstat(f.fileno()).st_size == 0:
+                            # an empty file can not be memory mapped, and has no records
+                            memory_map = b''
+                        else:
+                            memory_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._maps[shard] = memory_map
+        return memory_map
+
+    def _counts(self):
+        if self._cumulative_counts is None:
+            counts = [len(self._index(shard)[0]) for shard in range(len(self.paths))]
+            self._cumulative_counts = np.cumsum([0] + counts).tolist()
+        return self._cumulative_counts
+
+    def __len__(self):
+        return self._counts()[-1]
+
+    def _locate(self, i):
+        """(shard, index of the record within the shard) of the i-th record."""
+        num_records = len(self)
+        if i < 0:
+            i += num_records
+        if not 0 <= i < num_records:
+            raise IndexError('record index %d out of range for %d records' % (i, num_records))
+        counts = self._counts()
+        shard = bisect.bisect_right(counts, i) - 1
+        return shard, i - counts[shard]
+
+    def record(self, i):
+        """The serialized Example of the i-th record, as a memoryview of its file."""
+        shard, shard_i = self._locate(i)
+        offsets, sizes = self._index(shard)
+        offset = int(offsets[shard_i])
+        length = int(sizes[shard_i]) - 16
+        memory_map = memoryview(self._map(shard))
+        record = memory_map[offset + 12:offset + 12 + length]
+        if self.verify_crc:
+            expected_crc = struct.unpack('<I', memory_map[offset + 12 + length:
+                                                          offset + 16 + length])[0]
+            if masked_crc32c(record) != expected_crc:
+                raise ValueError('Record %d of %s is corrupt, bad data crc.' %
+                                 (shard_i, self.paths[shard]))
+        return record
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.get_batch(range(*key.indices(len(self))))
+        if isinstance(key, (list, tuple, np.ndarray)):
+            return self.get_batch(key)
+        return decode_example(self.record(int(key)), self.features)
+
+    def get_batch(self, indices):
+        """The decoded features of the records at `indices`, a list of dicts."""
+        return [decode_example(self.record(int(i)), self.features) for i in indices]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        """Close the memory maps, the views returned by the dataset must be released first."""
+        with self._lock:
+            for shard, memory_map in enumerate(self._maps):
+                if isinstance(memory_map, mmap.mmap):
+                    memory_map.close()
+                self._maps[shard] = None
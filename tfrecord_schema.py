@@ -0,0 +1,159 @@
+"""
+The features stored in every tfrecord Example, see the table in the README.
+
+Every feature has the type of the list it is stored in, `int64`, `float` or `bytes`, and
+is either fixed length, a single value per Example, or variable length.
+
+A profile is the subset of the features written for one kind of dataset, see PROFILES.
+create_tfrecords.py records the profile of a build in its `<name>-summary.json`, see
+`written_profile`.
+"""
+
+import collections
+import json
+import os
+import re
+
+Feature = collections.namedtuple('Feature', ['key', 'dtype', 'fixed_len'])
+
+FEATURES = (
+    Feature('image/height', 'int64', True),
+    Feature('image/width', 'int64', True),
+    Feature('image/colorspace', 'bytes', True),
+    Feature('image/channels', 'int64', True),
+    Feature('image/format', 'bytes', True),
+    Feature('image/filename', 'bytes', True),
+    Feature('image/id', 'bytes', True),
+    Feature('image/encoded', 'bytes', True),
+    Feature('image/extra', 'bytes', True),
+    Feature('image/class/label', 'int64', True),
+    Feature('image/class/text', 'bytes', True),
+    Feature('image/class/conf', 'float', True),
+    Feature('image/object/bbox/xmin', 'float', False),
+    Feature('image/object/bbox/xmax', 'float', False),
+    Feature('image/object/bbox/ymin', 'float', False),
+    Feature('image/object/bbox/ymax', 'float', False),
+    Feature('image/object/bbox/label', 'int64', False),
+    Feature('image/object/bbox/text', 'bytes', False),
+    Feature('image/object/bbox/conf', 'float', False),
+    Feature('image/object/bbox/score', 'float', False),
+    Feature('image/object/parts/x', 'float', False),
+    Feature('image/object/parts/y', 'float', False),
+    Feature('image/object/parts/v', 'int64', False),
+    Feature('image/object/parts/score', 'float', False),
+    Feature('image/object/count', 'int64', True),
+    Feature('image/object/area', 'float', False),
+    Feature('image/object/id', 'bytes', False),
+
+    # Additional fields for the format needed by the Object Detection repository
+    Feature('image/source_id', 'bytes', True),
+    Feature('image/key/sha256', 'bytes', True),
+    Feature('image/object/class/label', 'int64', False),
+    Feature('image/object/class/text', 'bytes', False),
+    Feature('image/object/is_crowd', 'int64', False),
+)
+
+# A finished shard, e.g. 'train-02-of-10-cnt-512.tfrec', and the name of its build
+SHARD_FILENAME = re.compile(r'^(.+)-\d+-of-\d+-cnt-\d+\.tfrec$')
+
+FEATURES_BY_KEY = dict((feature.key, feature) for feature in FEATURES)
+
+_IMAGE_KEYS = (
+    'image/height',
+    'image/width',
+    'image/colorspace',
+    'image/channels',
+    'image/format',
+    'image/filename',
+    'image/id',
+    'image/encoded',
+    'image/extra',
+    'image/key/sha256',
+)
+
+_CLASS_KEYS = (
+    'image/class/label',
+    'image/class/text',
+    'image/class/conf',
+)
+
+# boxes and the object fields shared by the detection and keypoints profiles
+_BOX_KEYS = (
+    'image/object/bbox/xmin',
+    'image/object/bbox/xmax',
+    'image/object/bbox/ymin',
+    'image/object/bbox/ymax',
+    'image/object/count',
+    'image/object/area',
+    'image/object/id',
+    'image/object/is_crowd',
+)
+
+_DETECTION_KEYS = (
+    'image/object/bbox/label',
+    'image/object/bbox/text',
+    'image/object/bbox/conf',
+    'image/object/bbox/score',
+    'image/source_id',
+    'image/object/class/label',
+    'image/object/class/text',
+)
+
+_PARTS_KEYS = (
+    'image/object/parts/x',
+    'image/object/parts/y',
+    'image/object/parts/v',
+    'image/object/parts/score',
+)
+
+# profile name -> keys of the features written, in the order of FEATURES
+PROFILES = collections.OrderedDict(
+    (name, tuple(feature.key for feature in FEATURES if feature.key in keys))
+    for name, keys in (
+        ('classification', _IMAGE_KEYS + _CLASS_KEYS),
+        ('detection', _IMAGE_KEYS + _CLASS_KEYS + _BOX_KEYS + _DETECTION_KEYS),
+        ('keypoints', _IMAGE_KEYS + _CLASS_KEYS + _BOX_KEYS + _PARTS_KEYS),
+        ('full', tuple(feature.key for feature in FEATURES)),
+    )
+)
+
+
+def profile_keys(profile):
+    """The keys of the features of a profile, see PROFILES."""
+    if profile not in PROFILES:
+        raise ValueError('profile must be one of %s, got %r' % (tuple(PROFILES), profile))
+    return PROFILES[profile]
+
+
+def written_profile(tfrecords):
+    """
+    The profile the tfrecord files were written with, from the summaries of their builds.
+    Args:
+        tfrecords : list of paths to tfrecord files
+    Returns:
+        string : the profile, None if a file is not in a summary, or is in the summary of
+            an older build, which does not record its profile.
+    Raises:
+        ValueError : the files were written with different profiles.
+    """
+    profiles = {}
+    for tfrecord in tfrecords:
+        directory, filename = os.path.split(tfrecord)
+        match = SHARD_FILENAME.match(filename)
+        if match is None:
+            return None
+
+        summary_file = os.path.join(directory, '%s-summary.json' % (match.group(1),))
+        if summary_file not in profiles:
+            if not os.path.exists(summary_file):
+                return None
+            with open(summary_file) as f:
+                profiles[summary_file] = json.load(f).get('profile')
+        if profiles[summary_file] is None:
+            return None
+
+    written_profiles = set(profiles.values())
+    if len(written_profiles) > 1:
+        raise ValueError('The tfrecord files were written with different profiles: %s' %
+                         (', '.join(sorted(written_profiles)),))
+    return written_profiles.pop() if written_profiles else None
@@ -1,16 +1,45 @@
 import os
 import sys
 import argparse
-
-import numpy as np
-import tensorflow as tf
+import json
+import math
+from datetime import datetime
 
 try:
-  from create_tfrecords import create
-  from dataset_utils import parse_dataset_mimic_final_structure
+  from create_tfrecords import create, DEDUP_INDEX_FILENAME
+  from remote_storage import is_remote
+  from dataset_utils import (parse_dataset_mimic_final_structure, diff_dataset_structures,
+                             load_dataset_structure, save_dataset_structure)
 except:
-  from tfrecords_creater.create_tfrecords import create
-  from tfrecords_creater.dataset_utils import parse_dataset_mimic_final_structure
+  from tfrecords_creater.create_tfrecords import create, DEDUP_INDEX_FILENAME
+  from tfrecords_creater.remote_storage import is_remote
+  from tfrecords_creater.dataset_utils import (parse_dataset_mimic_final_structure, diff_dataset_structures,
+                                               load_dataset_structure, save_dataset_structure)
+
+
+def _append_tombstones(output_directory, dataset_name, removed_images):
+    """
+    Record images removed from the dataset in `<dataset_name>-tombstones.json`.
+    The shards of earlier builds still hold these images, readers should skip their ids.
+    """
+    tombstones_filepath = os.path.join(output_directory, f"{dataset_name}-tombstones.json")
+    tombstones = []
+    if os.path.exists(tombstones_filepath):
+        with open(tombstones_filepath) as f:
+            tombstones = json.load(f)
+
+    removed_at = datetime.now().isoformat()
+    for image_data in removed_images:
+        tombstones.append({
+            "id": image_data["id"],
+            "filename": image_data["filename"],
+            "removed_at": removed_at,
+        })
+
+    with open(tombstones_filepath, 'w') as fout:
+        json.dump(tombstones, fout)
+
+    return tombstones_filepath
 
  
 def generate_tfrecords(
@@ -18,31 +47,123 @@ def generate_tfrecords(
         num_shards=10, num_threads=5, shuffle=False, store_images=True,
         explicit_labels=set(), store_mimicked_structure_json=True,
         mimicked_json_filepath=None, silent_on_extra_explicit_labels=False,
-        save_labels=True, labels_out_filepath=None,
+        save_labels=True, labels_out_filepath=None, executor='threads',
+        verify_decode_rate=0., transcode='jpeg', quality=100, png_compression=-1,
+        target_shard_mb=None, seed=None, resume=False, incremental=False,
+        dedup=None, dedup_index_path=None, backend='tensorflow', scan_threads=8,
+        profile='classification', num_io_threads=8, num_writer_threads=2,
+        storage_options=None, staging_directory=None, upload_threads=8, upload_retries=5,
+        max_staging_mb=None, metrics_path=None, prometheus_path=None, metrics_interval=10.,
     ):
+    """
+    Build the tfrecords of a dataset with one folder per class.
+
+    With `incremental` the dataset is compared against the mimicked structure json of the
+    previous build, by filename, size and mtime. Only the added (or changed) images are
+    written, to new shards named `<dataset_name>-update-<timestamp>-...`, and the removed
+    (or changed) images are recorded in `<dataset_name>-tombstones.json`. Unchanged images
+    keep their ids. Without a previous mimicked structure json, the whole dataset is built.
+
+    With `dedup` (`drop` or `count`) the images are checked against a sha256 hash index,
+    `sha256-index.npy` in the output directory unless `dedup_index_path` is given. A
+    build of the whole dataset starts a new index, an incremental update checks the added
+    images against the index of the earlier builds and extends it.
+
+    The records are written with the `classification` profile by default, the datasets
+    of class folders have no objects, see `create`.
+
+    The class folders are scanned concurrently by `scan_threads` threads. The mimicked
+    structure json of the previous build is also a cache of its scan: only the
+    directories that changed since are listed again, and unchanged images keep their ids.
+
+    With the `pipeline` executor, `num_io_threads` threads read the images, `num_threads`
+    threads process them and `num_writer_threads` threads write the shards, see `create`.
+
+    With a remote `output_directory`, e.g. `gs://bucket/tfrecords`, the shards are written
+    to `staging_directory` and uploaded as they are completed. The mimicked structure json,
+    the labels and the tombstones are kept in `staging_directory`, so it is required.
+
+    With `metrics_path` or `prometheus_path` the throughput and stage timings of the build
+    are reported every `metrics_interval` seconds, see `create`.
+    """
+    if incremental and resume:
+        raise ValueError("An incremental update can not be resumed, run it again instead.")
+
+    # the files kept between builds, next to the shards unless those are uploaded
+    local_directory = output_directory
+    if is_remote(output_directory):
+        if staging_directory is None:
+            raise ValueError("A remote output_directory needs a staging_directory, to keep the "
+                             "mimicked structure json and the labels between builds.")
+        local_directory = staging_directory
+
     if mimicked_json_filepath is None:
         mimicked_json_filepath = os.path.join(
-            output_directory, f"mimicked_structure-{dataset_name}.json"
+            local_directory, f"mimicked_structure-{dataset_name}.json"
         )
 
     if labels_out_filepath is None:
         labels_out_filepath = os.path.join(
-            output_directory, f"labels.txt"
+            local_directory, f"labels.txt"
         )
 
-    os.makedirs(output_directory, exist_ok=True)
+    os.makedirs(local_directory, exist_ok=True)
+
+    # structure of the previous build, read before it is overwritten
+    previous_structure = None
+    if os.path.exists(mimicked_json_filepath):
+        previous_structure = load_dataset_structure(mimicked_json_filepath)
+
+    previous_dataset = None
+    if incremental:
+        if previous_structure is not None:
+            previous_dataset = previous_structure["images"]
+        else:
+            print(f"No previous build found at {mimicked_json_filepath}, building the whole dataset.")
 
     # this should be your array of image data dictionaries. 
+    scanned_directories = {}
     dataset = parse_dataset_mimic_final_structure(
         dataset_dir,
         explicit_labels=explicit_labels,
         silent_on_extra_explicit_labels=silent_on_extra_explicit_labels,
-        store_mimicked_structure_json=store_mimicked_structure_json,
+        store_mimicked_structure_json=store_mimicked_structure_json and previous_dataset is None,
         mimicked_json_filepath=mimicked_json_filepath,
         save_labels=save_labels,
         labels_out_filepath=labels_out_filepath,
+        collect_file_stats=store_mimicked_structure_json or incremental,
+        scan_threads=scan_threads,
+        scan_cache=previous_structure,
+        scanned_directories=scanned_directories,
     )
 
+    if dedup is not None and dedup_index_path is None:
+        dedup_index_path = os.path.join(local_directory, DEDUP_INDEX_FILENAME)
+
+    if dedup is not None and previous_dataset is None and not resume:
+        if os.path.exists(dedup_index_path):
+            print(f"Building the whole dataset, starting a new hash index instead of {dedup_index_path}")
+            os.remove(dedup_index_path)
+
+    if previous_dataset is not None:
+        kept, added, removed = diff_dataset_structures(previous_dataset, dataset)
+        print(f"Incremental update: {len(kept)} unchanged, {len(added)} added, {len(removed)} removed images.")
+
+        if removed:
+            tombstones_filepath = _append_tombstones(local_directory, dataset_name, removed)
+            print(f"Removed images recorded in {tombstones_filepath}")
+
+        dataset = sorted(kept + added, key=lambda image_data: image_data["id"])
+        if not added:
+            if store_mimicked_structure_json:
+                save_dataset_structure(mimicked_json_filepath, dataset, scanned_directories)
+            return []
+
+        # new shards for the added images only, about as large as the existing shards
+        num_shards = max(1, int(math.ceil(num_shards * len(added) / float(len(dataset)))))
+        dataset_name = f"{dataset_name}-update-{datetime.now():%Y%m%d%H%M%S}"
+        updated_dataset, dataset = dataset, added
+
     failed_images = create(
         dataset=dataset,
         dataset_name=dataset_name,
@@ -50,8 +171,40 @@ def generate_tfrecords(
         num_shards=num_shards,
         num_threads=num_threads,
         shuffle=shuffle,
-        store_images=store_images
+        store_images=store_images,
+        executor=executor,
+        verify_decode_rate=verify_decode_rate,
+        transcode=transcode,
+        quality=quality,
+        png_compression=png_compression,
+        target_shard_mb=target_shard_mb,
+        seed=seed,
+        resume=resume,
+        dedup=dedup,
+        dedup_index_path=dedup_index_path,
+        backend=backend,
+        profile=profile,
+        num_io_threads=num_io_threads,
+        num_writer_threads=num_writer_threads,
+        storage_options=storage_options,
+        staging_directory=staging_directory,
+        upload_threads=upload_threads,
+        upload_retries=upload_retries,
+        max_staging_mb=max_staging_mb,
+        metrics_path=metrics_path,
+        prometheus_path=prometheus_path,
+        metrics_interval=metrics_interval
     )
+
+    if previous_dataset is not None and store_mimicked_structure_json:
+        # failed images are left out, so the next update tries them again
+        failed_filenames = set(image_data["filename"] for image_data in failed_images)
+        updated_dataset = [
+            image_data for image_data in updated_dataset
+            if image_data["filename"] not in failed_filenames
+        ]
+        save_dataset_structure(mimicked_json_filepath, updated_dataset, scanned_directories)
+
     return failed_images
 
 
@@ -68,12 +221,13 @@ def parse_args():
                         required=True)
 
     parser.add_argument('--output_dir', dest='output_dir',
-                        help='Directory for the tfrecords.', type=str,
+                        help='Directory for the tfrecords, or a remote url such as '
+                             'gs://bucket/tfrecords to upload every shard to.', type=str,
                         required=True)
 
     parser.add_argument('--shards', dest='num_shards',
-                        help='Number of shards to make.', type=int,
-                        required=True)
+                        help='Number of shards to make, unused with --target_shard_mb.', type=int,
+                        required=False, default=1)
 
     parser.add_argument('--threads', dest='num_threads',
                         help='Number of threads to make.', type=int,
@@ -100,6 +254,126 @@ def parse_args():
                         help='Filename to store -- parsed dataset structure(mimicked tfrecords structure).', type=str,
                         required=False)
 
+    parser.add_argument('--executor', dest='executor',
+                        help='Run batches in `threads` sharing one image coder, in worker '
+                             '`processes` that each have their own image coder, or in a '
+                             '`pipeline` of reader, worker and writer threads.',
+                        choices=['threads', 'processes', 'pipeline'],
+                        required=False, default='threads')
+
+    parser.add_argument('--io_threads', dest='num_io_threads',
+                        help='Number of threads reading the image files with --executor '
+                             'pipeline.',
+                        type=int, required=False, default=8)
+
+    parser.add_argument('--writer_threads', dest='num_writer_threads',
+                        help='Number of threads writing the shards with --executor pipeline.',
+                        type=int, required=False, default=2)
+
+    parser.add_argument('--verify_decode_rate', dest='verify_decode_rate',
+                        help='Fraction of the images to fully decode to check their integrity. '
+                             'The dimensions of the other images are read from their headers.',
+                        type=float, required=False, default=0.)
+
+    parser.add_argument('--transcode', dest='transcode',
+                        help='How PNG images are stored: `passthrough` keeps the original bytes, '
+                             '`jpeg` converts to JPEG, `png` re-compresses the PNG and `webp` '
+                             'converts to WebP. JPEG images are always stored as they are.',
+                        choices=['passthrough', 'jpeg', 'png', 'webp'],
+                        required=False, default='jpeg')
+
+    parser.add_argument('--quality', dest='quality',
+                        help='Quality of the JPEG and WebP encodings.',
+                        type=int, required=False, default=100)
+
+    parser.add_argument('--png_compression', dest='png_compression',
+                        help='zlib compression level of the PNG encoding, -1 for the default.',
+                        type=int, required=False, default=-1)
+
+    parser.add_argument('--target_shard_mb', dest='target_shard_mb',
+                        help='Size the shards to about this many megabytes instead of making '
+                             '--shards shards.',
+                        type=float, required=False, default=None)
+
+    parser.add_argument('--seed', dest='seed',
+                        help='Seed of the shuffle, the same seed gives the same shards.',
+                        type=int, required=False, default=None)
+
+    parser.add_argument('--resume', dest='resume',
+                        help='Resume an interrupted build from its journal, skipping the '
+                             'completed shards. Pass the --seed of the interrupted build.',
+                        required=False, action='store_true', default=False)
+
+    parser.add_argument('--incremental', dest='incremental',
+                        help='Only write the images added since the previous build, and record '
+                             'the removed ones in <prefix>-tombstones.json.',
+                        required=False, action='store_true', default=False)
+
+    parser.add_argument('--dedup', dest='dedup',
+                        help='`drop` or `count` the images whose content hash is already in '
+                             'the hash index, of this build or of an earlier one.',
+                        choices=['drop', 'count'],
+                        required=False, default=None)
+
+    parser.add_argument('--dedup_index_path', dest='dedup_index_path',
+                        help='Path of the hash index, defaults to sha256-index.npy in the '
+                             'output directory.',
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--backend', dest='backend',
+                        help='Write the records with `tensorflow`, or with `python` that does '
+                             'not need tensorflow and codes the images with Pillow.',
+                        choices=['tensorflow', 'python'],
+                        required=False, default='tensorflow')
+
+    parser.add_argument('--profile', dest='profile',
+                        help='Features written to every record: `classification`, `detection`, '
+                             '`keypoints` or `full`.',
+                        choices=['classification', 'detection', 'keypoints', 'full'],
+                        required=False, default='classification')
+
+    parser.add_argument('--scan_threads', dest='scan_threads',
+                        help='Number of class folders of the dataset scanned concurrently.',
+                        type=int, required=False, default=8)
+
+    parser.add_argument('--storage_options', dest='storage_options',
+                        help='JSON dict of the options of the fsspec filesystem of a remote '
+                             '--output_dir, e.g. \'{"client_kwargs": {"endpoint_url": '
+                             '"http://127.0.0.1:5000"}}\'.',
+                        type=json.loads, required=False, default=None)
+
+    parser.add_argument('--staging_dir', dest='staging_directory',
+                        help='Local directory of the shards of a remote --output_dir until '
+                             'they are uploaded, it also keeps the mimicked structure json '
+                             'and the labels. Required with a remote --output_dir.',
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--upload_threads', dest='upload_threads',
+                        help='Number of concurrent uploads to a remote --output_dir.',
+                        type=int, required=False, default=8)
+
+    parser.add_argument('--upload_retries', dest='upload_retries',
+                        help='Number of retries of a failed upload.',
+                        type=int, required=False, default=5)
+
+    parser.add_argument('--max_staging_mb', dest='max_staging_mb',
+                        help='Only start a new shard while the shards waiting for their upload '
+                             'take less than this many megabytes.',
+                        type=float, required=False, default=None)
+
+    parser.add_argument('--metrics_path', dest='metrics_path',
+                        help='JSON-Lines file to append the throughput and stage timings of '
+                             'the build to, every --metrics_interval seconds.',
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--prometheus_path', dest='prometheus_path',
+                        help='Prometheus textfile to write the same metrics to.',
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--metrics_interval', dest='metrics_interval',
+                        help='Seconds between two reports of the metrics.',
+                        type=float, required=False, default=10.)
+
     parsed_args = parser.parse_args()
 
     return parsed_args
@@ -136,12 +410,36 @@ def main():
         store_images=args.store_images,
         explicit_labels=args.explicit_labels,
         store_mimicked_structure_json=args.store_mimicked_structure_json,
-        mimicked_json_filepath=args.mimicked_json_filepath
+        mimicked_json_filepath=args.mimicked_json_filepath,
+        executor=args.executor,
+        verify_decode_rate=args.verify_decode_rate,
+        transcode=args.transcode,
+        quality=args.quality,
+        png_compression=args.png_compression,
+        target_shard_mb=args.target_shard_mb,
+        seed=args.seed,
+        resume=args.resume,
+        incremental=args.incremental,
+        dedup=args.dedup,
+        dedup_index_path=args.dedup_index_path,
+        backend=args.backend,
+        scan_threads=args.scan_threads,
+        profile=args.profile,
+        num_io_threads=args.num_io_threads,
+        num_writer_threads=args.num_writer_threads,
+        storage_options=args.storage_options,
+        staging_directory=args.staging_directory,
+        upload_threads=args.upload_threads,
+        upload_retries=args.upload_retries,
+        max_staging_mb=args.max_staging_mb,
+        metrics_path=args.metrics_path,
+        prometheus_path=args.prometheus_path,
+        metrics_interval=args.metrics_interval
     )
     
     if errors:
-        print("%d images failed." % (len(failed_images),))
-        for image_data in failed_images:
+        print("%d images failed." % (len(errors),))
+        for image_data in errors:
             print("Image %s: %s" % (image_data['id'], image_data['error_msg']))
     return
 